@@ -10,6 +10,10 @@ apt install -y git \
     kmod \
     libelf-dev \
     libdw-dev \
+    libcap-dev \
+    zlib1g-dev \
+    libzstd-dev \
+    libnuma-dev \
     cpio \
     build-essential \
     libssl-dev \
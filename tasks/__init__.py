@@ -3,6 +3,7 @@ from invoke import Collection
 from . import (
     kernel,
     rootfs,
+    tracing,
     vm,
 )
 
@@ -10,3 +11,5 @@ ns = Collection()
 ns.add_collection(kernel)
 ns.add_collection(rootfs)
 ns.add_collection(vm)
+
+tracing.install(ns)
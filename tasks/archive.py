@@ -0,0 +1,311 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import IO, BinaryIO, Optional
+
+from invoke.context import Context as InvokeContext
+
+from tasks.kernel import (
+    KernelBuildPaths,
+    KernelManifest,
+    KernelVersion,
+    get_kernel_pkg_dir,
+    manifest_add_kuuid,
+    open_registry,
+    save_manifest,
+)
+from tasks.compiler import CONTAINER_LINUX_BUILD_PATH
+from tasks.tool import Exit, info, warn
+
+ARCHIVE_SUFFIX = ".tar.zst"
+REF_SUFFIX = ".ref"
+CHUNK_SIZE = 1 << 20
+
+# Host local state of a kernel package which is never exported: the guest
+# disk, its network and ssh identity, and files generated by vm.init
+EXPORT_EXCLUDES = [
+    "overlay.qcow2",
+    "overlay.chroot",
+    "scratch",
+    "debug",
+    "gdb-index-cache",
+    "vm-*.id_rsa*",
+    "*.pid",
+    "*.log",
+    "run.sh",
+    "gdb.sh",
+    "ssh_connect",
+    "ssh_shutdown",
+    "steps.json",
+]
+# Manifest fields allocated on the exporting host, see tasks/registry.py
+HOST_FIELDS = [
+    "gateway_ip",
+    "guest_ip",
+    "tap_name",
+    "gdb_port",
+    "ssh_key",
+    "debuginfod",
+]
+
+
+def is_remote(location: str) -> bool:
+    return location.startswith("http://") or location.startswith("https://")
+
+
+def ref_name(kversion: KernelVersion) -> str:
+    return get_kernel_pkg_dir(kversion).name + REF_SUFFIX
+
+
+def open_location(location: str, name: str) -> BinaryIO:
+    if is_remote(location):
+        try:
+            response: BinaryIO = urllib.request.urlopen(
+                f"{location.rstrip('/')}/{name}"
+            )
+        except OSError as e:
+            raise Exit(f"unable to fetch {name} from {location}: {e}")
+        return response
+
+    path = Path(location) / name
+    if not path.exists():
+        raise Exit(f"{path} does not exist")
+    return open(path, "rb")
+
+
+def store(location: str, name: str, src: Path) -> None:
+    if is_remote(location):
+        with open(src, "rb") as f:
+            request = urllib.request.Request(
+                f"{location.rstrip('/')}/{name}",
+                data=f,
+                method="PUT",
+                headers={"Content-Length": str(src.stat().st_size)},
+            )
+            urllib.request.urlopen(request).close()
+        return
+
+    dest = Path(location)
+    dest.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(src, dest / f".{name}.tmp")
+    (dest / f".{name}.tmp").replace(dest / name)
+
+
+def export_kernel(ctx: InvokeContext, kversion: KernelVersion, dest: str) -> str:
+    """Archive a kernel package with multithreaded zstd. The archive is named
+    after its sha256 and a <package>.ref file points at the latest one."""
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    if not (pkg_dir / "kernel.manifest").exists():
+        raise Exit(f"kernel {kversion} is not built, no manifest in {pkg_dir}")
+
+    excludes = " ".join([f"--exclude='{pkg_dir.name}/{e}'" for e in EXPORT_EXCLUDES])
+    start = time.monotonic()
+    with tempfile.TemporaryDirectory(dir=KernelBuildPaths.kernel_sources_dir) as tmp:
+        archive = Path(tmp) / f"{pkg_dir.name}{ARCHIVE_SUFFIX}"
+        ctx.run(
+            f"tar -C {KernelBuildPaths.kernel_sources_dir} {excludes} -cf - {pkg_dir.name} | zstd -T0 -q -c > {archive}"
+        )
+
+        digest = hashlib.sha256()
+        with open(archive, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+        sha = digest.hexdigest()
+
+        size = archive.stat().st_size
+        store(dest, sha + ARCHIVE_SUFFIX, archive)
+        ref = Path(tmp) / "ref"
+        ref.write_text(sha)
+        store(dest, ref_name(kversion), ref)
+
+    info(
+        f"[+] Exported {kversion} as {sha}{ARCHIVE_SUFFIX} ({size / (1 << 20):.0f}MiB) "
+        f"to {dest} in {time.monotonic() - start:.1f}s"
+    )
+    return sha
+
+
+def localize_source_dir(path: str) -> str:
+    """Map the build tree of the exporting host to the same tree here"""
+    if Path(path).is_relative_to(CONTAINER_LINUX_BUILD_PATH):
+        return path
+
+    marker = f"/{KernelBuildPaths.linux_stable.name}/"
+    if marker not in path:
+        return path
+
+    worktree = path.split(marker, 1)[1]
+    return (KernelBuildPaths.linux_stable / worktree).absolute().as_posix()
+
+
+def localize_manifest(
+    manifest: KernelManifest, kversion: KernelVersion
+) -> KernelManifest:
+    for field in HOST_FIELDS:
+        manifest.pop(field, None)  # type: ignore
+
+    if "kernel_source_dir" in manifest:
+        manifest["kernel_source_dir"] = localize_source_dir(
+            manifest["kernel_source_dir"]
+        )
+    if "vmlinux_btf" in manifest:
+        pkg_dir = get_kernel_pkg_dir(kversion).absolute()
+        manifest["vmlinux_btf"] = (
+            pkg_dir / Path(manifest["vmlinux_btf"]).name
+        ).as_posix()
+
+    return manifest_add_kuuid(manifest, kversion)
+
+
+def close_pipe(pipe: IO[bytes]) -> None:
+    # closing flushes what is buffered, the reader may be gone already
+    try:
+        pipe.close()
+    except BrokenPipeError:
+        pass
+
+
+def import_kernel(
+    ctx: InvokeContext, kversion: KernelVersion, source: str, force: bool = False
+) -> None:
+    """Fetch the latest archive of a kernel package, decompressing it while it
+    streams in. The package is only moved into place once the sha256 of the
+    archive matches its name."""
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    if pkg_dir.exists() and not force:
+        raise Exit(f"{pkg_dir} already exists, pass --force to replace it")
+
+    with open_location(source, ref_name(kversion)) as f:
+        sha = f.read().decode().strip()
+
+    start = time.monotonic()
+    KernelBuildPaths.kernel_sources_dir.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(
+        dir=KernelBuildPaths.kernel_sources_dir
+    ) as staging:
+        digest = hashlib.sha256()
+        untar = subprocess.Popen(
+            f"zstd -d -q -c | tar -C {staging} -xf -", shell=True, stdin=subprocess.PIPE
+        )
+        assert untar.stdin is not None
+        with open_location(source, sha + ARCHIVE_SUFFIX) as archive:
+            try:
+                while chunk := archive.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    if untar.stdin.closed:
+                        continue
+                    try:
+                        untar.stdin.write(chunk)
+                    except BrokenPipeError:
+                        # zstd or tar gave up on a damaged archive, the rest
+                        # is only hashed to report it
+                        close_pipe(untar.stdin)
+            finally:
+                close_pipe(untar.stdin)
+
+        extracted = untar.wait() == 0
+        if digest.hexdigest() != sha:
+            raise Exit(
+                f"{sha}{ARCHIVE_SUFFIX} is corrupted, its sha256 is {digest.hexdigest()}"
+            )
+        if not extracted:
+            raise Exit(f"unable to extract {sha}{ARCHIVE_SUFFIX}")
+
+        staged = Path(staging) / pkg_dir.name
+        if not (staged / "kernel.manifest").exists():
+            raise Exit(
+                f"{sha}{ARCHIVE_SUFFIX} does not contain a {pkg_dir.name} package"
+            )
+
+        if pkg_dir.exists():
+            warn(f"[!] Replacing {pkg_dir}")
+            shutil.rmtree(pkg_dir)
+        staged.replace(pkg_dir)
+
+    with open(pkg_dir / "kernel.manifest", "r") as f:
+        manifest: KernelManifest = json.load(f)
+
+    manifest = localize_manifest(manifest, kversion)
+    save_manifest(manifest, kversion)
+    with open_registry() as registry:
+        registry.release_owner(pkg_dir.name)
+        registry.register_kernel(pkg_dir.name, manifest["kid"])
+
+    info(f"[+] Imported {kversion} from {source} in {time.monotonic() - start:.1f}s")
+    info(
+        f"[+] Run 'inv rootfs.build --kernel-version={kversion}' and 'inv vm.init' to boot it"
+    )
+
+
+def make_cache_handler(root: Path) -> type[BaseHTTPRequestHandler]:
+    class CacheHandler(BaseHTTPRequestHandler):
+        def _path(self) -> Optional[Path]:
+            name = self.path.strip("/")
+            if "/" in name or name.startswith("."):
+                return None
+            return root / name
+
+        def do_GET(self) -> None:
+            path = self._path()
+            if path is None or not path.is_file():
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(path.stat().st_size))
+            self.end_headers()
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+        def do_PUT(self) -> None:
+            path = self._path()
+            length = self.headers.get("Content-Length")
+            if path is None or length is None:
+                self.send_error(400)
+                return
+
+            tmp = root / f".{path.name}.tmp"
+            remaining = int(length)
+            with open(tmp, "wb") as f:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    remaining -= len(chunk)
+
+            if remaining > 0:
+                tmp.unlink()
+                self.send_error(400)
+                return
+
+            tmp.replace(path)
+            self.send_response(201)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format: str, *args: object) -> None:
+            info(f"[cache] {self.address_string()} {format % args}")
+
+    return CacheHandler
+
+
+def serve_cache(root: Path, host: str, port: int) -> None:
+    root.mkdir(parents=True, exist_ok=True)
+    server = ThreadingHTTPServer((host, port), make_cache_handler(root))
+    info(f"[+] Serving kernel packages in {root} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        warn("[!] Package cache stopped")
+    finally:
+        server.server_close()
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import json
+import math
+import time
+import uuid
+from typing import Any, Optional
+
+from tasks.arch import Arch
+from tasks.elf import read_build_id
+from tasks.guest import vm_running
+from tasks.kernel import (
+    KernelBuildPaths,
+    KernelVersion,
+    get_kernel_image_name,
+    get_kernel_pkg_dir,
+)
+from tasks.tool import Exit, info, warn
+from tasks.vm import snapshot_run
+
+BENCH_RESULTS = KernelBuildPaths.kernel_sources_dir / "bench" / "results.jsonl"
+# coefficient of variation above which a result is flagged as noisy
+NOISE_CV = 0.05
+
+# Every workload prints "<workload> <metric> <value> <unit> <higher|lower>"
+# per sample. They only use what the debootstrapped rootfs ships, bpftool
+# is optional.
+WORKLOADS = {
+    "sched": """
+s=$(now); dd if=/dev/zero bs=1 count=200000 status=none | dd of=/dev/null bs=1 status=none; e=$(now)
+echo "sched pipe_msgs_per_sec $(( 200000 * 1000000000 / (e - s) )) msg/s higher"
+s=$(now); for _ in $(seq 1000); do /bin/true; done; e=$(now)
+echo "sched fork_exec_per_sec $(( 1000 * 1000000000 / (e - s) )) proc/s higher"
+""",
+    "syscall": """
+s=$(now); dd if=/dev/zero of=/dev/null bs=1 count=1000000 status=none; e=$(now)
+echo "syscall read_write_per_sec $(( 2000000 * 1000000000 / (e - s) )) ops/s higher"
+""",
+    "net": """
+socat -u TCP-LISTEN:5201,reuseaddr OPEN:/dev/null & srv=$!
+sleep 0.5
+s=$(now); dd if=/dev/zero bs=1M count=1024 status=none | socat -u - TCP:127.0.0.1:5201; e=$(now)
+wait $srv
+echo "net tcp_loopback_mb_per_sec $(( 1024 * 1000000000 / (e - s) )) MB/s higher"
+""",
+    "block": """
+f=/root/.kbuild-bench.img
+s=$(now); dd if=/dev/zero of=$f bs=1M count=256 oflag=direct status=none; e=$(now)
+echo "block seq_write_mb_per_sec $(( 256 * 1000000000 / (e - s) )) MB/s higher"
+sync; echo 3 > /proc/sys/vm/drop_caches
+s=$(now); dd if=$f of=/dev/null bs=1M iflag=direct status=none; e=$(now)
+echo "block seq_read_mb_per_sec $(( 256 * 1000000000 / (e - s) )) MB/s higher"
+rm -f $f
+""",
+    "bpf": """
+if command -v bpftool >/dev/null; then
+    s=$(now); bpftool feature probe kernel >/dev/null 2>&1; e=$(now)
+    echo "bpf feature_probe_ms $(( (e - s) / 1000000 )) ms lower"
+fi
+""",
+}
+
+# one discarded warm up round, then the measured iterations
+SUITE_TEMPLATE = """
+now() {{ date +%s%N; }}
+{functions}
+for w in {workloads}; do bench_$w >/dev/null; done
+for _ in $(seq {iterations}); do
+    for w in {workloads}; do bench_$w; done
+done
+"""
+
+
+def suite_script(workloads: list[str], iterations: int) -> str:
+    functions = "\n".join([f"bench_{w}() {{{WORKLOADS[w]}}}" for w in workloads])
+    return SUITE_TEMPLATE.format(
+        functions=functions, workloads=" ".join(workloads), iterations=iterations
+    )
+
+
+def parse_samples(stdout: str) -> dict[str, dict[str, Any]]:
+    metrics: dict[str, dict[str, Any]] = dict()
+    for line in stdout.splitlines():
+        fields = line.split()
+        if len(fields) != 5 or fields[0] not in WORKLOADS:
+            continue
+
+        workload, metric, value, unit, direction = fields
+        try:
+            sample = float(value)
+        except ValueError:
+            continue
+
+        entry = metrics.setdefault(
+            f"{workload}.{metric}",
+            {
+                "unit": unit,
+                "higher_is_better": direction == "higher",
+                "samples": list(),
+            },
+        )
+        entry["samples"].append(sample)
+    return metrics
+
+
+def mean_cv(samples: list[float]) -> tuple[float, float]:
+    mean = sum(samples) / len(samples)
+    if len(samples) < 2 or mean == 0:
+        return mean, 0.0
+    variance = sum([(s - mean) ** 2 for s in samples]) / (len(samples) - 1)
+    return mean, math.sqrt(variance) / abs(mean)
+
+
+def load_results() -> list[dict[str, Any]]:
+    if not BENCH_RESULTS.exists():
+        return list()
+    with open(BENCH_RESULTS, "r") as f:
+        return [json.loads(line) for line in f if line.strip() != ""]
+
+
+def append_result(record: dict[str, Any]) -> None:
+    BENCH_RESULTS.parent.mkdir(parents=True, exist_ok=True)
+    with open(BENCH_RESULTS, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def run_suite(
+    kversion: KernelVersion,
+    arch: Arch,
+    workloads: list[str],
+    iterations: int,
+    cpus: int,
+    memory: str,
+    timeout: float,
+    run_id: str,
+) -> dict[str, Any]:
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    if not (pkg_dir / "kernel.manifest").exists():
+        raise Exit(f"kernel {kversion} is not initialized, run vm.init first")
+    if vm_running(pkg_dir / "vm.pid"):
+        raise Exit(f"VM of kernel {kversion} is running, stop it before benchmarking")
+
+    build_id = read_build_id(pkg_dir / "vmlinux")
+    if build_id is None:
+        raise Exit(f"{pkg_dir}/vmlinux has no build id")
+
+    info(f"[+] Running {', '.join(workloads)} on {kversion} ({cpus} cpus, {memory})")
+    start = time.monotonic()
+    result = snapshot_run(
+        kversion,
+        pkg_dir / get_kernel_image_name(arch),
+        suite_script(workloads, iterations),
+        timeout,
+        tag="bench",
+        cpus=cpus,
+        memory=memory,
+    )
+    if result is None:
+        raise Exit(f"guest did not become ssh-ready, see {pkg_dir}/bench.log")
+    if not result.ok:
+        raise Exit(f"benchmark suite failed on {kversion}:\n{result.stderr}")
+
+    metrics = parse_samples(result.stdout)
+    missing = [w for w in workloads if not any(m.startswith(f"{w}.") for m in metrics)]
+    if len(missing) > 0:
+        warn(f"[!] No results from {', '.join(missing)} on {kversion}")
+
+    info(f"[+] {kversion} done in {time.monotonic() - start:.0f}s")
+    return {
+        "run": run_id,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "kernel": str(kversion),
+        "build_id": build_id,
+        "cpus": cpus,
+        "memory": memory,
+        "iterations": iterations,
+        "metrics": metrics,
+    }
+
+
+def same_setup(a: dict[str, Any], b: dict[str, Any]) -> bool:
+    return bool(
+        a["build_id"] == b["build_id"]
+        and a["cpus"] == b["cpus"]
+        and a["memory"] == b["memory"]
+    )
+
+
+def report(records: list[dict[str, Any]], history: list[dict[str, Any]]) -> None:
+    """Mean and variation of every metric per kernel, with the delta to the
+    kernel before it. A delta within the noise of both is marked '~'.
+    Earlier runs of the same build and resources show whether results
+    are reproducible across boots."""
+    names = sorted({m for r in records for m in r["metrics"]})
+    for name in names:
+        first = next(r["metrics"][name] for r in records if name in r["metrics"])
+        better = "higher" if first["higher_is_better"] else "lower"
+        info(f"[+] {name} ({first['unit']}, {better} is better)")
+
+        previous: Optional[tuple[float, float]] = None
+        for r in records:
+            if name not in r["metrics"]:
+                warn(f"    {r['kernel']:<12} no result")
+                continue
+
+            mean, cv = mean_cv(r["metrics"][name]["samples"])
+            flags = list()
+            if cv > NOISE_CV:
+                flags.append("noisy")
+
+            earlier = [
+                mean_cv(h["metrics"][name]["samples"])[0]
+                for h in history
+                if same_setup(h, r) and h["run"] != r["run"] and name in h["metrics"]
+            ]
+            if len(earlier) > 0:
+                _, across = mean_cv(earlier + [mean])
+                flags.append(f"{len(earlier) + 1} runs, {across:.1%} apart")
+                if across > NOISE_CV:
+                    flags.append("unstable across runs")
+
+            delta = ""
+            if previous is not None and previous[0] != 0:
+                change = (mean - previous[0]) / previous[0]
+                noise = 2 * math.sqrt(cv**2 + previous[1] ** 2)
+                if abs(change) <= noise:
+                    delta = f"{change:+.1%} ~"
+                else:
+                    improved = (change > 0) == first["higher_is_better"]
+                    delta = f"{change:+.1%} {'better' if improved else 'worse'}"
+
+            line = f"    {r['kernel']:<12} {mean:>14.1f} ±{cv:>5.1%}  {delta:<16} {', '.join(flags)}"
+            if "noisy" in flags or "unstable across runs" in flags:
+                warn(line)
+            else:
+                info(line)
+            previous = (mean, cv)
+
+
+def bench_kernels(
+    kversions: list[KernelVersion],
+    arch: Arch,
+    workloads: list[str],
+    iterations: int,
+    cpus: int,
+    memory: str,
+    timeout: float,
+    report_only: bool = False,
+) -> None:
+    """Kernels are booted one after another with the same resources, so
+    they do not compete with each other for the host"""
+    unknown = [w for w in workloads if w not in WORKLOADS]
+    if len(unknown) > 0:
+        raise Exit(
+            f"unknown workloads {', '.join(unknown)}, available: {', '.join(WORKLOADS)}"
+        )
+
+    history = load_results()
+    records = list()
+    if report_only:
+        for kversion in kversions:
+            build_id = read_build_id(get_kernel_pkg_dir(kversion) / "vmlinux")
+            latest = [h for h in history if h["build_id"] == build_id]
+            if len(latest) == 0:
+                raise Exit(f"no stored results for {kversion} (build id {build_id})")
+            records.append(latest[-1])
+    else:
+        run_id = str(uuid.uuid4())
+        for kversion in kversions:
+            record = run_suite(
+                kversion, arch, workloads, iterations, cpus, memory, timeout, run_id
+            )
+            append_result(record)
+            records.append(record)
+        info(f"[+] Results stored in {BENCH_RESULTS}")
+
+    report(records, history + records)
@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+import json
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from invoke.context import Context as InvokeContext
+from invoke.exceptions import UnexpectedExit
+
+from tasks.arch import Arch
+from tasks.compiler import CONTAINER_LINUX_BUILD_PATH, get_compiler
+from tasks.guest import vm_running
+from tasks.kernel import (
+    KernelBuildPaths,
+    KernelVersion,
+    Runner,
+    _make_config,
+    get_kernel_image_name,
+    get_kernel_pkg_dir,
+)
+from tasks.network import link_exists
+from tasks.tool import Exit, info, warn
+from tasks.vm import BOOT_TIMEOUT, snapshot_run
+
+# Not named bisect.py, invoke puts tasks/ on sys.path and it would shadow
+# the bisect module of the standard library.
+#
+# One persistent tree is reused for every step, so each candidate only
+# recompiles what changed since the previous one.
+BISECT_WORKTREE = "bisect-build/bisect"
+BISECT_STATE = KernelBuildPaths.kernel_sources_dir / "bisect.json"
+
+GOOD = "good"
+BAD = "bad"
+SKIP = "skip"
+# exit code of a test script asking to skip the commit, as for git bisect run
+SKIP_EXIT_CODE = 125
+
+
+def load_state() -> Optional[dict[str, Any]]:
+    if not BISECT_STATE.exists():
+        return None
+
+    with open(BISECT_STATE, "r") as f:
+        state: dict[str, Any] = json.load(f)
+    return state
+
+
+def save_state(state: dict[str, Any]) -> None:
+    tmp = BISECT_STATE.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=4)
+    tmp.replace(BISECT_STATE)
+
+
+def git(ctx: InvokeContext, worktree: Path, args: str, allow_fail: bool = False) -> str:
+    res = ctx.run(f"cd {worktree} && git {args}", hide=True, warn=allow_fail)
+    if res is None or not res.ok:
+        return ""
+    return str(res.stdout).strip()
+
+
+def bisect_in_progress(ctx: InvokeContext, worktree: Path) -> bool:
+    return worktree.exists() and git(ctx, worktree, "bisect log", allow_fail=True) != ""
+
+
+def ensure_worktree(ctx: InvokeContext, good: str) -> Path:
+    worktree = KernelBuildPaths.linux_stable / BISECT_WORKTREE
+    if not worktree.exists():
+        info(f"[+] Creating bisect worktree at {worktree}")
+        ctx.run(
+            f"cd {KernelBuildPaths.linux_stable} && git worktree add --detach {BISECT_WORKTREE} {good}"
+        )
+
+    return worktree
+
+
+def build_runner(
+    ctx: InvokeContext, worktree: Path, always_use_gcc8: bool
+) -> tuple[Runner, Path]:
+    if always_use_gcc8:
+        cc = get_compiler(ctx, KernelBuildPaths.kernel_sources_dir)
+        return cc.exec, CONTAINER_LINUX_BUILD_PATH / "linux-stable" / BISECT_WORKTREE
+
+    return ctx.run, worktree
+
+
+def build_candidate(run: Runner, build_dir: Path, arch: Arch) -> bool:
+    try:
+        run(f"make -C {build_dir} olddefconfig")
+        run(f"make -C {build_dir} -j$(nproc) {get_kernel_image_name(arch)}")
+    except UnexpectedExit as e:
+        warn(f"[!] Build failed: {e}")
+        return False
+
+    return True
+
+
+def test_candidate(
+    kversion: KernelVersion,
+    kernel_image: Path,
+    test_script: str,
+    timeout: float,
+    append: str,
+) -> tuple[str, str]:
+    result = snapshot_run(
+        kversion, kernel_image, test_script, timeout, append, tag="bisect"
+    )
+    if result is None:
+        pkg_dir = get_kernel_pkg_dir(kversion)
+        return BAD, f"not ssh-ready within {BOOT_TIMEOUT}s, see {pkg_dir}/bisect.log"
+
+    output = result.stdout + result.stderr
+    if result.exit_code == 0:
+        return GOOD, output
+    if result.exit_code == SKIP_EXIT_CODE:
+        return SKIP, output
+    return BAD, output
+
+
+def check_vm_kernel(kversion: KernelVersion) -> None:
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    manifest_file = pkg_dir / "kernel.manifest"
+    if not manifest_file.exists():
+        raise Exit(f"kernel {kversion} is not initialized, run vm.init first")
+
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+
+    for key in ["guest_ip", "tap_name", "gdb_port"]:
+        if key not in manifest:
+            raise Exit(
+                f"manifest of {kversion} does not contain '{key}', run vm.init first"
+            )
+
+    if not link_exists(manifest["tap_name"]):
+        raise Exit(f"tap {manifest['tap_name']} does not exist, run vm.init first")
+
+    if vm_running(pkg_dir / "vm.pid"):
+        raise Exit(
+            f"the VM of kernel {kversion} is running, its disk and tap are needed to bisect"
+        )
+
+
+def bisect_step(
+    run: Runner,
+    build_dir: Path,
+    arch: Arch,
+    commit: str,
+    state: dict[str, Any],
+    test: Callable[[], tuple[str, str]],
+) -> str:
+    start = time.monotonic()
+    built = build_candidate(run, build_dir, arch)
+    build_seconds = time.monotonic() - start
+
+    start = time.monotonic()
+    if built:
+        verdict, output = test()
+    else:
+        verdict, output = SKIP, "build failed"
+    test_seconds = time.monotonic() - start
+
+    info(
+        f"[+] {commit[:12]} is {verdict} (build {build_seconds:.1f}s, test {test_seconds:.1f}s)"
+    )
+    state["steps"].append(
+        {
+            "commit": commit,
+            "verdict": verdict,
+            "build_seconds": build_seconds,
+            "test_seconds": test_seconds,
+            "output": output[-4096:],
+        }
+    )
+    # the verdict is persisted before git moves on, an interrupted run
+    # resumes at the commit git bisect checked out next
+    save_state(state)
+    return verdict
+
+
+def run_bisect(
+    ctx: InvokeContext,
+    good: str,
+    bad: str,
+    test_script: Path,
+    vm_kversion: KernelVersion,
+    extra_config: Optional[str] = None,
+    always_use_gcc8: bool = False,
+    timeout: float = 600,
+    append: str = "",
+) -> Optional[str]:
+    check_vm_kernel(vm_kversion)
+    arch = Arch.local()
+    worktree = ensure_worktree(ctx, good)
+    run, build_dir = build_runner(ctx, worktree, always_use_gcc8)
+
+    state = load_state()
+    finished = state is not None and state["first_bad"] is not None
+    if state is not None and finished and (state["good"], state["bad"]) == (good, bad):
+        info(
+            f"[+] Bisection of {good}..{bad} already finished, first bad commit: {state['first_bad']}"
+        )
+        first_bad: Optional[str] = state["first_bad"]
+        return first_bad
+
+    if state is not None and bisect_in_progress(ctx, worktree):
+        if state["good"] != good or state["bad"] != bad:
+            raise Exit(
+                f"a bisection of {state['good']}..{state['bad']} is in progress, pass --reset to abandon it"
+            )
+        info(
+            f"[+] Resuming bisection of {good}..{bad} after {len(state['steps'])} steps"
+        )
+    else:
+        state = {
+            "good": good,
+            "bad": bad,
+            "test_script": test_script.absolute().as_posix(),
+            "vm_kernel": str(vm_kversion),
+            "steps": [],
+            "first_bad": None,
+        }
+        git(ctx, worktree, "bisect reset", allow_fail=True)
+        ctx.run(f"cd {worktree} && git bisect start {bad} {good}")
+        _make_config(ctx, build_dir, extra_config)
+        save_state(state)
+
+    script = test_script.read_text()
+    kernel_image = (
+        worktree / "arch" / arch.kernel_arch / "boot" / get_kernel_image_name(arch)
+    )
+
+    def test() -> tuple[str, str]:
+        return test_candidate(vm_kversion, kernel_image, script, timeout, append)
+
+    while state["first_bad"] is None:
+        commit = git(ctx, worktree, "rev-parse HEAD")
+        steps = state["steps"]
+        if len(steps) > 0 and steps[-1]["commit"] == commit:
+            # interrupted after the verdict was recorded but before git got it
+            verdict = steps[-1]["verdict"]
+        else:
+            info(
+                f"[+] Bisect step {len(steps) + 1}: {git(ctx, worktree, 'log -1 --oneline HEAD')}"
+            )
+            verdict = bisect_step(run, build_dir, arch, commit, state, test)
+
+        res = ctx.run(f"cd {worktree} && git bisect {verdict}", hide=True, warn=True)
+        out = str(res.stdout) if res is not None else ""
+        if "is the first bad commit" in out:
+            state["first_bad"] = out.split()[0]
+        elif "There are only 'skip'ped commits left" in out or (
+            res is not None and not res.ok
+        ):
+            warn(f"[!] Bisection cannot continue:\n{out}")
+            break
+
+        save_state(state)
+
+    state["log"] = git(ctx, worktree, "bisect log", allow_fail=True)
+    save_state(state)
+    if state["first_bad"] is not None:
+        git(ctx, worktree, "bisect reset", allow_fail=True)
+        info(
+            f"[+] First bad commit: {git(ctx, worktree, 'log -1 --oneline ' + state['first_bad'])}"
+        )
+
+    total = sum([s["build_seconds"] + s["test_seconds"] for s in state["steps"]])
+    info(f"[+] {len(state['steps'])} steps in {total:.0f}s, log in {BISECT_STATE}")
+    first_bad = state["first_bad"]
+    return first_bad
+
+
+def reset_bisect(ctx: InvokeContext) -> None:
+    worktree = KernelBuildPaths.linux_stable / BISECT_WORKTREE
+    if worktree.exists():
+        git(ctx, worktree, "bisect reset", allow_fail=True)
+    BISECT_STATE.unlink(missing_ok=True)
+    info("[+] Bisection state removed")
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+
+from tasks.elf import read_build_id, read_section
+from tasks.tool import info, warn
+
+PAHOLE_WRAPPER = ".kbuild-pahole"
+PAHOLE_TIMES = ".kbuild-pahole.times"
+VMLINUX_BTF = "vmlinux.btf"
+
+# Kbuild calls $(PAHOLE) for vmlinux and every module. The wrapper lives in
+# the kernel tree, so the same path works on the host and in the compiler
+# container. Parallel encoding (-j) is available since pahole 1.22, older
+# kernels never ask for it. Modules are already encoded in parallel by make,
+# they are left alone.
+PAHOLE_WRAPPER_TEMPLATE = """#!/bin/bash
+if [ "$1" = "--version" ]; then
+    exec pahole "$@"
+fi
+
+args=("$@")
+version=$(pahole --version | sed -E 's/^v([0-9]+)\\.([0-9]+).*/\\1\\2/')
+if [ "${{version:-0}}" -ge {parallel_version} ] && [[ " $* " != *" --btf_base"* ]] && [[ " $* " != *" -j"* ]]; then
+    args=(-j "${{args[@]}}")
+fi
+
+start=$EPOCHREALTIME
+pahole "${{args[@]}}"
+rc=$?
+echo "$start $EPOCHREALTIME" >> "$(dirname "$0")/{times}"
+exit $rc
+"""
+PAHOLE_PARALLEL_VERSION = 122
+
+
+def btf_enabled(source_dir: Path) -> bool:
+    try:
+        with open(source_dir / ".config", "r") as f:
+            return "CONFIG_DEBUG_INFO_BTF=y\n" in f.read()
+    except OSError:
+        return False
+
+
+def install_pahole_wrapper(source_dir: Path) -> None:
+    """Write the pahole wrapper into the kernel tree and reset its timings"""
+    wrapper = source_dir / PAHOLE_WRAPPER
+    with open(wrapper, "w") as f:
+        f.write(
+            PAHOLE_WRAPPER_TEMPLATE.format(
+                parallel_version=PAHOLE_PARALLEL_VERSION, times=PAHOLE_TIMES
+            )
+        )
+    os.chmod(wrapper, 0o755)
+    (source_dir / PAHOLE_TIMES).unlink(missing_ok=True)
+
+
+def pahole_make_args(build_dir: Path) -> str:
+    # build_dir is the tree as seen by make, i.e. inside the container
+    return f"PAHOLE={build_dir.absolute() / PAHOLE_WRAPPER}"
+
+
+def pahole_seconds(source_dir: Path) -> float:
+    """Wall clock time of all pahole runs recorded by the wrapper"""
+    total = 0.0
+    try:
+        with open(source_dir / PAHOLE_TIMES, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    total += float(fields[1]) - float(fields[0])
+    except (OSError, ValueError):
+        return 0.0
+
+    return total
+
+
+def export_vmlinux_btf(vmlinux: Path, cache_dir: Path, kdir: Path) -> Optional[Path]:
+    """Copy the .BTF section of vmlinux next to the kernel package, for
+    host side BPF tooling. The raw BTF is cached by vmlinux build id, so
+    rebuilding an unchanged vmlinux does not extract it again."""
+    build_id = read_build_id(vmlinux)
+    if build_id is None:
+        warn(f"[!] {vmlinux} has no build id, not exporting BTF")
+        return None
+
+    cached = cache_dir / f"{build_id}.btf"
+    if not cached.exists():
+        start = time.monotonic()
+        btf = read_section(vmlinux, ".BTF")
+        if btf is None:
+            warn(f"[!] {vmlinux} has no .BTF section")
+            return None
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = cached.with_suffix(".tmp")
+        tmp.write_bytes(btf)
+        tmp.replace(cached)
+        info(f"[+] Cached BTF of {build_id} in {time.monotonic() - start:.2f}s")
+
+    dest = kdir / VMLINUX_BTF
+    shutil.copyfile(cached, dest)
+    return dest
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any, Optional
+
+from tasks.kbuild import KbuildObjects
+from tasks.tool import info, warn
+
+CC_WRAPPER = ".kbuild-ccprof"
+CC_TIMES = ".kbuild-ccprof.times"
+PROFILE_JSON = "build-profile.json"
+PROFILE_TEXT = "build-profile.txt"
+# objects not enabled by any fragment are built by the defconfig
+BASE_CONFIG = "defconfig"
+REPORT_TOP = 25
+# scratch files of the try-run and cc-option probes of kbuild
+PROBE_OUTPUT = re.compile(r"^(\.tmp_\d+|\.\d+\.tmp|-)$")
+
+# Kbuild runs $(CC) and $(LD) once per object. Like the pahole wrapper of
+# tasks/btf.py this lives in the kernel tree, so the same path works in the
+# compiler container. Probes writing to /dev/null or to temporary files of
+# the try-run macros are recorded too and dropped when parsing.
+CC_WRAPPER_TEMPLATE = """#!/bin/bash
+start=$EPOCHREALTIME
+"$@"
+rc=$?
+out=
+prev=
+for arg in "$@"; do
+    [ "$prev" = "-o" ] && out=$arg
+    prev=$arg
+done
+if [ $rc -eq 0 ] && [ -n "$out" ]; then
+    echo "$start $EPOCHREALTIME $(basename "$1") $PWD $out" >> "$(dirname "$0")/{times}"
+fi
+exit $rc
+"""
+
+
+def install_cc_wrapper(source_dir: Path) -> None:
+    """Write the compiler wrapper into the kernel tree and reset its timings"""
+    wrapper = source_dir / CC_WRAPPER
+    with open(wrapper, "w") as f:
+        f.write(CC_WRAPPER_TEMPLATE.format(times=CC_TIMES))
+    os.chmod(wrapper, 0o755)
+    (source_dir / CC_TIMES).unlink(missing_ok=True)
+
+
+def cc_make_args(build_dir: Path) -> str:
+    # kbuild records $(CC) in the .cmd file of every object, changing it
+    # rebuilds the whole tree, with and without the wrapper
+    wrapper = build_dir.absolute() / CC_WRAPPER
+    return f"CC='{wrapper} gcc' LD='{wrapper} ld'"
+
+
+def object_timings(source_dir: Path, build_dir: Path) -> dict[Path, tuple[str, float]]:
+    """Tool and wall clock time of every object below the tree, relative to
+    it. build_dir is the tree as seen by make."""
+    timings: dict[Path, tuple[str, float]] = dict()
+    root = Path(os.path.realpath(build_dir))
+    try:
+        with open(source_dir / CC_TIMES, "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return timings
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 5:
+            continue
+
+        start, end, tool, cwd, out = fields
+        path = Path(os.path.normpath(Path(cwd) / out))
+        if not path.is_relative_to(root):
+            continue
+        obj = path.relative_to(root)
+        if any(PROBE_OUTPUT.match(p) for p in obj.parts):
+            continue
+
+        try:
+            seconds = float(end) - float(start)
+        except ValueError:
+            continue
+        # objects built more than once, e.g. by deb-pkg, keep the last run
+        timings[obj] = (tool, seconds)
+
+    return timings
+
+
+def fragment_symbols(fragments: list[Path]) -> dict[str, str]:
+    """Fragment enabling each symbol, later fragments override earlier ones"""
+    enabled_by: dict[str, str] = dict()
+    for fragment in fragments:
+        try:
+            text = fragment.read_text()
+        except OSError:
+            warn(f"[!] Unable to read {fragment}")
+            continue
+
+        for line in text.splitlines():
+            line = line.strip()
+            if not line.startswith("CONFIG_") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            symbol = key[len("CONFIG_") :]
+            if value in ("y", "m"):
+                enabled_by[symbol] = fragment.name
+            else:
+                enabled_by.pop(symbol, None)
+
+    return enabled_by
+
+
+def source_object(obj: Path) -> Path:
+    """Object named in the Makefiles for an output of the compiler or linker"""
+    name = obj.name
+    for suffix in (".mod.o", ".ko", ".o"):
+        if name.endswith(suffix):
+            return obj.with_name(name[: -len(suffix)] + ".o")
+    return obj
+
+
+def ranked(totals: dict[str, dict[str, float]]) -> list[dict[str, Any]]:
+    return [
+        {"name": k, "seconds": round(v["seconds"], 3), "objects": int(v["objects"])}
+        for k, v in sorted(totals.items(), key=lambda kv: -kv[1]["seconds"])
+    ]
+
+
+def add(totals: dict[str, dict[str, float]], key: str, seconds: float) -> None:
+    entry = totals.setdefault(key, {"seconds": 0.0, "objects": 0})
+    entry["seconds"] += seconds
+    entry["objects"] += 1
+
+
+def build_profile(
+    source_dir: Path, build_dir: Path, fragments: list[Path]
+) -> Optional[dict[str, Any]]:
+    """Compile and link times aggregated by directory, by the CONFIG_ symbol
+    building each object and by the fragment enabling that symbol. An object
+    is charged to the innermost symbol which a fragment enables, disabling
+    it there removes the object from the build."""
+    timings = object_timings(source_dir, build_dir)
+    if len(timings) == 0:
+        return None
+
+    objects = KbuildObjects(source_dir)
+    enabled_by = fragment_symbols(fragments)
+    by_directory: dict[str, dict[str, float]] = dict()
+    by_symbol: dict[str, dict[str, float]] = dict()
+    by_fragment: dict[str, dict[str, float]] = dict()
+    fragment_of_symbol: dict[str, str] = dict()
+    tools: dict[str, float] = dict()
+
+    for obj, (tool, seconds) in timings.items():
+        tools[tool] = tools.get(tool, 0.0) + seconds
+        add(by_directory, obj.parent.as_posix(), seconds)
+
+        owners = objects.owners(source_object(obj))
+        symbol = next((s for s in owners if s in enabled_by), None)
+        if symbol is None:
+            add(by_fragment, BASE_CONFIG, seconds)
+            continue
+
+        fragment = enabled_by[symbol]
+        fragment_of_symbol[symbol] = fragment
+        add(by_symbol, symbol, seconds)
+        add(by_fragment, fragment, seconds)
+
+    symbols = ranked(by_symbol)
+    for entry in symbols:
+        entry["fragment"] = fragment_of_symbol[entry["name"]]
+
+    return {
+        "objects": len(timings),
+        "seconds": round(sum(tools.values()), 3),
+        "tools": {
+            t: round(s, 3) for t, s in sorted(tools.items(), key=lambda kv: -kv[1])
+        },
+        "by_fragment": ranked(by_fragment),
+        "by_symbol": symbols,
+        "by_directory": ranked(by_directory),
+        "by_object": [
+            {"name": o.as_posix(), "tool": t, "seconds": round(s, 3)}
+            for o, (t, s) in sorted(timings.items(), key=lambda kv: -kv[1][1])
+        ],
+    }
+
+
+def format_profile(profile: dict[str, Any]) -> list[str]:
+    total = profile["seconds"] or 1.0
+    lines = [
+        f"{profile['objects']} objects, {profile['seconds']:.1f}s of compile and link time",
+        "",
+    ]
+
+    def section(title: str, entries: list[dict[str, Any]], extra: str = "") -> None:
+        lines.append(title)
+        for e in entries[:REPORT_TOP]:
+            count = f"{e['objects']:>6} objs" if "objects" in e else f"{e['tool']:>11}"
+            suffix = f"  [{e[extra]}]" if extra != "" else ""
+            lines.append(
+                f"  {e['seconds']:>9.1f}s {e['seconds'] / total:>6.1%} {count}  {e['name']}{suffix}"
+            )
+        lines.append("")
+
+    section("By config fragment:", profile["by_fragment"])
+    section(
+        "By CONFIG_ symbol enabled in a fragment:", profile["by_symbol"], "fragment"
+    )
+    section("By directory:", profile["by_directory"])
+    section("Slowest objects:", profile["by_object"])
+    return lines
+
+
+def write_profile(
+    source_dir: Path, build_dir: Path, fragments: list[Path], kdir: Path
+) -> Optional[Path]:
+    """Write the ranked report next to the kernel package"""
+    profile = build_profile(source_dir, build_dir, fragments)
+    if profile is None:
+        warn(f"[!] No compile times recorded in {source_dir / CC_TIMES}")
+        return None
+
+    with open(kdir / PROFILE_JSON, "w") as f:
+        json.dump(profile, f, indent=4)
+    lines = format_profile(profile)
+    with open(kdir / PROFILE_TEXT, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    info(f"[+] Build profile written to {kdir / PROFILE_TEXT}")
+    for line in lines[2 : 2 + min(6, len(profile["by_fragment"]) + 1)]:
+        info(f"    {line}")
+    return kdir / PROFILE_TEXT
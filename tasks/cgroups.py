@@ -0,0 +1,374 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+from tasks.qemu import parse_cpu_list
+from tasks.tool import Exit, info, warn
+
+# Builds and VMs get cgroups of their own below KBUILD_CGROUP, so the
+# weights and cpusets below decide how they share the host:
+#   kbuild/build       make, debootstrap and the compiler container
+#   kbuild/vms/<name>  qemu of every VM, run.sh and snapshot boots alike
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+KBUILD_CGROUP = CGROUP_ROOT / "kbuild"
+BUILD_CGROUP = KBUILD_CGROUP / "build"
+VMS_CGROUP = KBUILD_CGROUP / "vms"
+CGROUPS_FILE = Path("./kernels/sources/cgroups.json")
+CONTROLLERS = ["cpu", "cpuset", "memory", "io"]
+OBSERVATION_HISTORY = 50
+
+DEFAULT_BUILD_WEIGHT = 100
+DEFAULT_VM_WEIGHT = 400
+DEFAULT_BUILD_IO_WEIGHT = 100
+DEFAULT_VM_IO_WEIGHT = 400
+
+
+class CgroupLayout:
+    """CPU and IO weights are relative to each other, 100 is the weight of
+    every other cgroup on the host. Empty cpu lists leave builds or VMs on
+    all cpus, disjoint ones keep builds off the cores of the VMs."""
+
+    def __init__(
+        self,
+        build_cpus: str = "",
+        vm_cpus: str = "",
+        build_weight: int = DEFAULT_BUILD_WEIGHT,
+        vm_weight: int = DEFAULT_VM_WEIGHT,
+        build_memory: str = "max",
+        build_io_weight: int = DEFAULT_BUILD_IO_WEIGHT,
+        vm_io_weight: int = DEFAULT_VM_IO_WEIGHT,
+    ):
+        self.build_cpus = build_cpus
+        self.vm_cpus = vm_cpus
+        self.build_weight = build_weight
+        self.vm_weight = vm_weight
+        self.build_memory = build_memory
+        self.build_io_weight = build_io_weight
+        self.vm_io_weight = vm_io_weight
+
+        for cpus in (build_cpus, vm_cpus):
+            if cpus != "":
+                parse_cpu_list(cpus)
+        shared = set(self.cpus(build_cpus)) & set(self.cpus(vm_cpus))
+        if len(shared) > 0:
+            warn(f"[!] Builds and VMs share cpus {sorted(shared)}")
+
+    @staticmethod
+    def cpus(cpus: str) -> list[int]:
+        return parse_cpu_list(cpus) if cpus != "" else list()
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, d: dict[str, Any]) -> CgroupLayout:
+        return cls(**d)
+
+    def files(self) -> dict[Path, dict[str, str]]:
+        return {
+            BUILD_CGROUP: {
+                "cpuset.cpus": self.build_cpus,
+                "cpu.weight": str(self.build_weight),
+                "memory.max": self.build_memory,
+                "io.weight": f"default {self.build_io_weight}",
+            },
+            VMS_CGROUP: {
+                "cpuset.cpus": self.vm_cpus,
+                "cpu.weight": str(self.vm_weight),
+                "io.weight": f"default {self.vm_io_weight}",
+            },
+        }
+
+    def docker_args(self) -> str:
+        """The same limits for the compiler container. docker places it in
+        a cgroup of its own, its shares and blkio weight are on the scale
+        of cpu.weight * 10.24 and io.weight clamped to 10-1000."""
+        args = [
+            f"--cpu-shares={self.build_weight * 1024 // 100}",
+            f"--blkio-weight={min(max(self.build_io_weight, 10), 1000)}",
+        ]
+        if self.build_cpus != "":
+            args.append(f"--cpuset-cpus={self.build_cpus}")
+        if self.build_memory != "max":
+            args.append(f"--memory={self.build_memory}")
+        return " ".join(args)
+
+
+def cgroup2_available() -> bool:
+    return (CGROUP_ROOT / "cgroup.controllers").exists()
+
+
+def write(path: Path, value: str) -> bool:
+    if os.geteuid() == 0:
+        try:
+            path.write_text(value)
+            return True
+        except OSError:
+            return False
+
+    proc = subprocess.run(
+        ["sudo", "tee", path.as_posix()],
+        input=value.encode(),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return proc.returncode == 0
+
+
+def sudo(*argv: str) -> bool:
+    prefix = [] if os.geteuid() == 0 else ["sudo"]
+    return (
+        subprocess.run(prefix + list(argv), stderr=subprocess.DEVNULL).returncode == 0
+    )
+
+
+def load_state() -> dict[str, Any]:
+    try:
+        with open(CGROUPS_FILE, "r") as f:
+            state: dict[str, Any] = json.load(f)
+            return state
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_state(state: dict[str, Any]) -> None:
+    CGROUPS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = CGROUPS_FILE.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=4)
+    tmp.replace(CGROUPS_FILE)
+
+
+def load_layout() -> Optional[CgroupLayout]:
+    layout = load_state().get("layout")
+    return CgroupLayout.from_dict(layout) if layout is not None else None
+
+
+def enable_controllers(cgroup: Path) -> None:
+    available = (cgroup / "cgroup.controllers").read_text().split()
+    wanted = [c for c in CONTROLLERS if c in available]
+    missing = [c for c in CONTROLLERS if c not in available]
+    if len(missing) > 0:
+        warn(f"[!] Controllers {', '.join(missing)} are not available in {cgroup}")
+    if not write(
+        cgroup / "cgroup.subtree_control", " ".join([f"+{c}" for c in wanted])
+    ):
+        warn(f"[!] Unable to enable controllers in {cgroup}")
+
+
+def apply_layout(layout: CgroupLayout) -> None:
+    """Create the cgroups and write the layout into them. io.weight only
+    exists with an IO scheduler or io.cost model which supports it."""
+    if not cgroup2_available():
+        raise Exit(f"cgroup v2 is not mounted on {CGROUP_ROOT}")
+
+    sudo("mkdir", "-p", BUILD_CGROUP.as_posix(), VMS_CGROUP.as_posix())
+    for cgroup in (CGROUP_ROOT, KBUILD_CGROUP, VMS_CGROUP):
+        enable_controllers(cgroup)
+
+    for cgroup, files in layout.files().items():
+        for name, value in files.items():
+            if not (cgroup / name).exists():
+                warn(f"[!] {cgroup / name} does not exist, {name} is not applied")
+                continue
+            if not write(cgroup / name, value):
+                warn(f"[!] Unable to set {name} of {cgroup} to '{value}'")
+
+
+def ensure_layout() -> Optional[CgroupLayout]:
+    """Layout configured with vm.cgroups, the cgroups are created again
+    when they are gone, e.g. after a reboot"""
+    layout = load_layout()
+    if layout is None:
+        return None
+    if not cgroup2_available():
+        warn(
+            f"[!] cgroup v2 is not mounted on {CGROUP_ROOT}, the cgroup layout is ignored"
+        )
+        return None
+    if not BUILD_CGROUP.exists() or not VMS_CGROUP.exists():
+        apply_layout(layout)
+    return layout
+
+
+def current_cgroup(pid: int) -> Path:
+    with open(f"/proc/{pid}/cgroup", "r") as f:
+        for line in f:
+            if line.startswith("0::"):
+                return CGROUP_ROOT / line.strip()[len("0::/") :]
+    return CGROUP_ROOT
+
+
+def join(cgroup: Path, pid: int) -> bool:
+    # all threads of the process move along
+    return write(cgroup / "cgroup.procs", str(pid))
+
+
+def vm_cgroup(name: str) -> Optional[Path]:
+    if ensure_layout() is None:
+        return None
+    return VMS_CGROUP / name
+
+
+def join_vm_cgroup(cgroup: Path, pid: int) -> None:
+    sudo("mkdir", "-p", cgroup.as_posix())
+    if not join(cgroup, pid):
+        warn(f"[!] Unable to move qemu ({pid}) into {cgroup}")
+
+
+def read_stats(cgroup: Path) -> dict[str, float]:
+    """CPU time, quota throttling, memory limit events and the time tasks
+    stalled on cpu, io and memory (PSI), in seconds"""
+    stats: dict[str, float] = dict()
+
+    def read(name: str) -> list[str]:
+        try:
+            return (cgroup / name).read_text().splitlines()
+        except OSError:
+            return list()
+
+    for line in read("cpu.stat"):
+        key, value = line.split()
+        if key in ("usage_usec", "throttled_usec"):
+            stats[key.replace("_usec", "_seconds")] = int(value) / 1e6
+        elif key == "nr_throttled":
+            stats[key] = int(value)
+    for line in read("memory.events"):
+        key, value = line.split()
+        if key in ("high", "max", "oom_kill"):
+            stats[f"memory_{key}"] = int(value)
+    for resource in ("cpu", "io", "memory"):
+        for line in read(f"{resource}.pressure"):
+            if line.startswith("some "):
+                total = line.split()[-1]
+                stats[f"{resource}_pressure_seconds"] = int(total.split("=")[1]) / 1e6
+    return stats
+
+
+def record(label: str, cgroup: Path, stats: dict[str, float]) -> None:
+    state = load_state()
+    observation = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "label": label,
+        "cgroup": cgroup.relative_to(CGROUP_ROOT).as_posix(),
+        **{k: round(v, 3) for k, v in stats.items()},
+    }
+    state["observations"] = (state.get("observations", list()) + [observation])[
+        -OBSERVATION_HISTORY:
+    ]
+    save_state(state)
+
+
+_build_lock = threading.Lock()
+_build_users = 0
+_build_origin: Optional[Path] = None
+_build_before: dict[str, float] = dict()
+
+
+@contextmanager
+def build_cgroup(label: str) -> Iterator[None]:
+    """Run the block with this process in the build cgroup, so every command
+    it starts lands there. Steps of vm.init share the process, it leaves
+    the cgroup when the last of them is done. The counters of the cgroup
+    over that time are recorded."""
+    global _build_users, _build_origin, _build_before
+    if ensure_layout() is None:
+        yield
+        return
+
+    with _build_lock:
+        if _build_users == 0:
+            _build_origin = current_cgroup(os.getpid())
+            _build_before = read_stats(BUILD_CGROUP)
+            if not join(BUILD_CGROUP, os.getpid()):
+                warn(f"[!] Unable to move the build into {BUILD_CGROUP}")
+        _build_users += 1
+
+    try:
+        yield
+    finally:
+        with _build_lock:
+            _build_users -= 1
+            if _build_users == 0 and _build_origin is not None:
+                join(_build_origin, os.getpid())
+                after = read_stats(BUILD_CGROUP)
+                record(
+                    label,
+                    BUILD_CGROUP,
+                    {k: v - _build_before.get(k, 0) for k, v in after.items()},
+                )
+
+
+def vm_cgroups() -> list[Path]:
+    if not VMS_CGROUP.exists():
+        return list()
+    return sorted([p for p in VMS_CGROUP.iterdir() if (p / "cgroup.procs").exists()])
+
+
+def remove_idle_vm_cgroups() -> None:
+    for cgroup in vm_cgroups():
+        if (cgroup / "cgroup.procs").read_text().strip() == "":
+            sudo("rmdir", cgroup.as_posix())
+
+
+def configure(layout: CgroupLayout) -> None:
+    apply_layout(layout)
+    state = load_state()
+    state["layout"] = layout.to_dict()
+    save_state(state)
+    info(f"[+] Cgroup layout written to {CGROUPS_FILE}")
+    info("[+] Restart the compiler container for it to pick up the build limits")
+
+
+def remove() -> None:
+    remove_idle_vm_cgroups()
+    for cgroup in (BUILD_CGROUP, VMS_CGROUP, KBUILD_CGROUP):
+        if cgroup.exists() and not sudo("rmdir", cgroup.as_posix()):
+            warn(f"[!] Unable to remove {cgroup}, processes are still running in it")
+
+    state = load_state()
+    state.pop("layout", None)
+    save_state(state)
+    info("[+] Builds and VMs are no longer placed in cgroups")
+
+
+def status() -> None:
+    """Print the layout and the counters of the build cgroup and of every
+    running VM, and record them"""
+    layout = load_layout()
+    if layout is None:
+        info("[+] No cgroup layout configured, see 'inv vm.cgroups --help'")
+        return
+
+    info(
+        "[+] Layout: "
+        + ", ".join([f"{k}={v or 'all'}" for k, v in layout.to_dict().items()])
+    )
+    remove_idle_vm_cgroups()
+    for cgroup in [BUILD_CGROUP] + vm_cgroups():
+        if not cgroup.exists():
+            continue
+        stats = read_stats(cgroup)
+        record("status", cgroup, stats)
+        info(f"    {cgroup.relative_to(KBUILD_CGROUP)}")
+        for key, value in stats.items():
+            print(f"        {key:<26} {value:,.1f}")
+
+    recent = load_state().get("observations", list())
+    builds = [o for o in recent if o["label"] != "status"][-5:]
+    if len(builds) > 0:
+        info("[+] Recent builds:")
+        for o in builds:
+            print(
+                f"    {o['time']} {o['label']:<24} cpu {o.get('usage_seconds', 0):>8.1f}s "
+                f"cpu stall {o.get('cpu_pressure_seconds', 0):>7.1f}s "
+                f"io stall {o.get('io_pressure_seconds', 0):>7.1f}s "
+                f"memory.max hits {o.get('memory_max', 0):.0f}"
+            )
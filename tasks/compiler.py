@@ -4,12 +4,17 @@ from pathlib import Path
 
 import sys
 import os
+import threading
 from typing import Protocol, Optional
 from invoke.context import Context
 from tasks.arch import Arch
+from tasks.cgroups import load_layout
 from tasks.tool import info, warn
 
 CONTAINER_LINUX_BUILD_PATH = Path("/tmp/sources")
+# start() removes the container before running it again, steps of vm.init
+# needing the compiler at the same time must not start it twice
+_start_lock = threading.Lock()
 
 
 class CompilerExec(Protocol):
@@ -72,12 +77,13 @@ class CompilerImage:
         return self._check_container_exists(allow_stopped=True)
 
     def ensure_running(self) -> None:
-        if not self.is_running:
-            info(f"[*] Compiler for {self.arch} not running, starting it...")
-            try:
-                self.start()
-            except Exception as e:
-                raise e
+        with _start_lock:
+            if not self.is_running:
+                info(f"[*] Compiler for {self.arch} not running, starting it...")
+                try:
+                    self.start()
+                except Exception as e:
+                    raise e
 
     def exec(
         self,
@@ -119,8 +125,11 @@ class CompilerImage:
         if not self.mountpoint.exists():
             self.mountpoint.mkdir(parents=True)
 
+        # builds in the container share the limits of the build cgroup
+        layout = load_layout()
+        resources = layout.docker_args() if layout is not None else ""
         res = self.ctx.run(
-            f"{self.docker_cmd} run -d --restart always --name {self.name} "
+            f"{self.docker_cmd} run -d --restart always --name {self.name} {resources} "
             f"--mount type=bind,source={self.mountpoint.absolute()},target={CONTAINER_LINUX_BUILD_PATH} "
             f"{self.image} sleep \"infinity\"",
         )
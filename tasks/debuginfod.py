@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import json
+import shutil
+import threading
+import time
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import unquote
+
+from invoke.context import Context as InvokeContext
+
+from tasks.elf import read_build_id
+from tasks.kernel import KernelBuildPaths
+from tasks.tool import Exit, info, warn
+
+DEBUGINFOD_PORT = 8002
+INDEX_FILE = KernelBuildPaths.kernel_sources_dir / "debuginfod-index.json"
+# debug payload of the linux-image-*-dbg package, extracted once per package
+DEBUG_DIR = "debug"
+DEBUG_STAMP = ".extracted-from"
+RESCAN_INTERVAL = 10.0
+
+
+def extract_debug_package(ctx: InvokeContext, kdir: Path) -> Optional[Path]:
+    debs = glob(f"{kdir}/linux-image-*-dbg*.deb")
+    if len(debs) == 0:
+        return None
+
+    deb = Path(max(debs))
+    debug_dir = kdir / DEBUG_DIR
+    stamp = debug_dir / DEBUG_STAMP
+    if stamp.exists() and stamp.read_text().strip() == deb.name:
+        return debug_dir
+
+    info(f"[+] Extracting {deb.name} for the symbol server")
+    ctx.run(f"rm -rf {debug_dir} && mkdir -p {debug_dir}")
+    ctx.run(f"dpkg-deb -x {deb} {debug_dir}")
+    stamp.write_text(deb.name)
+    return debug_dir
+
+
+class DebuginfodIndex:
+    """Maps GNU build ids to the vmlinux and modules of every built kernel.
+    The build id of each file is cached with its mtime, so a rescan only
+    reads the ELF notes of files that changed."""
+
+    def __init__(self, ctx: InvokeContext, index_file: Path = INDEX_FILE):
+        self.ctx = ctx
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        self.last_scan = 0.0
+        self.files: dict[str, list[float | str | None]] = dict()
+        self.build_ids: dict[str, dict[str, str]] = dict()
+        if index_file.exists():
+            with open(index_file, "r") as f:
+                self.files = json.load(f).get("files", dict())
+
+    def _kernel_files(self, kdir: Path) -> list[Path]:
+        files = [kdir / "vmlinux"]
+        debug_dir = extract_debug_package(self.ctx, kdir)
+        if debug_dir is not None:
+            files += [Path(p) for p in glob(f"{debug_dir}/**/*.ko", recursive=True)]
+            files += [Path(p) for p in glob(f"{debug_dir}/**/vmlinux*", recursive=True)]
+
+        return [f for f in files if f.is_file()]
+
+    def scan(self) -> None:
+        with self.lock:
+            files: dict[str, list[float | str | None]] = dict()
+            build_ids: dict[str, dict[str, str]] = dict()
+            for k in sorted(glob(f"{KernelBuildPaths.kernel_sources_dir}/kernel-*")):
+                kdir = Path(k)
+                build_root = ""
+                manifest_file = kdir / "kernel.manifest"
+                if manifest_file.exists():
+                    with open(manifest_file, "r") as f:
+                        build_root = json.load(f).get("kernel_source_dir", "")
+
+                for path in self._kernel_files(kdir):
+                    key = path.absolute().as_posix()
+                    mtime = path.stat().st_mtime
+                    cached = self.files.get(key)
+                    if cached is not None and cached[0] == mtime:
+                        build_id = cached[1]
+                    else:
+                        build_id = read_build_id(path)
+                    files[key] = [mtime, build_id]
+                    if not isinstance(build_id, str) or build_id in build_ids:
+                        continue
+
+                    build_ids[build_id] = {
+                        "debuginfo": key,
+                        "executable": key,
+                        "build_root": build_root,
+                        "source_root": (kdir / "linux-source").absolute().as_posix(),
+                    }
+
+            self.files = files
+            self.build_ids = build_ids
+            self.last_scan = time.monotonic()
+            with open(self.index_file, "w") as f:
+                json.dump({"files": files}, f)
+
+        info(f"[+] Symbol server indexed {len(self.build_ids)} build ids")
+
+    def lookup(self, build_id: str) -> Optional[dict[str, str]]:
+        entry = self.build_ids.get(build_id)
+        if entry is None and time.monotonic() - self.last_scan > RESCAN_INTERVAL:
+            # a kernel may have been built since the last scan
+            self.scan()
+            entry = self.build_ids.get(build_id)
+
+        return entry
+
+
+def source_path(entry: dict[str, str], requested: str) -> Optional[Path]:
+    """Map a source path recorded in the DWARF to the extracted linux-source
+    tree of the kernel. Paths outside of the tree are refused."""
+    build_root = entry["build_root"].rstrip("/")
+    if build_root != "" and requested.startswith(build_root + "/"):
+        requested = requested[len(build_root) + 1 :]
+
+    root = Path(entry["source_root"]).resolve()
+    path = (root / requested.lstrip("/")).resolve()
+    if root not in path.parents or not path.is_file():
+        return None
+
+    return path
+
+
+def make_handler(index: DebuginfodIndex) -> type[BaseHTTPRequestHandler]:
+    class DebuginfodHandler(BaseHTTPRequestHandler):
+        def _resolve(self) -> Optional[Path]:
+            # /buildid/<id>/debuginfo, /buildid/<id>/executable, /buildid/<id>/source/<path>
+            parts = self.path.split("/", 4)
+            if len(parts) < 4 or parts[1] != "buildid":
+                return None
+
+            entry = index.lookup(parts[2].lower())
+            if entry is None:
+                return None
+
+            if parts[3] in ["debuginfo", "executable"] and len(parts) == 4:
+                return Path(entry[parts[3]])
+            if parts[3] == "source" and len(parts) == 5:
+                return source_path(entry, "/" + unquote(parts[4]))
+
+            return None
+
+        def do_GET(self) -> None:
+            path = self._resolve()
+            if path is None or not path.exists():
+                self.send_error(404)
+                return
+
+            size = path.stat().st_size
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            self.send_header("X-Debuginfod-Size", str(size))
+            self.send_header("X-Debuginfod-File", path.name)
+            self.end_headers()
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+        def log_message(self, format: str, *args: object) -> None:
+            info(f"[debuginfod] {self.address_string()} {format % args}")
+
+    return DebuginfodHandler
+
+
+def listen_addresses() -> list[str]:
+    """Loopback, which pool instances reach through slirp, and the tap
+    gateway of every kernel package, where its guest looks for the server"""
+    addresses = {"127.0.0.1"}
+    for manifest_file in glob(
+        f"{KernelBuildPaths.kernel_sources_dir}/kernel-*/kernel.manifest"
+    ):
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        if "gateway_ip" in manifest:
+            addresses.add(manifest["gateway_ip"])
+    return sorted(addresses)
+
+
+def serve(ctx: InvokeContext, hosts: list[str], port: int) -> None:
+    index = DebuginfodIndex(ctx)
+    index.scan()
+    handler = make_handler(index)
+    servers = list()
+    urls = list()
+    for host in hosts:
+        try:
+            servers.append(ThreadingHTTPServer((host, port), handler))
+            urls.append(f"http://{host}:{port}")
+        except OSError as e:
+            # the tap of a kernel whose VM was never started has no address
+            warn(f"[!] Unable to listen on {host}:{port}: {e}")
+    if len(servers) == 0:
+        raise Exit(f"unable to listen on any of {', '.join(hosts)}")
+
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    info(f"[+] Symbol server listening on {', '.join(urls)}")
+    try:
+        servers[0].serve_forever()
+    except KeyboardInterrupt:
+        warn("[!] Symbol server stopped")
+    finally:
+        for server in servers[1:]:
+            server.shutdown()
+        for server in servers:
+            server.server_close()
+
+
+def guest_debuginfod_url(gateway_ip: str, port: int = DEBUGINFOD_PORT) -> str:
+    return f"http://{gateway_ip}:{port}"
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import os
+from glob import glob
+from pathlib import Path
+from typing import Optional
+
+from tasks.cgroups import write
+from tasks.kernel import KernelBuildPaths
+from tasks.qemu import KSM_DIR, KSM_PAGES_TO_SCAN
+from tasks.tool import info, warn
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+GIB = 1 << 30
+SIZE_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def read_int(path: Path) -> Optional[int]:
+    try:
+        return int(path.read_text().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def enable_ksm() -> None:
+    """Start ksmd with a scan rate which merges idle guests within seconds,
+    what run.sh does for VMs started by hand"""
+    if not KSM_DIR.exists():
+        warn(f"[!] {KSM_DIR} does not exist, the host kernel is built without KSM")
+        return
+
+    if read_int(KSM_DIR / "run") != 1 and not write(KSM_DIR / "run", "1"):
+        warn("[!] Unable to start KSM")
+    pages = read_int(KSM_DIR / "pages_to_scan")
+    if pages is not None and pages < KSM_PAGES_TO_SCAN:
+        write(KSM_DIR / "pages_to_scan", str(KSM_PAGES_TO_SCAN))
+
+
+def guest_pidfiles() -> list[Path]:
+    """pidfiles of every VM of every kernel package: vm.init, snapshot
+    boots and the instances of a pool"""
+    root = KernelBuildPaths.kernel_sources_dir
+    paths = glob(f"{root}/kernel-*/*.pid") + glob(f"{root}/kernel-*/pool-*/vm.pid")
+    return sorted([Path(p) for p in paths])
+
+
+def qemu_pid(pidfile: Path) -> Optional[int]:
+    pid = read_int(pidfile)
+    if pid is None:
+        return None
+    try:
+        comm = Path(f"/proc/{pid}/comm").read_text().strip()
+    except OSError:
+        return None
+    return pid if comm.startswith("qemu") else None
+
+
+def parse_size(size: str, unit: int) -> int:
+    """Bytes of a size like 4G or 512M, a plain number counts in unit"""
+    if size[-1:].upper() in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1].upper()])
+    return int(float(size) * unit)
+
+
+def configured_memory(pid: int) -> Optional[int]:
+    argv = Path(f"/proc/{pid}/cmdline").read_bytes().decode().split("\0")
+    if "-m" not in argv:
+        return None
+    # qemu reads a plain number as MiB
+    return parse_size(argv[argv.index("-m") + 1].split(",")[0], 1 << 20)
+
+
+def process_memory(pid: int) -> dict[str, int]:
+    """Rss, Pss and Swap of the process in bytes, and the pages KSM merged
+    out of it. Pss charges every shared page to its users in equal parts,
+    merged pages included, the sum over all guests is what they cost."""
+    stats: dict[str, int] = dict()
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] in ("Rss:", "Pss:", "Swap:"):
+            stats[fields[0].rstrip(":").lower()] = int(fields[1]) << 10
+
+    merging = read_int(Path(f"/proc/{pid}/ksm_merging_pages"))
+    if merging is not None:
+        stats["ksm_merged"] = merging * PAGE_SIZE
+    return stats
+
+
+def ksm_saved() -> Optional[int]:
+    # pages_sharing counts the page table entries pointing at a merged page
+    # beyond the first, i.e. the pages saved
+    sharing = read_int(KSM_DIR / "pages_sharing")
+    return sharing * PAGE_SIZE if sharing is not None else None
+
+
+def host_available() -> Optional[int]:
+    for line in Path("/proc/meminfo").read_text().splitlines():
+        if line.startswith("MemAvailable:"):
+            return int(line.split()[1]) << 10
+    return None
+
+
+def gib(size: Optional[int]) -> str:
+    return f"{size / GIB:.2f}G" if size is not None else "-"
+
+
+def mem_stats_report() -> None:
+    guests = list()
+    for pidfile in guest_pidfiles():
+        pid = qemu_pid(pidfile)
+        if pid is None:
+            continue
+        try:
+            stats = process_memory(pid)
+            stats["configured"] = configured_memory(pid) or 0
+        except OSError:
+            # the VM exited meanwhile
+            continue
+        label = pidfile.relative_to(KernelBuildPaths.kernel_sources_dir).with_suffix("")
+        guests.append((label.as_posix(), pid, stats))
+
+    if len(guests) == 0:
+        info("[+] No VMs running")
+        return
+
+    print(
+        f"{'guest':<44} {'pid':>8} {'memory':>8} {'rss':>8} {'pss':>8} {'swap':>8} {'merged':>8}"
+    )
+    for name, pid, stats in guests:
+        print(
+            f"{name:<44} {pid:>8} {gib(stats['configured']):>8} {gib(stats.get('rss')):>8} "
+            f"{gib(stats.get('pss')):>8} {gib(stats.get('swap')):>8} {gib(stats.get('ksm_merged')):>8}"
+        )
+
+    configured = sum([s["configured"] for _, _, s in guests])
+    pss = sum([s.get("pss", 0) for _, _, s in guests])
+    info(
+        f"[+] {len(guests)} guests: {gib(configured)} configured, {gib(pss)} used on the host "
+        f"({configured / max(pss, 1):.1f}x overcommit)"
+    )
+
+    if read_int(KSM_DIR / "run") != 1:
+        warn("[!] KSM is not running, start VMs with --balloon to enable it")
+    else:
+        info(f"[+] KSM saves {gib(ksm_saved())}")
+
+    available = host_available()
+    if available is not None:
+        info(
+            f"[+] {gib(available)} available on the host, room for about "
+            f"{available // max(pss // len(guests), 1)} more guests like these"
+        )
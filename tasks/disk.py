@@ -0,0 +1,364 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import time
+from glob import glob
+from pathlib import Path
+from typing import Optional
+
+from invoke.context import Context as InvokeContext
+
+from tasks.bisection import BISECT_WORKTREE
+from tasks.density import GIB, gib, guest_pidfiles, parse_size, qemu_pid
+from tasks.kconfig import TRIM_WORKTREE
+from tasks.kernel import KernelBuildPaths, open_registry
+from tasks.network import teardown_tap
+from tasks.rootfs import RootfsBuildPaths
+from tasks.tool import Exit, info, warn
+from tasks.usertools import TOOLS_CACHE, TOOLS_KEY
+
+# What a kernel leaves on disk, in the order vm.gc reclaims it: whatever is
+# cheapest to get back goes first.
+# extracted again from linux.tar.gz by the next kernel.build
+LINUX_SOURCE = "linux-source"
+# untracked files of the worktree, the next build compiles every object
+OBJECTS = "objects"
+# the checked out sources, kernel.build checks them out again
+WORKTREE = "worktree"
+# only read when the overlay is set up again
+DEBS = "debs"
+# the rest of the kernel package: images, source tarball and the overlay,
+# changes made in the guest are lost
+PACKAGE = "package"
+RECLAIM_ORDER = [LINUX_SOURCE, OBJECTS, WORKTREE, DEBS, PACKAGE]
+PKG_PREFIX = "kernel-"
+WORKTREE_SUFFIX = "-build"
+# worktrees of kernel.bisect and kernel.trim-config next to those of the
+# kernels, never reclaimed, a bisection may be going on in one
+TOOL_WORKTREES = {
+    Path(BISECT_WORKTREE).parts[0]: "bisect worktree",
+    Path(TRIM_WORKTREE).parts[0]: "trim-config worktree",
+}
+# worktrees of tags, those of branches only count along with a package
+VERSION_NAME = re.compile(r"^v\d+\.\d+(\.\d+)?(-rc\d+)?$")
+
+
+def disk_usage(path: Path, skip: Optional[set[Path]] = None) -> int:
+    """Bytes allocated below path, hard links counted once. qcow2 images
+    and sparse files count with what they use, not their size."""
+    if not path.exists():
+        return 0
+    if not path.is_dir() or path.is_symlink():
+        return path.lstat().st_blocks * 512
+
+    seen: set[tuple[int, int]] = set()
+    total = 0
+    for root, dirs, files in os.walk(path):
+        if skip is not None:
+            dirs[:] = [d for d in dirs if Path(root) / d not in skip]
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def blocks(paths: list[Path]) -> int:
+    total = 0
+    for path in paths:
+        try:
+            total += path.lstat().st_blocks * 512
+        except OSError:
+            # left out by a sparse checkout
+            continue
+    return total
+
+
+def worktree_usage(ctx: InvokeContext, base: Path, worktree: Path) -> tuple[int, int]:
+    """Bytes of the checked out sources and of what git clean removes from
+    the worktree plus the files next to it: objects, build results and the
+    packages kbuild leaves in the parent directory"""
+    tracked = ctx.run(f"git -C {worktree} ls-files -z", hide=True, warn=True)
+    # without --exclude-standard ignored files are listed too
+    others = ctx.run(f"git -C {worktree} ls-files -z --others", hide=True, warn=True)
+    if tracked is None or others is None or not tracked.ok or not others.ok:
+        return 0, disk_usage(base)
+
+    sources = blocks([worktree / p for p in tracked.stdout.split("\0") if p != ""])
+    objects = blocks([worktree / p for p in others.stdout.split("\0") if p != ""])
+    return sources, objects + blocks([p for p in base.iterdir() if p.is_file()])
+
+
+class KernelUsage:
+    """Disk space of one kernel version, by kind of artifact"""
+
+    def __init__(self, version: str):
+        self.version = version
+        self.pkg_dir = KernelBuildPaths.kernel_sources_dir / f"{PKG_PREFIX}{version}"
+        self.worktree_base = (
+            KernelBuildPaths.linux_stable / f"{version}{WORKTREE_SUFFIX}"
+        )
+        self.worktree = self.worktree_base / version
+        self.sizes: dict[str, int] = dict()
+        self.last_used = 0.0
+        self.running = False
+
+    @property
+    def total(self) -> int:
+        return sum(self.sizes.values())
+
+    def measure(self, ctx: InvokeContext) -> None:
+        linux_source = disk_usage(self.pkg_dir / LINUX_SOURCE)
+        debs = sum([disk_usage(Path(d)) for d in glob(f"{self.pkg_dir}/*.deb")])
+        self.sizes[LINUX_SOURCE] = linux_source
+        self.sizes[DEBS] = debs
+        self.sizes[PACKAGE] = max(disk_usage(self.pkg_dir) - linux_source - debs, 0)
+        if self.worktree.exists():
+            self.sizes[WORKTREE], self.sizes[OBJECTS] = worktree_usage(
+                ctx, self.worktree_base, self.worktree
+            )
+        else:
+            self.sizes[WORKTREE] = 0
+            self.sizes[OBJECTS] = disk_usage(self.worktree_base)
+        self.last_used = self._last_used()
+
+    def _last_used(self) -> float:
+        """When the manifest says the kernel was last built or booted. VMs
+        started with run.sh only show in the mtime of their logs and disks,
+        the directories change whenever gc removes something."""
+        used = 0.0
+        manifest_file = self.pkg_dir / "kernel.manifest"
+        if manifest_file.exists():
+            try:
+                with open(manifest_file, "r") as f:
+                    used = float(json.load(f).get("last_used", 0.0))
+            except ValueError:
+                pass
+        for path in [self.pkg_dir, self.worktree_base]:
+            if not path.exists():
+                continue
+            mtimes = [p.stat().st_mtime for p in path.iterdir() if p.is_file()]
+            used = max([used] + mtimes)
+        return used
+
+
+def running_packages() -> set[str]:
+    running = set()
+    for pidfile in guest_pidfiles():
+        if qemu_pid(pidfile) is not None:
+            running.add(
+                pidfile.relative_to(KernelBuildPaths.kernel_sources_dir).parts[0]
+            )
+    return running
+
+
+def worktree_dirs() -> set[Path]:
+    return {
+        Path(p.rstrip("/"))
+        for p in glob(f"{KernelBuildPaths.linux_stable}/*{WORKTREE_SUFFIX}/")
+    }
+
+
+def kernel_inventory(ctx: InvokeContext) -> list[KernelUsage]:
+    """Every kernel with a package or a worktree, most recently used first"""
+    versions = set()
+    for p in glob(f"{KernelBuildPaths.kernel_sources_dir}/{PKG_PREFIX}*/"):
+        versions.add(Path(p).name[len(PKG_PREFIX) :])
+    for path in worktree_dirs():
+        version = path.name[: -len(WORKTREE_SUFFIX)]
+        if path.name not in TOOL_WORKTREES and VERSION_NAME.match(version):
+            versions.add(version)
+
+    running = running_packages()
+    kernels = list()
+    for version in versions:
+        kernel = KernelUsage(version)
+        kernel.measure(ctx)
+        kernel.running = kernel.pkg_dir.name in running
+        kernels.append(kernel)
+    return sorted(kernels, key=lambda k: -k.last_used)
+
+
+def shared_inventory(kernels: list[KernelUsage]) -> dict[str, int]:
+    """Space used by all kernels together and by worktrees of no kernel"""
+    worktrees = worktree_dirs()
+    others = worktrees - {k.worktree_base for k in kernels}
+    sources = KernelBuildPaths.kernel_sources_dir
+    usage = {
+        "git repository": disk_usage(KernelBuildPaths.linux_stable, skip=worktrees),
+        "base image": disk_usage(RootfsBuildPaths.images_dir),
+        "tools cache": disk_usage(TOOLS_CACHE),
+        "btf cache": disk_usage(sources / "btf-cache"),
+        "selftest results": disk_usage(sources / "selftests"),
+        "traces": disk_usage(sources / "traces"),
+        "overhead reports": disk_usage(sources / "overhead"),
+    }
+    for name, label in TOOL_WORKTREES.items():
+        usage[label] = disk_usage(KernelBuildPaths.linux_stable / name)
+    usage["other worktrees"] = sum(
+        [disk_usage(p) for p in others if p.name not in TOOL_WORKTREES]
+    )
+    return usage
+
+
+def unreferenced_tools(kernels: list[KernelUsage]) -> list[Path]:
+    """Tools cache entries whose key no kernel package records"""
+    keys = set()
+    for kernel in kernels:
+        key_file = kernel.pkg_dir / TOOLS_KEY
+        if key_file.exists():
+            keys.add(key_file.read_text().strip())
+    if not TOOLS_CACHE.exists():
+        return list()
+    return sorted([p for p in TOOLS_CACHE.iterdir() if p.name not in keys])
+
+
+def plan_gc(
+    kernels: list[KernelUsage], keep: int, free: Optional[int]
+) -> list[tuple[KernelUsage, str, int]]:
+    """Artifacts of the kernels beyond the keep used last, cheapest to get
+    back first and least recently used first within a kind, until free bytes
+    are reclaimed"""
+    candidates = [k for k in kernels[keep:] if not k.running]
+    plan: list[tuple[KernelUsage, str, int]] = list()
+    reclaimed = 0
+    for kind in RECLAIM_ORDER:
+        for kernel in sorted(candidates, key=lambda k: k.last_used):
+            size = kernel.sizes.get(kind, 0)
+            if free is not None and reclaimed >= free:
+                return plan
+            if size == 0 and not (kind == PACKAGE and kernel.pkg_dir.exists()):
+                continue
+            plan.append((kernel, kind, size))
+            reclaimed += size
+    return plan
+
+
+def reclaim(ctx: InvokeContext, kernel: KernelUsage, kind: str) -> None:
+    if kind == LINUX_SOURCE:
+        ctx.run(f"rm -rf {kernel.pkg_dir / LINUX_SOURCE}")
+    elif kind == OBJECTS:
+        if kernel.worktree.exists():
+            ctx.run(f"git -C {kernel.worktree} clean -fdxq")
+        # packages and source tarballs kbuild left next to the worktree
+        ctx.run(f"find {kernel.worktree_base} -maxdepth 1 -type f -delete")
+    elif kind == WORKTREE:
+        ctx.run(
+            f"cd {KernelBuildPaths.linux_stable} && git worktree remove --force {kernel.version}{WORKTREE_SUFFIX}/{kernel.version}",
+            warn=True,
+        )
+        ctx.run(f"rm -rf {kernel.worktree_base}")
+    elif kind == DEBS:
+        ctx.run(f"rm -f {kernel.pkg_dir}/*.deb")
+    elif kind == PACKAGE:
+        manifest_file = kernel.pkg_dir / "kernel.manifest"
+        if manifest_file.exists():
+            with open(manifest_file, "r") as f:
+                manifest = json.load(f)
+            if "tap_name" in manifest:
+                teardown_tap(ctx, manifest["tap_name"], manifest.get("gateway_ip"))
+        ctx.run(f"rm -rf {kernel.pkg_dir}")
+        with open_registry() as registry:
+            registry.release_owner(kernel.pkg_dir.name)
+
+
+def compact_overlay(ctx: InvokeContext, overlay: Path) -> int:
+    """Rewrite an overlay without the clusters the guest zeroed or freed,
+    keeping its backing file. Returns the bytes saved."""
+    before = disk_usage(overlay)
+    base = RootfsBuildPaths.images_dir / "rootfs.qcow2"
+    tmp = overlay.with_suffix(".compact.qcow2")
+    ctx.run(f"qemu-img convert -O qcow2 -B {base.absolute()} -F qcow2 {overlay} {tmp}")
+    tmp.replace(overlay)
+    return before - disk_usage(overlay)
+
+
+def print_inventory(
+    kernels: list[KernelUsage], keep: int, shared: dict[str, int]
+) -> None:
+    header = "".join([f"{kind:>13}" for kind in RECLAIM_ORDER])
+    print(f"{'kernel':<24} {'last used':<17} {'state':<8}{header}{'total':>10}")
+    for i, kernel in enumerate(kernels):
+        state = "running" if kernel.running else ("keep" if i < keep else "gc")
+        used = time.strftime("%Y-%m-%d %H:%M", time.localtime(kernel.last_used))
+        sizes = "".join(
+            [f"{gib(kernel.sizes.get(kind, 0)):>13}" for kind in RECLAIM_ORDER]
+        )
+        print(
+            f"{kernel.version:<24} {used:<17} {state:<8}{sizes}{gib(kernel.total):>10}"
+        )
+    for name, size in shared.items():
+        print(f"{name:<51}{gib(size):>75}")
+
+    total = sum([k.total for k in kernels]) + sum(shared.values())
+    info(f"[+] {len(kernels)} kernels, {gib(total)} in total")
+
+
+def gc(
+    ctx: InvokeContext,
+    keep: int,
+    free: Optional[str] = None,
+    compact: bool = False,
+    dry_run: bool = False,
+) -> None:
+    if keep < 0:
+        raise Exit("--keep cannot be negative")
+
+    kernels = kernel_inventory(ctx)
+    print_inventory(kernels, keep, shared_inventory(kernels))
+
+    target = parse_size(free, GIB) if free is not None else None
+    plan = plan_gc(kernels, keep, target)
+    removed = {k.version for k, kind, _ in plan if kind == PACKAGE}
+    tools = unreferenced_tools([k for k in kernels if k.version not in removed])
+    tools_size = sum([disk_usage(p) for p in tools])
+    overlays = list()
+    if compact:
+        overlays = [
+            k.pkg_dir / "overlay.qcow2"
+            for k in kernels
+            if not k.running
+            and k.version not in removed
+            and (k.pkg_dir / "overlay.qcow2").exists()
+        ]
+
+    if len(plan) == 0 and len(tools) == 0 and len(overlays) == 0:
+        info(f"[+] Nothing to reclaim beyond the {keep} kernels used last")
+        return
+
+    for kernel, kind, size in plan:
+        info(f"    {gib(size):>9}  {kind:<13} {kernel.version}")
+    if len(tools) > 0:
+        info(
+            f"    {gib(tools_size):>9}  {len(tools)} tools builds no kernel package refers to"
+        )
+    for overlay in overlays:
+        info(f"    {'?':>9}  compact {overlay}")
+    reclaimed = sum([size for _, _, size in plan]) + tools_size
+    if dry_run:
+        info(f"[+] Dry run, would reclaim {gib(reclaimed)}")
+        return
+
+    worktrees = {k.version for k, kind, _ in plan if kind == WORKTREE}
+    for kernel, kind, _ in plan:
+        # the objects go with the worktree
+        if kind == OBJECTS and kernel.version in worktrees:
+            continue
+        reclaim(ctx, kernel, kind)
+    for path in tools:
+        ctx.run(f"rm -rf {path}")
+    for overlay in overlays:
+        saved = compact_overlay(ctx, overlay)
+        info(f"[+] Compacted {overlay}, {gib(saved)} saved")
+        reclaimed += saved
+    if any([k.running for k in kernels[keep:]]):
+        warn("[!] Kernels with running VMs were left alone")
+    info(f"[+] Reclaimed {gib(reclaimed)}")
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import struct
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+SHT_NOTE = 7
+NT_GNU_BUILD_ID = 3
+
+# Xen ELF note advertising the 32bit PVH entry point. Its presence means
+# the vmlinux can be booted directly by qemu without decompression.
+XEN_ELFNOTE_PHYS32_ENTRY = 18
+
+
+class ElfNote:
+    def __init__(self, name: str, type: int, desc: bytes):
+        self.name = name
+        self.type = type
+        self.desc = desc
+
+
+def _parse_notes(data: bytes, endian: str) -> list[ElfNote]:
+    notes = list()
+    offset = 0
+    while offset + 12 <= len(data):
+        namesz, descsz, ntype = struct.unpack_from(f"{endian}III", data, offset)
+        offset += 12
+        name = data[offset : offset + namesz].rstrip(b"\x00").decode(errors="replace")
+        offset += (namesz + 3) & ~3
+        desc = data[offset : offset + descsz]
+        offset += (descsz + 3) & ~3
+        notes.append(ElfNote(name, ntype, desc))
+
+    return notes
+
+
+class ElfSection:
+    def __init__(self, name: str, type: int, offset: int, size: int):
+        self.name = name
+        self.type = type
+        self.offset = offset
+        self.size = size
+
+
+def _read_sections(f: BinaryIO, path: Path) -> tuple[list[ElfSection], str]:
+    ident = f.read(16)
+    if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+        raise ValueError(f"{path} is not an ELF file")
+
+    is64 = ident[4] == ELFCLASS64
+    endian = "<" if ident[5] == ELFDATA2LSB else ">"
+    if is64:
+        f.seek(0x28)
+        (shoff,) = struct.unpack(f"{endian}Q", f.read(8))
+        f.seek(0x3A)
+        shentsize, shnum, shstrndx = struct.unpack(f"{endian}HHH", f.read(6))
+    else:
+        f.seek(0x20)
+        (shoff,) = struct.unpack(f"{endian}I", f.read(4))
+        f.seek(0x2E)
+        shentsize, shnum, shstrndx = struct.unpack(f"{endian}HHH", f.read(6))
+
+    raw = list()
+    for i in range(shnum):
+        f.seek(shoff + i * shentsize)
+        header = f.read(shentsize)
+        sh_name, sh_type = struct.unpack_from(f"{endian}II", header, 0)
+        if is64:
+            sh_offset, sh_size = struct.unpack_from(f"{endian}QQ", header, 0x18)
+        else:
+            sh_offset, sh_size = struct.unpack_from(f"{endian}II", header, 0x10)
+        raw.append((sh_name, sh_type, sh_offset, sh_size))
+
+    strtab = b""
+    if shstrndx < len(raw):
+        f.seek(raw[shstrndx][2])
+        strtab = f.read(raw[shstrndx][3])
+
+    sections = list()
+    for sh_name, sh_type, sh_offset, sh_size in raw:
+        end = strtab.find(b"\x00", sh_name)
+        name = strtab[sh_name:end].decode(errors="replace") if end >= 0 else ""
+        sections.append(ElfSection(name, sh_type, sh_offset, sh_size))
+
+    return sections, endian
+
+
+def elf_sections(path: Path) -> list[ElfSection]:
+    with open(path, "rb") as f:
+        return _read_sections(f, path)[0]
+
+
+def read_section(path: Path, name: str) -> Optional[bytes]:
+    """Contents of the named section, None if the file has no such section"""
+    try:
+        with open(path, "rb") as f:
+            for section in _read_sections(f, path)[0]:
+                if section.name == name:
+                    f.seek(section.offset)
+                    return f.read(section.size)
+    except (OSError, ValueError, struct.error):
+        return None
+
+    return None
+
+
+def elf_notes(path: Path) -> list[ElfNote]:
+    """Return the notes of all SHT_NOTE sections of an ELF file. Only the
+    section headers and note sections are read, never the whole file."""
+    with open(path, "rb") as f:
+        sections, endian = _read_sections(f, path)
+        notes: list[ElfNote] = list()
+        for section in sections:
+            if section.type != SHT_NOTE:
+                continue
+            f.seek(section.offset)
+            notes.extend(_parse_notes(f.read(section.size), endian))
+
+    return notes
+
+
+def read_build_id(path: Path) -> Optional[str]:
+    """GNU build-id of an ELF file as a hex string"""
+    try:
+        notes = elf_notes(path)
+    except (OSError, ValueError, struct.error):
+        return None
+
+    for n in notes:
+        if n.name == "GNU" and n.type == NT_GNU_BUILD_ID:
+            return n.desc.hex()
+
+    return None
+
+
+def has_gdb_index(path: Path) -> bool:
+    try:
+        names = [s.name for s in elf_sections(path)]
+    except (OSError, ValueError, struct.error):
+        return False
+
+    return ".gdb_index" in names or ".debug_names" in names
+
+
+def has_pvh_entry(path: Path) -> bool:
+    try:
+        notes = elf_notes(path)
+    except (OSError, ValueError, struct.error):
+        return False
+
+    return any(n.name == "Xen" and n.type == XEN_ELFNOTE_PHYS32_ENTRY for n in notes)
@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import socket
+import subprocess
+import time
+from glob import glob
+from pathlib import Path
+from typing import Optional
+
+from tasks.cgroups import join_vm_cgroup
+from tasks.density import enable_ksm
+from tasks.kernel import KernelManifest, KernelVersion, get_kernel_pkg_dir
+from tasks.qemu import QemuConfig, build_qemu_command
+from tasks.tool import Exit
+
+SSH_PORT = 22
+SSH_USER = "root"
+# %C is a hash of the connection parameters, which keeps the socket path
+# short and unique per guest
+SSH_CONTROL_PATH = "/tmp/kbuild-ssh-%C"
+SSH_CONTROL_PERSIST = "10m"
+# a master whose guest was killed is given up after 3 unanswered keepalives
+SSH_ALIVE_INTERVAL = 5
+SSH_ALIVE_COUNT_MAX = 3
+SSH_MULTIPLEX_OPTIONS = f"-o ControlMaster=auto -o ControlPath={SSH_CONTROL_PATH} -o ControlPersist={SSH_CONTROL_PERSIST}"
+
+
+def probe_ssh(ip: str, port: int = SSH_PORT, timeout: float = 1.0) -> bool:
+    """Return True once sshd on the guest accepts connections and sends its
+    version banner. A bare TCP connect is not enough, the guest kernel accepts
+    the connection before sshd is serving it."""
+    try:
+        with socket.create_connection((ip, port), timeout=timeout) as s:
+            s.settimeout(timeout)
+            return s.recv(4).startswith(b"SSH-")
+    except OSError:
+        return False
+
+
+def wait_for_ssh(
+    ip: str,
+    timeout: float,
+    proc: subprocess.Popen[bytes] | None = None,
+    interval: float = 0.05,
+    port: int = SSH_PORT,
+) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            return False
+        if probe_ssh(ip, port=port, timeout=interval * 10):
+            return True
+        time.sleep(interval)
+
+    return False
+
+
+def launch_vm(config: QemuConfig, log_file: Path) -> subprocess.Popen[bytes]:
+    """Start qemu in the background, detached from the terminal."""
+    if config.balloon:
+        enable_ksm()
+
+    cmd = build_qemu_command(config)
+    with open(log_file, "ab") as log:
+        proc = subprocess.Popen(
+            cmd.argv, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT
+        )
+
+    if config.cgroup is not None:
+        join_vm_cgroup(config.cgroup, proc.pid)
+    return proc
+
+
+def stop_vm(
+    proc: subprocess.Popen[bytes], timeout: float = 10.0, guest: Optional[Guest] = None
+) -> None:
+    """Stop qemu and close the ssh master to the guest. The next VM booted
+    on the same address would otherwise be reached through the master of
+    the dead one, and its commands fail with 255."""
+    try:
+        if proc.poll() is not None:
+            return
+
+        proc.terminate()
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    finally:
+        if guest is not None:
+            guest.close_master()
+
+
+def vm_running(pidfile: Path) -> bool:
+    if not pidfile.exists():
+        return False
+
+    try:
+        pid = int(pidfile.read_text().strip())
+    except ValueError:
+        return False
+
+    return Path(f"/proc/{pid}").exists()
+
+
+class Guest:
+    def __init__(self, name: str, ip: str, ssh_key: Path, port: int = SSH_PORT):
+        self.name = name
+        self.ip = ip
+        self.ssh_key = ssh_key
+        self.port = port
+
+    @property
+    def destination(self) -> str:
+        return f"{SSH_USER}@{self.ip}"
+
+    def ssh_options(self) -> list[str]:
+        return [
+            "-i",
+            self.ssh_key.absolute().as_posix(),
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "UserKnownHostsFile=/dev/null",
+            "-o",
+            "LogLevel=ERROR",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            f"Port={self.port}",
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={SSH_CONTROL_PATH}",
+            "-o",
+            f"ControlPersist={SSH_CONTROL_PERSIST}",
+            "-o",
+            f"ServerAliveInterval={SSH_ALIVE_INTERVAL}",
+            "-o",
+            f"ServerAliveCountMax={SSH_ALIVE_COUNT_MAX}",
+        ]
+
+    def close_master(self) -> None:
+        subprocess.run(
+            ["ssh", *self.ssh_options(), "-O", "exit", self.destination],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def ssh_argv(self, *extra: str) -> list[str]:
+        return ["ssh", *self.ssh_options(), *extra, self.destination]
+
+
+def guest_ssh_key(pkg_dir: Path, manifest: KernelManifest) -> Path:
+    if "ssh_key" in manifest:
+        return Path(manifest["ssh_key"])
+
+    # manifests written before the key path was recorded
+    ssh_keys = [k for k in glob(str(pkg_dir / "vm-*.id_rsa")) if not k.endswith(".pub")]
+    if len(ssh_keys) == 0:
+        raise Exit(f"no SSH key found in {pkg_dir}")
+
+    return Path(ssh_keys[0])
+
+
+def guest_from_manifest(kversion: KernelVersion) -> Guest:
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    manifest_file = pkg_dir / "kernel.manifest"
+    if not manifest_file.exists():
+        raise Exit(f"kernel {kversion} is not initialized, no manifest in {pkg_dir}")
+
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+
+    if "guest_ip" not in manifest:
+        raise Exit(f"manifest of {kversion} does not contain 'guest_ip'")
+
+    return Guest(str(kversion), manifest["guest_ip"], guest_ssh_key(pkg_dir, manifest))
+
+
+class GuestResult:
+    def __init__(
+        self, guest: Guest, exit_code: int, stdout: str, stderr: str, duration: float
+    ):
+        self.guest = guest
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0
+
+
+async def async_probe_ssh(ip: str, port: int = SSH_PORT, timeout: float = 1.0) -> bool:
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, port), timeout
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    try:
+        banner = await asyncio.wait_for(reader.read(4), timeout)
+        return banner.startswith(b"SSH-")
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+
+async def async_ssh_run(
+    guest: Guest, cmd: str, timeout: float | None = None
+) -> GuestResult:
+    start = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *guest.ssh_argv(),
+        cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return GuestResult(
+            guest, -1, "", f"timed out after {timeout}s", time.monotonic() - start
+        )
+
+    return GuestResult(
+        guest,
+        proc.returncode if proc.returncode is not None else -1,
+        stdout.decode(errors="replace"),
+        stderr.decode(errors="replace"),
+        time.monotonic() - start,
+    )
+
+
+async def async_wait_ready(
+    guest: Guest, timeout: float, interval: float = 0.1
+) -> GuestResult:
+    """Wait for sshd to answer, then log in once. The login becomes the
+    control master that later commands to this guest are multiplexed over."""
+    start = time.monotonic()
+    deadline = start + timeout
+    while time.monotonic() < deadline:
+        if await async_probe_ssh(guest.ip, port=guest.port, timeout=interval * 10):
+            remaining = max(deadline - time.monotonic(), 1.0)
+            result = await async_ssh_run(guest, "true", timeout=remaining)
+            if result.ok:
+                result.duration = time.monotonic() - start
+                return result
+        await asyncio.sleep(interval)
+
+    return GuestResult(
+        guest, -1, "", f"not ready after {timeout}s", time.monotonic() - start
+    )
+
+
+def wait_ready(guests: list[Guest], timeout: float) -> list[GuestResult]:
+    async def _all() -> list[GuestResult]:
+        return await asyncio.gather(*[async_wait_ready(g, timeout) for g in guests])
+
+    return asyncio.run(_all())
+
+
+def run_on_guests(
+    guests: list[Guest], cmd: str, timeout: float | None = None
+) -> list[GuestResult]:
+    async def _all() -> list[GuestResult]:
+        return await asyncio.gather(*[async_ssh_run(g, cmd, timeout) for g in guests])
+
+    return asyncio.run(_all())
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import json
+import shlex
+import time
+from glob import glob
+from pathlib import Path
+from typing import Optional
+
+from invoke.context import Context as InvokeContext
+
+from tasks.compiler import CONTAINER_LINUX_BUILD_PATH, get_compiler
+from tasks.guest import Guest, guest_from_manifest, run_on_guests, vm_running
+from tasks.kernel import (
+    KernelBuildPaths,
+    KernelManifest,
+    KernelVersion,
+    Runner,
+    get_kernel_pkg_dir,
+)
+from tasks.tool import Exit, info, warn
+
+# Modules depending on each other are unloaded over several passes, a
+# module can only go once nothing in the set uses it anymore. One still
+# loaded after that is in use, loading it again would keep the old code
+# running. {load} is $mods for modules asked for explicitly, $loaded for
+# the rebuilt ones.
+RELOAD_SCRIPT = """
+depmod -a {release}
+mods="{modules}"
+loaded=""
+for m in $mods; do [ -d /sys/module/$m ] && loaded="$loaded $m"; done
+for _ in 1 2 3; do
+    for m in $loaded; do [ -d /sys/module/$m ] && modprobe -r $m 2>/dev/null; done
+done
+stuck=""
+for m in $loaded; do [ -d /sys/module/$m ] && stuck="$stuck $m"; done
+if [ -n "$stuck" ]; then
+    for m in $stuck; do
+        echo "unable to unload $m, used by $(cat /sys/module/$m/refcnt) references" >&2
+        modprobe -r $m
+    done
+    exit 1
+fi
+for m in {load}; do modprobe $m || exit 1; echo "reloaded $m"; done
+"""
+
+
+def build_tree(
+    ctx: InvokeContext, manifest: KernelManifest
+) -> tuple[Runner, Path, Path]:
+    """Runner, build directory and host directory of the tree the kernel was
+    built from. Kernels built in the compiler container record the path as
+    seen inside of it."""
+    source_dir = Path(manifest["kernel_source_dir"])
+    if source_dir.is_relative_to(CONTAINER_LINUX_BUILD_PATH):
+        cc = get_compiler(ctx, KernelBuildPaths.kernel_sources_dir)
+        host_dir = KernelBuildPaths.kernel_sources_dir / source_dir.relative_to(
+            CONTAINER_LINUX_BUILD_PATH
+        )
+        return cc.exec, source_dir, host_dir
+
+    return ctx.run, source_dir, source_dir
+
+
+def module_name(ko: Path) -> str:
+    return ko.name.removesuffix(".ko").replace("-", "_")
+
+
+def changed_modules(host_dir: Path, subdir: str, since: float) -> list[Path]:
+    kos = [Path(k) for k in glob(f"{host_dir / subdir}/**/*.ko", recursive=True)]
+    return sorted([k for k in kos if k.stat().st_mtime >= since])
+
+
+def push_modules(
+    ctx: InvokeContext, guest: Guest, host_dir: Path, release: str, kos: list[Path]
+) -> None:
+    # /./ anchors --relative, the .ko land at the same path below kernel/
+    # where the deb package installed them
+    srcs = " ".join(
+        [shlex.quote(f"{host_dir}/./{k.relative_to(host_dir)}") for k in kos]
+    )
+    ssh = shlex.quote(shlex.join(["ssh", *guest.ssh_options()]))
+    ctx.run(
+        f"rsync -a --relative -e {ssh} {srcs} {guest.destination}:/lib/modules/{release}/kernel/"
+    )
+
+
+def hotpatch_modules(
+    ctx: InvokeContext,
+    kversion: KernelVersion,
+    subdir: str,
+    modules: Optional[str] = None,
+    reload: bool = True,
+) -> None:
+    start = time.time()
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    manifest_file = pkg_dir / "kernel.manifest"
+    if not manifest_file.exists():
+        raise Exit(f"kernel {kversion} is not built, no manifest in {pkg_dir}")
+
+    with open(manifest_file, "r") as f:
+        manifest: KernelManifest = json.load(f)
+
+    if not vm_running(pkg_dir / "vm.pid"):
+        raise Exit(f"VM of kernel {kversion} is not running")
+
+    run, build_dir, host_dir = build_tree(ctx, manifest)
+    subdir = subdir.strip("/")
+    if not (host_dir / subdir).is_dir():
+        raise Exit(f"{subdir} does not exist in {host_dir}")
+
+    run(f"make -C {build_dir} -j$(nproc) M={subdir} modules")
+
+    kos = changed_modules(host_dir, subdir, start)
+    if len(kos) == 0:
+        warn(f"[!] No module in {subdir} was rebuilt, nothing to push")
+        return
+
+    release = (host_dir / "include" / "config" / "kernel.release").read_text().strip()
+    guest = guest_from_manifest(kversion)
+    push_modules(ctx, guest, host_dir, release, kos)
+    info(f"[+] Pushed {len(kos)} modules to {guest.ip}")
+
+    if reload:
+        names = (
+            modules.split(",") if modules is not None else [module_name(k) for k in kos]
+        )
+        script = RELOAD_SCRIPT.format(
+            release=release,
+            modules=" ".join(names),
+            load="$mods" if modules is not None else "$loaded",
+        )
+        result = run_on_guests([guest], script)[0]
+        print(result.stdout, end="")
+        if not result.ok:
+            raise Exit(f"reloading modules failed:\n{result.stderr}")
+
+    info(f"[+] Hotpatched {subdir} into {kversion} in {time.time() - start:.1f}s")
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import os
+import re
+from glob import glob
+from pathlib import Path
+from typing import Optional
+
+OBJ_LINE = re.compile(r"^obj-\$\(CONFIG_([A-Za-z0-9_]+)\)\s*[:+]?=\s*(.*)$")
+COMPOSITE_LINE = re.compile(
+    r"^([A-Za-z0-9_-]+)-(?:objs|y|\$\(CONFIG_[A-Za-z0-9_]+\))\s*[:+]?=\s*(.*)$"
+)
+# Kbuild variables which look like composite objects but are not
+NOT_COMPOSITE = {
+    "obj",
+    "lib",
+    "subdir",
+    "ccflags",
+    "asflags",
+    "ldflags",
+    "always",
+    "targets",
+}
+
+
+class KbuildObjects:
+    """Module names and objects enabled by each CONFIG_ symbol, read from
+    the obj-$(CONFIG_...) lines of every Makefile and Kbuild file"""
+
+    def __init__(self, source_dir: Path):
+        self.source_dir = source_dir
+        # module name -> symbol building it
+        self.modules: dict[str, str] = dict()
+        # symbol -> objects and directories, relative to source_dir
+        self.objects: dict[str, list[Path]] = dict()
+        self._owners: Optional[dict[Path, str]] = None
+        self._parse()
+
+    def _files(self) -> list[str]:
+        files = list()
+        for root, dirs, names in os.walk(self.source_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            files += [
+                os.path.join(root, n) for n in names if n in ("Makefile", "Kbuild")
+            ]
+        return files
+
+    def _parse(self) -> None:
+        for makefile in self._files():
+            directory = Path(makefile).parent.relative_to(self.source_dir)
+            try:
+                with open(makefile, "r", errors="replace") as f:
+                    lines = f.read().replace("\\\n", " ").splitlines()
+            except OSError:
+                continue
+
+            composites: dict[str, list[str]] = dict()
+            for line in lines:
+                m = COMPOSITE_LINE.match(line.strip())
+                if m is not None and m.group(1) not in NOT_COMPOSITE:
+                    composites.setdefault(m.group(1), []).extend(m.group(2).split())
+
+            for line in lines:
+                m = OBJ_LINE.match(line.strip())
+                if m is None:
+                    continue
+
+                symbol = m.group(1)
+                for token in m.group(2).split():
+                    if token.endswith("/"):
+                        self.objects.setdefault(symbol, []).append(directory / token)
+                    elif token.endswith(".o"):
+                        name = token[: -len(".o")]
+                        self.modules.setdefault(name.replace("-", "_"), symbol)
+                        parts = composites.get(name, [])
+                        self.objects.setdefault(symbol, []).extend(
+                            [directory / p for p in parts + [token] if p.endswith(".o")]
+                        )
+
+    def built_objects(self, symbols: set[str]) -> int:
+        """Number of objects in the build tree which the given symbols enable"""
+        count = 0
+        for symbol in symbols:
+            for obj in self.objects.get(symbol, []):
+                path = self.source_dir / obj
+                if path.is_dir():
+                    count += len(glob(f"{path}/**/*.o", recursive=True))
+                elif path.exists():
+                    count += 1
+        return count
+
+    def _index(self) -> dict[Path, str]:
+        if self._owners is None:
+            self._owners = dict()
+            for symbol, paths in self.objects.items():
+                for path in paths:
+                    self._owners.setdefault(path, symbol)
+        return self._owners
+
+    def owners(self, obj: Path) -> list[str]:
+        """Symbols building obj, innermost first: the symbol of the object
+        itself followed by those of the directories containing it"""
+        index = self._index()
+        symbols = list()
+        symbol: Optional[str] = index.get(obj)
+        if symbol is not None:
+            symbols.append(symbol)
+        for parent in obj.parents:
+            symbol = index.get(parent)
+            if symbol is not None and symbol not in symbols:
+                symbols.append(symbol)
+        return symbols
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import json
+import time
+from glob import glob
+from pathlib import Path
+from typing import Optional
+
+from invoke.context import Context as InvokeContext
+
+from tasks.arch import Arch
+from tasks.guest import guest_from_manifest, run_on_guests, vm_running
+from tasks.hotpatch import build_tree
+from tasks.kbuild import KbuildObjects
+from tasks.kernel import (
+    KernelBuildPaths,
+    KernelManifest,
+    KernelVersion,
+    Runner,
+    _make_config,
+    get_kernel_image_name,
+    get_kernel_pkg_dir,
+)
+from tasks.tool import Exit, info, warn
+from tasks.vm import snapshot_run
+
+TRIM_WORKTREE = "trim-build/trim"
+
+# Sample the loaded modules every second while the workload runs, modules
+# loaded on demand may be unloaded again before it finishes
+WORKLOAD_TEMPLATE = """
+({workload}) >/dev/null 2>&1 &
+pid=$!
+while kill -0 $pid 2>/dev/null; do cut -d' ' -f1 /proc/modules; sleep 1; done
+wait $pid
+cut -d' ' -f1 /proc/modules
+echo {separator}
+zcat /proc/config.gz 2>/dev/null
+"""
+SEPARATOR = "--kbuild-config--"
+
+
+def parse_config(text: str) -> dict[str, str]:
+    config = dict()
+    for line in text.splitlines():
+        if line.startswith("CONFIG_") and "=" in line:
+            key, value = line.split("=", 1)
+            config[key[len("CONFIG_") :]] = value
+    return config
+
+
+def gather_usage(
+    ctx: InvokeContext, kversion: KernelVersion, workload: str, timeout: Optional[float]
+) -> tuple[set[str], Optional[dict[str, str]]]:
+    """Loaded modules and the running config of the guest. The running VM is
+    used, otherwise the kernel is booted with -snapshot for the workload."""
+    script = WORKLOAD_TEMPLATE.format(workload=workload or "true", separator=SEPARATOR)
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    if vm_running(pkg_dir / "vm.pid"):
+        result = run_on_guests([guest_from_manifest(kversion)], script, timeout)[0]
+    else:
+        info(f"[+] Booting {kversion} to run the workload")
+        image = pkg_dir / get_kernel_image_name(Arch.local())
+        snapshot = snapshot_run(kversion, image, script, timeout, tag="trim-config")
+        if snapshot is None:
+            raise Exit(f"guest did not become ssh-ready, see {pkg_dir}/trim-config.log")
+        result = snapshot
+
+    if not result.ok:
+        raise Exit(f"workload failed in the guest:\n{result.stderr}")
+
+    modules_out, _, config_out = result.stdout.partition(SEPARATOR)
+    modules = {m.strip() for m in modules_out.splitlines() if m.strip() != ""}
+    config = parse_config(config_out) if config_out.strip() != "" else None
+    return modules, config
+
+
+def trim_fragment(
+    kversion: KernelVersion,
+    config: dict[str, str],
+    used: set[str],
+    pinned: set[str],
+) -> list[str]:
+    """Fragment disabling every module which the workload did not use"""
+    dropped = sorted(
+        [s for s, v in config.items() if v == "m" and s not in used and s not in pinned]
+    )
+    lines = [
+        f"# Generated by kernel.trim-config for {kversion}",
+        f"# {len(used)} modules in use, {len(dropped)} dropped",
+    ]
+    if len(pinned) > 0:
+        lines.append(f"# pinned: {' '.join(sorted(pinned))}")
+    lines += [f"CONFIG_{s}=n" for s in dropped]
+    return lines
+
+
+def timed_build(
+    ctx: InvokeContext, run: Runner, build_dir: Path, extra_config: Optional[str]
+) -> float:
+    run(f"make -C {build_dir} clean")
+    _make_config(ctx, build_dir, extra_config)
+    start = time.monotonic()
+    run(f"make -C {build_dir} -j$(nproc) vmlinux modules")
+    return time.monotonic() - start
+
+
+def measure_builds(
+    ctx: InvokeContext,
+    run: Runner,
+    build_dir: Path,
+    host_dir: Path,
+    extra_config: Optional[str],
+    fragment: Path,
+) -> tuple[float, float]:
+    """Clean build times of the full and the trimmed config, in a separate
+    worktree at the commit the kernel was built from"""
+    head = ctx.run(f"git -C {host_dir} rev-parse HEAD", hide=True, warn=True)
+    if head is None or not head.ok:
+        raise Exit(f"{host_dir} is not a git worktree, unable to measure build times")
+
+    commit = head.stdout.strip()
+    worktree = KernelBuildPaths.linux_stable / TRIM_WORKTREE
+    if not worktree.exists():
+        ctx.run(
+            f"cd {KernelBuildPaths.linux_stable} && git worktree add --detach {TRIM_WORKTREE} {commit}"
+        )
+    else:
+        ctx.run(f"git -C {worktree} checkout --detach {commit}")
+
+    # the worktree sits next to the kernel's own, in the container as well
+    trim_dir = build_dir.parent.parent / TRIM_WORKTREE
+    trimmed = fragment.absolute().as_posix()
+    if extra_config is not None:
+        trimmed = f"{extra_config},{trimmed}"
+
+    full = timed_build(ctx, run, trim_dir, extra_config)
+    info(f"[+] Full config built in {full:.0f}s")
+    trim = timed_build(ctx, run, trim_dir, trimmed)
+    info(f"[+] Trimmed config built in {trim:.0f}s")
+    return full, trim
+
+
+def trim_config(
+    ctx: InvokeContext,
+    kversion: KernelVersion,
+    workload: str = "",
+    pin: str = "",
+    extra_config: Optional[str] = None,
+    measure: bool = False,
+    timeout: Optional[float] = None,
+) -> Path:
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    manifest_file = pkg_dir / "kernel.manifest"
+    if not manifest_file.exists():
+        raise Exit(f"kernel {kversion} is not initialized, run vm.init first")
+
+    with open(manifest_file, "r") as f:
+        manifest: KernelManifest = json.load(f)
+
+    run, build_dir, host_dir = build_tree(ctx, manifest)
+    loaded, config = gather_usage(ctx, kversion, workload, timeout)
+    if config is None:
+        warn("[!] Guest has no /proc/config.gz, using the .config of the build tree")
+        config = parse_config((host_dir / ".config").read_text())
+
+    objects = KbuildObjects(host_dir)
+    pinned = {
+        p.strip().removeprefix("CONFIG_") for p in pin.split(",") if p.strip() != ""
+    }
+    # the symbol of a module kbuild cannot map would be disabled although
+    # the workload used it, only the user can name it
+    unmapped = sorted(
+        [m for m in loaded if m not in objects.modules and m not in pinned]
+    )
+    if len(unmapped) > 0:
+        raise Exit(
+            f"no CONFIG_ symbol is known to build the loaded modules {', '.join(unmapped)}, "
+            "pin the symbols building them along with the module names, e.g. --pin=CONFIG_FOO,foo"
+        )
+    used = {objects.modules[m] for m in loaded if m in objects.modules}
+    lines = trim_fragment(kversion, config, used, pinned)
+    dropped = {
+        line[len("CONFIG_") : -len("=n")]
+        for line in lines
+        if line.startswith("CONFIG_")
+    }
+
+    fragment = (
+        KernelBuildPaths.configs_dir
+        / f"trim-{pkg_dir.name.removeprefix('kernel-')}.config"
+    )
+    with open(fragment, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    info(f"[+] Wrote {fragment}: {len(used)} modules used, {len(dropped)} disabled")
+
+    total = len(glob(f"{host_dir}/**/*.o", recursive=True))
+    removed = objects.built_objects(dropped)
+    report: dict[str, float] = {
+        "objects": total,
+        "objects_removed": removed,
+    }
+    share = removed / total if total > 0 else 0.0
+    info(f"[+] {removed} of {total} objects ({share:.1%}) are no longer built")
+    build_seconds = manifest.get("build_stats", dict()).get("build")
+    if build_seconds is not None:
+        report["projected_seconds_saved"] = build_seconds * share
+        info(
+            f"[+] Projected: {build_seconds * share:.0f}s of the last {build_seconds:.0f}s build"
+        )
+
+    if measure:
+        full, trim = measure_builds(
+            ctx, run, build_dir, host_dir, extra_config, fragment
+        )
+        report["full_build_seconds"] = full
+        report["trimmed_build_seconds"] = trim
+        info(
+            f"[+] Measured: {full - trim:.0f}s saved ({(full - trim) / full:.1%}) per clean build"
+        )
+
+    with open(fragment.with_suffix(".json"), "w") as f:
+        json.dump(report, f, indent=4)
+
+    return fragment
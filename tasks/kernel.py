@@ -1,16 +1,32 @@
 from __future__ import annotations
 
+from contextlib import contextmanager
 from glob import glob
 from invoke import task, runners
 from invoke.context import Context as InvokeContext
+import os
+import time
 import uuid
 import json
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Any, Callable, Iterator, Optional
 
 from tasks.arch import Arch
+from tasks.btf import (
+    btf_enabled,
+    export_vmlinux_btf,
+    install_pahole_wrapper,
+    pahole_make_args,
+    pahole_seconds,
+)
+from tasks.cgroups import build_cgroup
+from tasks.ccprofile import cc_make_args, install_cc_wrapper, write_profile
 from tasks.tool import info, Exit
+from tasks.tracing import phase, set_kernel
 from tasks.compiler import get_compiler, CONTAINER_LINUX_BUILD_PATH, CompilerExec
+from tasks.network import TAP_PREFIX
+from tasks.registry import Registry, GDB_PORTS, SUBNETS, TAPS
+from tasks.sparse import narrow_sparse_checkout, record_checkout, sparse_checkout
 from typing_extensions import TypedDict
 
 DEFAULT_GIT_SOURCE = (
@@ -25,6 +41,12 @@ class KernelManifest(TypedDict, total=False):
     guest_ip: str
     tap_name: str
     gdb_port: int
+    ssh_key: str
+    debuginfod: bool
+    vmlinux_btf: str
+    build_stats: dict[str, float]
+    trace_history: list[dict[str, Any]]
+    last_used: float
 
 
 class KernelVersion:
@@ -105,6 +127,43 @@ class KernelBuildPaths:
     configs_dir = kernel_dir / "configs"
 
 
+def import_manifests(registry: Registry) -> None:
+    """Seed a new registry with the resources recorded in existing manifests"""
+    for k in glob(f"{KernelBuildPaths.kernel_sources_dir}/kernel-*"):
+        manifest_file = os.path.join(k, "kernel.manifest")
+        if not os.path.exists(manifest_file):
+            continue
+
+        try:
+            with open(manifest_file, "r") as f:
+                manifest = json.load(f)
+        except ValueError:
+            continue
+
+        owner = os.path.basename(k)
+        if "kid" in manifest:
+            registry.register_kernel(owner, manifest["kid"])
+        if "gdb_port" in manifest:
+            registry.claim(GDB_PORTS, owner, manifest["gdb_port"])
+        if "gateway_ip" in manifest:
+            registry.claim(SUBNETS, owner, int(manifest["gateway_ip"].split(".")[2]))
+        if manifest.get("tap_name", "").startswith(f"{TAP_PREFIX}-"):
+            registry.claim(TAPS, owner, int(manifest["tap_name"].split("-")[-1]))
+
+
+@contextmanager
+def open_registry() -> Iterator[Registry]:
+    path = KernelBuildPaths.kernel_sources_dir / "registry.db"
+    new = not path.exists()
+    registry = Registry(path, KernelBuildPaths.kernel_sources_dir)
+    try:
+        if new:
+            import_manifests(registry)
+        yield registry
+    finally:
+        registry.close()
+
+
 def bare_repository(ctx, repo):
     description = repo / "description"
     if not description.exists():
@@ -156,7 +215,13 @@ def checkout_kernel(
     kernel_version: KernelVersion,
     git_source: str,
     pull: bool = False,
+    sparse: bool = False,
+    arch: Optional[Arch] = None,
 ) -> bool:
+    """Check out the worktree of a version. A sparse checkout leaves out
+    what kbuild does not read for the arch, the build then leaves out what
+    it does not read for the config, see tasks/sparse.py. A worktree stays
+    sparse until 'git sparse-checkout disable' is run in it."""
     cloned = False
     if not KernelBuildPaths.linux_stable.exists():
         clone_kernel_source(
@@ -171,16 +236,31 @@ def checkout_kernel(
 
     info(f"[+] Creating new worktree for tag {kernel_version}")
     worktree = KernelBuildPaths.linux_stable / kernel_version.worktree
-    if not worktree.exists():
+    rev = (
+        str(kernel_version) if kernel_version.branch != "" else f"tags/{kernel_version}"
+    )
+    created = not worktree.exists()
+    start = time.monotonic()
+    if created:
+        no_checkout = "--no-checkout " if sparse else ""
         ctx.run(
-            f"cd {KernelBuildPaths.linux_stable} && git worktree add {kernel_version.worktree}"
+            f"cd {KernelBuildPaths.linux_stable} && git worktree add {no_checkout}{kernel_version.worktree}"
         )
 
-    if kernel_version.branch != "":
-        ctx.run(f"cd {worktree} && git checkout {kernel_version}")
-    else:
-        ctx.run(f"cd {worktree} && git checkout tags/{kernel_version}")
+    if sparse:
+        sparse_checkout(ctx, worktree, arch or Arch.local())
 
+    ctx.run(f"cd {worktree} && git checkout {rev}")
+
+    if created:
+        record_checkout(
+            ctx,
+            KernelBuildPaths.kernel_sources_dir / "checkout-stats.json",
+            worktree,
+            str(kernel_version),
+            sparse,
+            time.monotonic() - start,
+        )
     return cloned
 
 
@@ -193,18 +273,20 @@ def make_config(
     _make_config(ctx, source_dir, extra_config)
 
 
+def config_fragments(extra_config: Optional[str]) -> list[Path]:
+    # fragments are applied in order, later ones override earlier ones
+    all_configs = list(EXTRA_CONFIG)
+    if extra_config is not None:
+        for p in extra_config.split(','):
+            if Path(p) not in all_configs:
+                all_configs.append(Path(p))
+    return all_configs
+
+
 def _make_config(
     ctx: InvokeContext, source_dir: Path, extra_config: Optional[str]
 ) -> None:
-    if extra_config is None:
-        all_configs = set(EXTRA_CONFIG)
-    else:
-        all_configs = set()
-
-    if extra_config is not None:
-        print(EXTRA_CONFIG)
-        all_configs = set([Path(p) for p in extra_config.split(',')] + EXTRA_CONFIG)
-
+    all_configs = config_fragments(extra_config)
     build_path = str(source_dir)
     ctx.run(f"make -C {build_path} KCONFIG_CONFIG=start.config defconfig")
 
@@ -220,25 +302,40 @@ def _make_config(
 Runner = Callable[[str], Optional[runners.Result]] | CompilerExec
 
 
-def make_kernel(run: Runner, sources_dir: Path, compile_only: bool) -> None:
+def make_kernel(
+    run: Runner, sources_dir: Path, compile_only: bool, make_args: str = ""
+) -> None:
     #if compile_only:
     #    run(f"make -C {sources_dir} -j$(nproc) bzImage KCFLAGS=-ggdb3")
     #else:
     #    run(f"DPKG_DEB_OPTIONS=\"--compression=gzip --nocheck\" make -C {sources_dir} -j$(nproc) deb-pkg KCFLAGS=-ggdb3")
     if compile_only:
-        run(f"make -C {sources_dir} -j$(nproc) bzImage")
+        run(f"make -C {sources_dir} -j$(nproc) bzImage {make_args}")
     else:
-        run(f"DPKG_DEB_OPTIONS=\"--compression=gzip --nocheck\" make -C {sources_dir} -j$(nproc) deb-pkg")
+        run(
+            f"DPKG_DEB_OPTIONS=\"--compression=gzip --nocheck\" make -C {sources_dir} -j$(nproc) deb-pkg {make_args}"
+        )
 
-@task  # type: ignore
+
+@task(  # type: ignore
+    help={
+        "kernel_version": "kernel version string of the form v6.8 or v5.2.20",
+        "sparse": "check out only what kbuild reads for the arch and config: no Documentation, other arches or disabled drivers",
+        "arch": "architecture of the form x86 or aarch64, etc., for --sparse",
+    },
+)
 def checkout(
     ctx: InvokeContext,
     kernel_version: str,
+    sparse: bool = False,
+    arch: Optional[str] = None,
 ) -> None:
     checkout_kernel(
         ctx,
         KernelVersion.from_str(ctx, kernel_version),
         DEFAULT_GIT_SOURCE,
+        sparse=sparse,
+        arch=Arch.from_str(arch) if arch is not None else None,
     )
 
 
@@ -303,6 +400,19 @@ def save_manifest(manifest: KernelManifest, kernel_version: KernelVersion) -> No
         json.dump(manifest, f)
 
 
+def mark_used(kernel_version: KernelVersion) -> None:
+    """Record that the kernel was built or booted, vm.gc keeps the kernels
+    used last"""
+    manifest_file = get_kernel_pkg_dir(kernel_version) / "kernel.manifest"
+    if not manifest_file.exists():
+        return
+
+    with open(manifest_file, "r") as f:
+        manifest: KernelManifest = json.load(f)
+    manifest["last_used"] = time.time()
+    save_manifest(manifest, kernel_version)
+
+
 def manifest_add_kernel_source_dir(
     manifest: KernelManifest,
     kernel_src_dir: Path,
@@ -341,6 +451,8 @@ EXTRA_CONFIG = [
         "extra_config": "path to file containing extra KConfig options",
         "compile_only": "only rebuild bzImage",
         "always_use_gcc8": "always compile in docker container with gcc-8",
+        "profile": "record per-object compile and link times and write build-profile.txt to the kernel package, rebuilds every object",
+        "sparse": "check out only what kbuild reads for the arch and config: no Documentation, other arches or disabled drivers",
     },
 )
 def build(
@@ -353,6 +465,8 @@ def build(
     kernel_src_dir: str | None = None,
     git_source: str = DEFAULT_GIT_SOURCE,
     no_checkout: bool = False,
+    profile: bool = False,
+    sparse: bool = False,
 ) -> None:
     build_kernel(
         ctx,
@@ -360,9 +474,12 @@ def build(
         arch=arch,
         extra_config=extra_config,
         compile_only=compile_only,
+        always_use_gcc8=always_use_gcc8,
         kernel_src_dir=kernel_src_dir,
         git_source=git_source,
         no_checkout=no_checkout,
+        profile=profile,
+        sparse=sparse,
     )
 
 
@@ -387,6 +504,8 @@ def build_kernel(
     always_use_gcc8: bool = False,
     kernel_src_dir: str | None = None,
     no_checkout: bool = False,
+    profile: bool = False,
+    sparse: bool = False,
 ) -> None:
     if arch is None:
         arch = Arch.local()
@@ -396,9 +515,17 @@ def build_kernel(
     if kernel_src_dir is not None:
         KernelBuildPaths.linux_stable = Path(kernel_src_dir)
 
+    set_kernel(get_kernel_pkg_dir(kversion))
     cloned = False
     if not no_checkout:
-        cloned = checkout_kernel(ctx, kversion, git_source)
+        with phase("checkout"):
+            cloned = checkout_kernel(
+                ctx,
+                kversion,
+                git_source,
+                sparse=sparse,
+                arch=arch,
+            )
 
     if cloned and use_docker_compiler(kversion, always_use_gcc8):
         # restart compiler if we had to clone the kernel sources again
@@ -407,6 +534,7 @@ def build_kernel(
 
     run_cmd = ctx.run
     source_dir = KernelBuildPaths.linux_stable / f"{kversion.worktree}"
+    host_source_dir = source_dir
     if use_docker_compiler(kversion, always_use_gcc8):
         cc = get_compiler(ctx, KernelBuildPaths.kernel_sources_dir)
         run_cmd = cc.exec
@@ -414,16 +542,63 @@ def build_kernel(
             CONTAINER_LINUX_BUILD_PATH / "linux-stable" / f"{kversion.worktree}"
         )
 
-    _make_config(ctx, source_dir, extra_config)
-    make_kernel(run_cmd, source_dir, compile_only)
-    build_package(ctx, source_dir, kversion, arch, compile_only)
+    with phase("config"):
+        _make_config(ctx, source_dir, extra_config)
+        narrow_sparse_checkout(ctx, host_source_dir, arch)
+
+    make_args = ""
+    btf = btf_enabled(host_source_dir)
+    if btf:
+        install_pahole_wrapper(host_source_dir)
+        make_args = pahole_make_args(source_dir)
+    if profile:
+        install_cc_wrapper(host_source_dir)
+        make_args = f"{make_args} {cc_make_args(source_dir)}"
+
+    start = time.monotonic()
+    with build_cgroup(f"kernel.build {kversion}"):
+        with phase("compile"):
+            make_kernel(run_cmd, source_dir, compile_only, make_args)
+        build_stats = {"build": time.monotonic() - start}
+        with phase("package"):
+            build_package(ctx, source_dir, kversion, arch, compile_only)
 
     manifest: KernelManifest = {}
     manifest = manifest_add_kuuid(manifest, kversion)
     manifest = manifest_add_kernel_source_dir(manifest, source_dir)
+    kdir = get_kernel_pkg_dir(kversion)
+    if (kdir / "kernel.manifest").exists():
+        # keep the timings of earlier runs to compare against
+        with open(kdir / "kernel.manifest", "r") as f:
+            previous = json.load(f)
+        if "trace_history" in previous:
+            manifest["trace_history"] = previous["trace_history"]
+    if btf:
+        build_stats["btf"] = pahole_seconds(host_source_dir)
+        vmlinux_btf = export_vmlinux_btf(
+            kdir / "vmlinux", KernelBuildPaths.kernel_sources_dir / "btf-cache", kdir
+        )
+        if vmlinux_btf is not None:
+            manifest["vmlinux_btf"] = vmlinux_btf.absolute().as_posix()
+
+    if profile:
+        with phase("profile"):
+            write_profile(
+                host_source_dir, source_dir, config_fragments(extra_config), kdir
+            )
+
+    manifest["build_stats"] = build_stats
+    manifest["last_used"] = time.time()
     save_manifest(manifest, kversion)
+    with open_registry() as registry:
+        registry.register_kernel(kdir.name, manifest["kid"])
 
     info(f"[+] Kernel {kversion} build complete")
+    info(f"[+] Build time: {build_stats['build']:.1f}s")
+    if "btf" in build_stats:
+        info(f"[+] BTF encoding (pahole): {build_stats['btf']:.1f}s")
+    if "vmlinux_btf" in manifest:
+        info(f"[+] vmlinux BTF exported to {manifest['vmlinux_btf']}")
 
 
 @task  # type: ignore
@@ -452,3 +627,184 @@ def clean(
     if kversion < KernelVersion(5, 5, 0):
         cc = get_compiler(ctx, KernelBuildPaths.linux_stable)
         cc.exec("rm -f /tmp/*", allow_fail=True)
+
+
+@task(  # type: ignore
+    help={
+        "kernel_version": "kernel version string of the form v6.8 or v5.2.20",
+        "subdir": "directory of the modules to rebuild, relative to the kernel tree, e.g. net/netfilter",
+        "modules": "comma separated modules to reload, defaults to the rebuilt ones that are loaded",
+        "reload": "unload and reload the modules in the guest after pushing them",
+    },
+)
+def hotpatch(
+    ctx: InvokeContext,
+    kernel_version: str,
+    subdir: str,
+    modules: Optional[str] = None,
+    reload: bool = True,
+) -> None:
+    """Rebuild the modules of one directory and load them into the running VM"""
+    # tasks.hotpatch depends on tasks.guest, which imports this module
+    from tasks.hotpatch import hotpatch_modules
+
+    hotpatch_modules(
+        ctx, KernelVersion.from_str(ctx, kernel_version), subdir, modules, reload
+    )
+
+
+@task(  # type: ignore
+    help={
+        "good": "known good tag or commit, e.g. v6.1.10",
+        "bad": "known bad tag or commit",
+        "test_script": "script run in the guest, exit 0 for good, 125 to skip and anything else for bad",
+        "vm_kernel_version": "initialized kernel whose disk, tap and ssh key the candidates boot with",
+        "extra_config": "path to file containing extra KConfig options",
+        "always_use_gcc8": "always compile in docker container with gcc-8",
+        "timeout": "seconds the test script may run",
+        "append": "extra kernel command line arguments",
+        "reset": "abandon the bisection in progress and remove its state",
+    },
+)
+def bisect(
+    ctx: InvokeContext,
+    good: str = "",
+    bad: str = "",
+    test_script: str = "",
+    vm_kernel_version: str = "",
+    extra_config: Optional[str] = None,
+    always_use_gcc8: bool = False,
+    timeout: int = 600,
+    append: str = "",
+    reset: bool = False,
+) -> None:
+    """Find the first bad commit between two kernels by booting each candidate.
+    The bisection is resumed when run again with the same good and bad."""
+    # tasks.bisection depends on tasks.guest, which imports this module
+    from tasks.bisection import reset_bisect, run_bisect
+
+    if reset:
+        reset_bisect(ctx)
+        return
+
+    if good == "" or bad == "" or test_script == "" or vm_kernel_version == "":
+        raise Exit("--good, --bad, --test-script and --vm-kernel-version are required")
+
+    run_bisect(
+        ctx,
+        good,
+        bad,
+        Path(test_script),
+        KernelVersion.from_str(ctx, vm_kernel_version),
+        extra_config=extra_config,
+        always_use_gcc8=always_use_gcc8,
+        timeout=timeout,
+        append=append,
+    )
+
+
+@task(  # type: ignore
+    help={
+        "kernel_version": "kernel version string of the form v6.8 or v5.2.20",
+        "workload": "command run in the guest while the loaded modules are sampled",
+        "pin": "comma separated CONFIG_ symbols to keep even if unused, and loaded modules no symbol is known for",
+        "extra_config": "fragments the kernel was built with, for --measure",
+        "measure": "time clean builds of the full and the trimmed config",
+        "timeout": "seconds the workload may run, 0 for no limit",
+    },
+)
+def trim_config(
+    ctx: InvokeContext,
+    kernel_version: str,
+    workload: str = "",
+    pin: str = "",
+    extra_config: Optional[str] = None,
+    measure: bool = False,
+    timeout: int = 0,
+) -> None:
+    """Generate a config fragment disabling the modules a workload does not load"""
+    # tasks.kconfig depends on tasks.guest, which imports this module
+    from tasks.kconfig import trim_config as _trim_config
+
+    _trim_config(
+        ctx,
+        KernelVersion.from_str(ctx, kernel_version),
+        workload=workload,
+        pin=pin,
+        extra_config=extra_config,
+        measure=measure,
+        timeout=timeout if timeout > 0 else None,
+    )
+
+
+@task(  # type: ignore
+    help={
+        "kernel_version": "kernel version string of the form v6.8 or v5.2.20",
+        "always_use_gcc8": "always compile in docker container with gcc-8",
+    },
+)
+def tools(
+    ctx: InvokeContext, kernel_version: str, always_use_gcc8: bool = False
+) -> None:
+    """Build perf, bpftool and libbpf from the tree of a kernel, or reuse the
+    cached build of the same tools/ sources"""
+    # tasks.usertools imports this module
+    from tasks.usertools import build_userspace_tools
+
+    cached = build_userspace_tools(
+        ctx, KernelVersion.from_str(ctx, kernel_version), always_use_gcc8
+    )
+    info(
+        f"[+] Tools installed below {cached}, 'inv vm.init --tools' puts them in the guest"
+    )
+
+
+@task(  # type: ignore
+    name="export",
+    help={
+        "kernel_version": "kernel version string of the form v6.8 or v5.2.20",
+        "dest": "directory or http:// URL of a package cache (see kernel.serve-cache)",
+    },
+)
+def export_package(ctx: InvokeContext, kernel_version: str, dest: str) -> None:
+    """Archive a built kernel package into a shared package cache"""
+    # tasks.archive imports this module
+    from tasks.archive import export_kernel
+
+    export_kernel(ctx, KernelVersion.from_str(ctx, kernel_version), dest)
+
+
+@task(  # type: ignore
+    name="import",
+    help={
+        "kernel_version": "kernel version string of the form v6.8 or v5.2.20",
+        "source": "directory or http:// URL of a package cache",
+        "force": "replace an existing package of the same version",
+    },
+)
+def import_package(
+    ctx: InvokeContext, kernel_version: str, source: str, force: bool = False
+) -> None:
+    """Install a kernel package exported by another host"""
+    from tasks.archive import import_kernel
+
+    import_kernel(ctx, KernelVersion.from_str(ctx, kernel_version), source, force)
+
+
+@task(  # type: ignore
+    help={
+        "directory": "directory holding the archives",
+        "host": "address to listen on",
+        "port": "port to listen on",
+    },
+)
+def serve_cache(
+    ctx: InvokeContext,
+    directory: str = "kernels/cache",
+    host: str = "127.0.0.1",
+    port: int = 8003,
+) -> None:
+    """Serve a directory of exported kernel packages over HTTP GET and PUT"""
+    from tasks.archive import serve_cache as _serve_cache
+
+    _serve_cache(Path(directory), host, port)
@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Optional
+
+from invoke.context import Context as InvokeContext
+
+from tasks.tool import info, warn
+
+# All guest subnets are /30s carved out of this range, see rootfs.IP_ADDR
+GUEST_NETWORK = "169.254.0.0/16"
+GUEST_PREFIX_LEN = 30
+TAP_PREFIX = "qemu_tap"
+BRIDGE_NAME = "kbuild-br0"
+
+# Our rules live in dedicated chains, jumped to from the builtin ones. This
+# keeps them from piling up in the builtin chains and lets cleanup remove
+# everything we installed without touching anyone else's rules.
+NAT_CHAIN = "KBUILD-POSTROUTING"
+FORWARD_CHAIN = "KBUILD-FORWARD"
+
+PROC_NET_ROUTE = Path("/proc/net/route")
+IP_FORWARD = Path("/proc/sys/net/ipv4/ip_forward")
+RTF_UP = 0x1
+
+
+def default_uplink() -> Optional[str]:
+    """Interface of the lowest metric IPv4 default route, read straight from
+    the kernel routing table. Returns None when the host has no default
+    route, e.g. when offline."""
+    try:
+        with open(PROC_NET_ROUTE, "r") as f:
+            lines = f.read().splitlines()[1:]
+    except OSError:
+        return None
+
+    best: Optional[tuple[int, str]] = None
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 8:
+            continue
+
+        iface, dest, flags, metric, mask = (
+            fields[0],
+            fields[1],
+            fields[3],
+            fields[6],
+            fields[7],
+        )
+        if dest != "00000000" or mask != "00000000" or not int(flags, 16) & RTF_UP:
+            continue
+
+        if best is None or int(metric) < best[0]:
+            best = (int(metric), iface)
+
+    return best[1] if best is not None else None
+
+
+def tap_name(slot: int) -> str:
+    return f"{TAP_PREFIX}-{slot}"
+
+
+def link_exists(name: str) -> bool:
+    return os.path.exists(f"/sys/class/net/{name}")
+
+
+def _iptables(ctx: InvokeContext, table: str, args: str, check: bool = False) -> bool:
+    res = ctx.run(f"sudo iptables -w -t {table} {args}", warn=True, hide=check)
+    return res is not None and res.ok
+
+
+def ensure_rule(ctx: InvokeContext, table: str, chain: str, rule: str) -> None:
+    """Append a rule only if an identical one is not already installed"""
+    if _iptables(ctx, table, f"-C {chain} {rule}", check=True):
+        return
+    _iptables(ctx, table, f"-A {chain} {rule}")
+
+
+def delete_rule(ctx: InvokeContext, table: str, chain: str, rule: str) -> None:
+    # also removes duplicates left behind by older versions of this tool
+    while _iptables(ctx, table, f"-C {chain} {rule}", check=True):
+        if not _iptables(ctx, table, f"-D {chain} {rule}"):
+            return
+
+
+def collapse_duplicates(ctx: InvokeContext, table: str, chain: str) -> None:
+    """Reduce repeated copies of a rule in a builtin chain to a single one"""
+    res = ctx.run(f"sudo iptables -w -t {table} -S {chain}", warn=True, hide=True)
+    if res is None or not res.ok:
+        return
+
+    seen: dict[str, int] = dict()
+    for line in res.stdout.splitlines():
+        if line.startswith(f"-A {chain} "):
+            rule = line[len(f"-A {chain} ") :]
+            seen[rule] = seen.get(rule, 0) + 1
+
+    for rule, count in seen.items():
+        for _ in range(count - 1):
+            _iptables(ctx, table, f"-D {chain} {rule}")
+
+
+def ensure_chain(ctx: InvokeContext, table: str, chain: str, parent: str) -> None:
+    if not _iptables(ctx, table, f"-n -L {chain}", check=True):
+        _iptables(ctx, table, f"-N {chain}")
+    ensure_rule(ctx, table, parent, f"-j {chain}")
+
+
+def enable_ip_forward(ctx: InvokeContext) -> None:
+    try:
+        if IP_FORWARD.read_text().strip() == "1":
+            return
+    except OSError:
+        pass
+
+    ctx.run(f"sudo sh -c 'echo 1 > {IP_FORWARD}'")
+
+
+def setup_nat(ctx: InvokeContext) -> Optional[str]:
+    """Install the single NAT rule for all guests. Returns the uplink or None
+    when the host has no default route, in which case guests only get
+    host connectivity."""
+    enable_ip_forward(ctx)
+    uplink = default_uplink()
+    if uplink is None:
+        warn("[!] No default route, guests will not have outbound network access")
+        return None
+
+    ensure_chain(ctx, "nat", NAT_CHAIN, "POSTROUTING")
+    ensure_chain(ctx, "filter", FORWARD_CHAIN, "FORWARD")
+
+    # This rule sets up NAT for traffic leaving the guest subnets through the
+    # uplink, so guests can reach the internet with the uplink's public IP.
+    ensure_rule(ctx, "nat", NAT_CHAIN, f"-s {GUEST_NETWORK} -o {uplink} -j MASQUERADE")
+    ensure_rule(
+        ctx,
+        "filter",
+        FORWARD_CHAIN,
+        "-m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT",
+    )
+    return uplink
+
+
+def forward_rule(iface: str, uplink: str) -> str:
+    return f"-i {iface} -o {uplink} -j ACCEPT"
+
+
+def ensure_bridge(ctx: InvokeContext, uplink: Optional[str]) -> None:
+    if not link_exists(BRIDGE_NAME):
+        ctx.run(f"sudo ip link add name {BRIDGE_NAME} type bridge")
+        ctx.run(f"sudo ip link set dev {BRIDGE_NAME} up")
+
+    if uplink is not None:
+        ensure_rule(ctx, "filter", FORWARD_CHAIN, forward_rule(BRIDGE_NAME, uplink))
+
+
+def create_tap(
+    ctx: InvokeContext,
+    tap_name: str,
+    gateway_ip: str,
+    queues: int = 1,
+    bridge: bool = False,
+) -> None:
+    """Create a tap for one guest. Without a bridge the tap carries the /30
+    gateway address itself. With a bridge the tap is enslaved to it and the
+    gateway address is added to the bridge, so every guest is reached through
+    one interface and one forward rule."""
+    if link_exists(tap_name):
+        ctx.run(f"sudo ip link del {tap_name}", warn=True)
+
+    # multiqueue virtio-net needs a multi_queue tap to attach its queues to
+    mq = " multi_queue" if queues > 1 else ""
+    ctx.run(f"sudo ip tuntap add {tap_name} mode tap{mq}")
+
+    uplink = setup_nat(ctx)
+    if bridge:
+        ensure_bridge(ctx, uplink)
+        ctx.run(f"sudo ip link set dev {tap_name} master {BRIDGE_NAME}")
+        ctx.run(
+            f"sudo ip addr replace {gateway_ip}/{GUEST_PREFIX_LEN} dev {BRIDGE_NAME}"
+        )
+    else:
+        ctx.run(f"sudo ip addr replace {gateway_ip}/{GUEST_PREFIX_LEN} dev {tap_name}")
+        if uplink is not None:
+            ensure_rule(ctx, "filter", FORWARD_CHAIN, forward_rule(tap_name, uplink))
+
+    ctx.run(f"sudo ip link set dev {tap_name} up")
+
+
+def teardown_tap(ctx: InvokeContext, tap_name: str, gateway_ip: Optional[str]) -> None:
+    uplink = default_uplink()
+    if uplink is not None:
+        delete_rule(ctx, "filter", FORWARD_CHAIN, forward_rule(tap_name, uplink))
+        # rules appended to the builtin chain by older versions of this tool
+        delete_rule(ctx, "filter", "FORWARD", forward_rule(tap_name, uplink))
+
+    if link_exists(tap_name):
+        ctx.run(f"sudo ip link del {tap_name}", warn=True)
+
+    if gateway_ip is not None and link_exists(BRIDGE_NAME):
+        ctx.run(
+            f"sudo ip addr del {gateway_ip}/{GUEST_PREFIX_LEN} dev {BRIDGE_NAME}",
+            warn=True,
+            hide=True,
+        )
+
+
+def all_taps() -> list[str]:
+    try:
+        return sorted(
+            [n for n in os.listdir("/sys/class/net") if n.startswith(TAP_PREFIX)]
+        )
+    except OSError:
+        return list()
+
+
+def teardown_all(ctx: InvokeContext) -> None:
+    """Remove every tap, the bridge and all iptables state installed by us"""
+    for tap in all_taps():
+        teardown_tap(ctx, tap, None)
+
+    if link_exists(BRIDGE_NAME):
+        ctx.run(f"sudo ip link del {BRIDGE_NAME}", warn=True)
+
+    for table, chain, parent in [
+        ("nat", NAT_CHAIN, "POSTROUTING"),
+        ("filter", FORWARD_CHAIN, "FORWARD"),
+    ]:
+        delete_rule(ctx, table, parent, f"-j {chain}")
+        if _iptables(ctx, table, f"-n -L {chain}", check=True):
+            _iptables(ctx, table, f"-F {chain}")
+            _iptables(ctx, table, f"-X {chain}")
+
+    # older versions appended a MASQUERADE and a conntrack rule on every
+    # init. They may be shared with other users of the host, keep one copy.
+    collapse_duplicates(ctx, "nat", "POSTROUTING")
+    collapse_duplicates(ctx, "filter", "FORWARD")
+
+    info("[+] Removed all guest taps, bridge and iptables rules")
@@ -0,0 +1,355 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from invoke.context import Context as InvokeContext
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
+
+from tasks import kernel, rootfs, vm
+from tasks.arch import Arch
+from tasks.compiler import CONTAINER_LINUX_BUILD_PATH
+from tasks.kernel import KernelBuildPaths, get_kernel_image_name
+from tasks.tool import Exit, info, warn
+from tasks.tracing import DOCKER_EXEC, Tracer, record_command, tracing_to
+
+OVERHEAD_DIR = KernelBuildPaths.kernel_sources_dir / "overhead"
+# a minor version, resolved through 'git tag' like users usually pass it
+KERNEL = "v6.8"
+FAKE_PATCH = 12
+FAKE_COMMIT = "0" * 40
+FAKE_CONTAINER = "f00dfeedf00d"
+# most commands a scenario may run before it counts as a regression. The
+# warm vm.init is the one users wait for on every boot.
+BUDGETS = {
+    "kernel.build": 30,
+    "kernel.build-gcc8": 24,
+    "rootfs.build": 32,
+    "vm.init-cold": 90,
+    "vm.init-warm": 28,
+}
+# host probes answered like on a builder with nothing running
+FAKE_PROBES = [(rootfs, "nbd_free", lambda index: True)]
+# directories of the repository the tasks read, linked into the sandbox
+SANDBOX_LINKS = [KernelBuildPaths.configs_dir, Path("./scripts")]
+CD_PREFIX = re.compile(r"^cd (\S+)$")
+# exit code and stdout of a faked command
+Answer = tuple[int, str]
+
+
+class FakeTools:
+    """Answers the commands the tasks run in place of git, make, docker and
+    everything run as root. Leaves behind the files the tasks look for
+    afterwards: worktrees, build results, disk images. Files are only
+    touched below the sandbox root."""
+
+    def __init__(self, root: Path):
+        self.root = root.absolute()
+        self.rules: list[
+            tuple[re.Pattern[str], Callable[[re.Match[str], Path], Answer]]
+        ] = [
+            (
+                re.compile(r"^(sudo )?docker ps "),
+                lambda m, cwd: (0, f"{FAKE_CONTAINER}\n"),
+            ),
+            (re.compile(r"^id -[ug]$"), lambda m, cwd: (0, "1000\n")),
+            # no rule of a tap which is being set up or torn down is installed
+            (re.compile(r"^sudo iptables .* -C "), lambda m, cwd: (1, "")),
+            (re.compile(r"^git tag .*grep 'v(\d+)\.(\d+)"), self.git_tag),
+            (
+                re.compile(r"^git (-C \S+ )?rev-parse "),
+                lambda m, cwd: (0, f"{FAKE_COMMIT}\n"),
+            ),
+            (re.compile(r"^git worktree add (\S+)$"), self.mkdir),
+            (re.compile(r"^git clone .* (\S+)$"), self.mkdir),
+            (re.compile(r"make -C (\S+) .*\b(deb-pkg|bzImage)\b"), self.make_kernel),
+            (re.compile(r"^mv (\S+) (\S+)$"), self.move),
+            (re.compile(r"^rm -r?f (\S+)$"), self.remove),
+            (re.compile(r"^qemu-img create .* (\S+)$"), self.touch),
+            (re.compile(r"^(sudo )?qemu-img convert .* (\S+)$"), self.touch),
+        ]
+
+    def host_path(self, path: str, cwd: Path) -> Optional[Path]:
+        if path.startswith(str(CONTAINER_LINUX_BUILD_PATH)):
+            path = (
+                str(KernelBuildPaths.kernel_sources_dir)
+                + path[len(str(CONTAINER_LINUX_BUILD_PATH)) :]
+            )
+        resolved = Path(os.path.normpath(cwd / path))
+        if resolved != self.root and self.root not in resolved.parents:
+            return None
+        return resolved
+
+    def git_tag(self, m: re.Match[str], cwd: Path) -> Answer:
+        return 0, f"v{m.group(1)}.{m.group(2)}.{FAKE_PATCH}\n"
+
+    def mkdir(self, m: re.Match[str], cwd: Path) -> Answer:
+        path = self.host_path(m.group(m.lastindex or 1), cwd)
+        if path is not None:
+            path.mkdir(parents=True, exist_ok=True)
+        return 0, ""
+
+    def touch(self, m: re.Match[str], cwd: Path) -> Answer:
+        path = self.host_path(m.group(m.lastindex or 1), cwd)
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        return 0, ""
+
+    def make_kernel(self, m: re.Match[str], cwd: Path) -> Answer:
+        tree = self.host_path(m.group(1), cwd)
+        if tree is None:
+            return 0, ""
+        arch = Arch.local()
+        outputs = [
+            tree / "vmlinux",
+            tree / "arch" / arch.kernel_arch / "boot" / get_kernel_image_name(arch),
+        ]
+        if m.group(2) == "deb-pkg":
+            outputs += [
+                tree.parent / f"linux-image-{FAKE_PATCH}_{arch.debarch}.deb",
+                tree.parent / f"linux-image-{FAKE_PATCH}-dbg_{arch.debarch}.deb",
+                tree.parent / f"linux-{FAKE_PATCH}.orig.tar.gz",
+            ]
+        for output in outputs:
+            output.parent.mkdir(parents=True, exist_ok=True)
+            output.touch()
+        return 0, ""
+
+    def move(self, m: re.Match[str], cwd: Path) -> Answer:
+        src, dst = self.host_path(m.group(1), cwd), self.host_path(m.group(2), cwd)
+        if src is None or dst is None or not src.exists():
+            return 0, ""
+        if dst.is_dir():
+            dst = dst / src.name
+        if dst.is_dir():
+            shutil.rmtree(dst)
+        dst.unlink(missing_ok=True)
+        shutil.move(src, dst)
+        return 0, ""
+
+    def remove(self, m: re.Match[str], cwd: Path) -> Answer:
+        path = self.host_path(m.group(1), cwd)
+        if path is None or path == self.root:
+            return 0, ""
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink(missing_ok=True)
+        return 0, ""
+
+    def __call__(self, command: str) -> Answer:
+        m = DOCKER_EXEC.search(command)
+        if m is not None:
+            command = m.group(1)
+
+        stdout = ""
+        cwd = self.root
+        for part in [p.strip() for p in command.split("&&")]:
+            cd = CD_PREFIX.match(part)
+            if cd is not None:
+                cwd = self.host_path(cd.group(1), cwd) or cwd
+                continue
+            for pattern, answer in self.rules:
+                found = pattern.search(part)
+                if found is not None:
+                    exited, out = answer(found, cwd)
+                    stdout += out
+                    if exited != 0:
+                        return exited, stdout
+                    break
+        return 0, stdout
+
+
+class RecordingContext(InvokeContext):
+    """Context whose commands are answered by FakeTools instead of being
+    run. Every command is recorded with its duration, and with its phase
+    when a tracer is installed."""
+
+    def __init__(self, tools: FakeTools):
+        super().__init__()
+        # plain attributes, anything else set on a Context goes to its config
+        commands: list[dict[str, Any]] = list()
+        self._set(tools=tools, lock=threading.Lock(), commands=commands)
+
+    def run(self, command: str, **kwargs: Any) -> Result:
+        start = time.monotonic()
+        exited, stdout = self.tools(command)
+        end = time.monotonic()
+        with self.lock:
+            self.commands.append({"command": command, "seconds": end - start})
+        record_command(command, start, end, exited)
+        result = Result(
+            stdout=stdout, command=command, exited=exited, hide=("stdout", "stderr")
+        )
+        if exited != 0 and not kwargs.get("warn", False):
+            raise UnexpectedExit(result)
+        return result
+
+    def sudo(self, command: str, **kwargs: Any) -> Result:
+        return self.run(f"sudo {command}", **kwargs)
+
+
+def program(command: str) -> str:
+    """What a command mostly costs: docker, git, make, sudo or a shell tool"""
+    m = DOCKER_EXEC.search(command)
+    if m is not None:
+        return "docker exec"
+    try:
+        words = shlex.split(command.split("&&")[-1].split("|")[0])
+    except ValueError:
+        words = command.split()
+    if len(words) > 0 and words[0] == "sudo":
+        return f"sudo {words[1]}" if len(words) > 1 else "sudo"
+    if len(words) > 1 and words[0] == "docker":
+        return f"docker {words[1]}"
+    return words[0] if len(words) > 0 else ""
+
+
+class Scenario:
+    def __init__(
+        self, name: str, run: Callable[[InvokeContext], Any], fresh: bool = False
+    ):
+        self.name = name
+        self.run = run
+        # start from an empty sandbox instead of the state left by the
+        # scenario before
+        self.fresh = fresh
+
+
+SCENARIOS = [
+    Scenario("kernel.build", lambda ctx: kernel.build(ctx, KERNEL), fresh=True),
+    Scenario(
+        "kernel.build-gcc8",
+        lambda ctx: kernel.build(ctx, KERNEL, compile_only=True, always_use_gcc8=True),
+    ),
+    Scenario("rootfs.build", lambda ctx: rootfs.build(ctx, KERNEL)),
+    Scenario("vm.init-cold", lambda ctx: vm.init(ctx, KERNEL), fresh=True),
+    Scenario("vm.init-warm", lambda ctx: vm.init(ctx, KERNEL)),
+]
+
+
+def reset_sandbox(sandbox: Path, repo: Path) -> None:
+    shutil.rmtree(sandbox, ignore_errors=True)
+    sandbox.mkdir(parents=True)
+    for link in SANDBOX_LINKS:
+        (sandbox / link).parent.mkdir(parents=True, exist_ok=True)
+        (sandbox / link).symlink_to(repo / link)
+
+
+def run_scenario(scenario: Scenario, sandbox: Path, log: Path) -> dict[str, Any]:
+    ctx = RecordingContext(FakeTools(sandbox))
+    tracer = Tracer(log.with_suffix(".json"), scenario.name)
+    error = None
+    probes = [(module, name, getattr(module, name)) for module, name, _ in FAKE_PROBES]
+    for module, name, fake in FAKE_PROBES:
+        setattr(module, name, fake)
+    start = time.monotonic()
+    try:
+        with (
+            open(log, "w") as f,
+            redirect_stdout(f),
+            redirect_stderr(f),
+            tracing_to(tracer),
+        ):
+            try:
+                scenario.run(ctx)
+            except (Exception, SystemExit) as e:
+                error = (
+                    str(e) if not isinstance(e, UnexpectedExit) else e.result.command
+                )
+    finally:
+        for module, name, probe in probes:
+            setattr(module, name, probe)
+    total = time.monotonic() - start
+
+    programs: dict[str, int] = dict()
+    for c in ctx.commands:
+        programs[program(c["command"])] = programs.get(program(c["command"]), 0) + 1
+    faked = sum([c["seconds"] for c in ctx.commands])
+    budget = BUDGETS.get(scenario.name)
+    return {
+        "scenario": scenario.name,
+        "ok": error is None and (budget is None or len(ctx.commands) <= budget),
+        "error": error,
+        "commands": len(ctx.commands),
+        "budget": budget,
+        "seconds": round(total, 3),
+        # time spent in the tasks themselves, the fakes answer in microseconds
+        "python_seconds": round(total - faked, 3),
+        "programs": dict(sorted(programs.items(), key=lambda kv: -kv[1])),
+        "phases": tracer.summary()["phases"],
+        "log": str(log),
+        "command_log": [c["command"] for c in ctx.commands],
+    }
+
+
+def overhead_report(scenarios: Optional[str], report: Optional[str]) -> None:
+    """Run the scenarios against fake tools in a scratch directory and
+    check the commands of each against its budget"""
+    selected = SCENARIOS
+    if scenarios is not None:
+        names = scenarios.split(",")
+        unknown = set(names) - {s.name for s in SCENARIOS}
+        if len(unknown) > 0:
+            raise Exit(
+                f"unknown scenarios {', '.join(sorted(unknown))}, choose from {', '.join(BUDGETS)}"
+            )
+        selected = [s for s in SCENARIOS if s.name in names]
+
+    repo = Path.cwd()
+    out_dir = (OVERHEAD_DIR / time.strftime("%Y%m%d-%H%M%S")).absolute()
+    out_dir.mkdir(parents=True)
+    sandbox = Path(tempfile.mkdtemp(prefix="kbuild-overhead-"))
+    results = list()
+    try:
+        for i, scenario in enumerate(selected):
+            if scenario.fresh or i == 0:
+                reset_sandbox(sandbox, repo)
+            os.chdir(sandbox)
+            try:
+                results.append(
+                    run_scenario(scenario, sandbox, out_dir / f"{scenario.name}.log")
+                )
+            finally:
+                os.chdir(repo)
+    finally:
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+    report_file = Path(report) if report is not None else out_dir / "report.json"
+    with open(report_file, "w") as f:
+        json.dump(
+            {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "scenarios": results},
+            f,
+            indent=4,
+        )
+
+    print(f"{'scenario':<20} {'commands':>8} {'budget':>6} {'python':>8}  top programs")
+    for r in results:
+        top = ", ".join([f"{p} {n}" for p, n in list(r["programs"].items())[:4]])
+        budget = r["budget"] if r["budget"] is not None else "-"
+        print(
+            f"{r['scenario']:<20} {r['commands']:>8} {budget:>6} {r['python_seconds']:>7.2f}s  {top}"
+        )
+    info(f"[+] Report written to {report_file}")
+
+    failed = [r for r in results if not r["ok"]]
+    for r in failed:
+        if r["error"] is not None:
+            warn(f"[!] {r['scenario']} failed: {r['error']}, see {r['log']}")
+        else:
+            warn(
+                f"[!] {r['scenario']} ran {r['commands']} commands, over its budget of {r['budget']}"
+            )
+    if len(failed) > 0:
+        raise Exit(f"{len(failed)} of {len(results)} scenarios failed")
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+from tasks.cgroups import vm_cgroup
+from tasks.guest import Guest, guest_ssh_key, launch_vm, stop_vm, vm_running, wait_ready
+from tasks.kernel import KernelVersion, get_kernel_pkg_dir, mark_used, open_registry
+from tasks.qemu import QemuConfig
+from tasks.registry import SSH_PORTS, port_free
+from tasks.tool import Exit, info, warn
+from tasks.vm import BOOT_TIMEOUT, boot_kernel_cmdline
+
+# Instances reach the host through qemu user networking, the guest sees its
+# usual address and gateway and sshd is forwarded to a port on localhost
+FORWARD_HOST = "127.0.0.1"
+
+
+class VmInstance:
+    def __init__(self, index: int, instance_dir: Path, guest: Guest):
+        self.index = index
+        self.instance_dir = instance_dir
+        self.guest = guest
+        self.proc: Optional[subprocess.Popen[bytes]] = None
+        self.boots = 0
+
+    @property
+    def name(self) -> str:
+        return self.guest.name
+
+    @property
+    def console_log(self) -> Path:
+        return self.instance_dir / "console.log"
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+
+class VmPool:
+    """Instances of one initialized kernel package, booted with -snapshot on
+    its overlay so they can run side by side and a crashed one is replaced
+    by a clean boot. Every instance leases an ssh port, owned by a directory
+    pool-<n> of the package while this process is alive."""
+
+    def __init__(
+        self,
+        kversion: KernelVersion,
+        kernel_image: Path,
+        size: int,
+        cpus: int,
+        memory: str,
+        append: str = "",
+        snapshot: bool = True,
+    ):
+        self.kversion = kversion
+        self.pkg_dir = get_kernel_pkg_dir(kversion)
+        self.kernel_image = kernel_image
+        self.size = size
+        self.cpus = cpus
+        self.memory = memory
+        self.append = append
+        self.snapshot = snapshot
+        self.instances: list[VmInstance] = list()
+
+        manifest_file = self.pkg_dir / "kernel.manifest"
+        if not manifest_file.exists():
+            raise Exit(f"kernel {kversion} is not initialized, run vm.init first")
+        with open(manifest_file, "r") as f:
+            self.manifest = json.load(f)
+        if vm_running(self.pkg_dir / "vm.pid"):
+            raise Exit(
+                f"VM of kernel {kversion} is running, stop it before starting a pool"
+            )
+
+    def _owner(self, index: int) -> str:
+        return f"{self.pkg_dir.name}/pool-{index}"
+
+    def _lease(self, index: int) -> VmInstance:
+        instance_dir = self.pkg_dir / f"pool-{index}"
+        instance_dir.mkdir(parents=True, exist_ok=True)
+        with open_registry() as registry:
+            port = registry.allocate(
+                SSH_PORTS, self._owner(index), pid=os.getpid(), accept=port_free
+            )
+
+        ssh_key = guest_ssh_key(self.pkg_dir, self.manifest)
+        guest = Guest(f"pool-{index}", FORWARD_HOST, ssh_key, port=port)
+        return VmInstance(index, instance_dir, guest)
+
+    def _boot(self, instance: VmInstance) -> None:
+        qemu_config = QemuConfig(
+            kernel_image=self.kernel_image,
+            kernel_cmdline=boot_kernel_cmdline(False, self.append),
+            rootfs_path=self.pkg_dir / "overlay.qcow2",
+            tap_interface="",
+            gdb_port=0,
+            memory=self.memory,
+            cpus=self.cpus,
+            pidfile=instance.instance_dir / "vm.pid",
+            name=f"{self.pkg_dir.name}-pool-{instance.index}",
+            console_log=instance.console_log,
+            snapshot=self.snapshot,
+            interactive=False,
+            ssh_forward=(self.manifest["guest_ip"], instance.guest.port),
+            cgroup=vm_cgroup(f"{self.pkg_dir.name}-pool-{instance.index}"),
+            # instances boot the same kernel and disk, KSM merges most of them
+            balloon=True,
+        )
+        instance.console_log.unlink(missing_ok=True)
+        instance.guest.close_master()
+        instance.proc = launch_vm(qemu_config, instance.instance_dir / "qemu.log")
+        instance.boots += 1
+
+    def _wait(self, instances: list[VmInstance]) -> None:
+        results = wait_ready([i.guest for i in instances], BOOT_TIMEOUT)
+        failed = [r.guest.name for r in results if not r.ok]
+        if len(failed) > 0:
+            raise Exit(
+                f"{', '.join(failed)} of {self.kversion} not ssh-ready after {BOOT_TIMEOUT}s, "
+                f"see console.log in {self.pkg_dir}/pool-<n>"
+            )
+
+    def start(self) -> list[VmInstance]:
+        """Boot all instances at once and wait until each accepts ssh"""
+        self.instances = [self._lease(i) for i in range(self.size)]
+        mark_used(self.kversion)
+        for instance in self.instances:
+            self._boot(instance)
+        self._wait(self.instances)
+        info(f"[+] {self.size} instances of {self.kversion} ready")
+        return self.instances
+
+    def replace(self, instance: VmInstance) -> None:
+        """Stop an instance which crashed or hung and boot it again from the
+        unmodified overlay, keeping its port. The console of the lost
+        instance is kept as console.log.<boot>."""
+        if instance.proc is not None:
+            stop_vm(instance.proc, timeout=1.0, guest=instance.guest)
+        if instance.console_log.exists():
+            shutil.copyfile(
+                instance.console_log,
+                instance.instance_dir / f"console.log.{instance.boots}",
+            )
+
+        warn(f"[!] Replacing {instance.name} of {self.kversion}")
+        self._boot(instance)
+        self._wait([instance])
+
+    def close(self) -> None:
+        for instance in self.instances:
+            if instance.proc is not None:
+                stop_vm(instance.proc, guest=instance.guest)
+
+        with open_registry() as registry:
+            for instance in self.instances:
+                registry.release(SSH_PORTS, self._owner(instance.index))
+        self.instances = list()
+
+    def __enter__(self) -> list[VmInstance]:
+        try:
+            return self.start()
+        except BaseException:
+            self.close()
+            raise
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
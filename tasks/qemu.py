@@ -1,49 +1,424 @@
+from __future__ import annotations
+
+import shlex
 from pathlib import Path
+from typing import Optional
+
+from tasks.tool import Exit
+
+QEMU_BINARY = "qemu-system-x86_64"
+GUEST_MAC = "52:55:00:d1:55:01"
+
+PROFILE_DEFAULT = "default"
+PROFILE_PERF = "perf"
+QEMU_PROFILES = [PROFILE_DEFAULT, PROFILE_PERF]
+
+HUGEPAGES_MOUNT = Path("/dev/hugepages")
+EPHEMERAL_DIR = Path("/dev/shm")
+DEFAULT_EPHEMERAL_SIZE = "4G"
+KSM_DIR = Path("/sys/kernel/mm/ksm")
+# pages merged per wake up of ksmd, every 20ms by default. The kernel
+# default of 100 takes minutes to merge a single idle guest.
+KSM_PAGES_TO_SCAN = 1000
+
+# microvm has no PCI bus, firmware option roms or legacy PC devices to probe.
+# Devices are virtio-mmio and qemu appends their virtio_mmio.device= params.
+MICROVM_MACHINE = (
+    "microvm,x-option-roms=off,pit=off,pic=off,isa-serial=off,rtc=off,acpi=off"
+)
+
+
+def parse_cpu_list(cpus: str) -> list[int]:
+    """Expand a cpu list of the form '2-5,8' into [2, 3, 4, 5, 8]."""
+    result: list[int] = list()
+    for part in cpus.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            result.extend(range(int(start), int(end) + 1))
+        else:
+            result.append(int(part))
+
+    if len(result) == 0:
+        raise Exit(f"invalid cpu list '{cpus}'")
+
+    return result
+
+
+def net_queues(profile: str, cpus: int) -> int:
+    # the perf profile gives every vCPU its own virtio-net queue pair
+    if profile == PROFILE_PERF:
+        return cpus
+    return 1
+
+
+def qemu_props(name: str, props: dict[str, str | int]) -> str:
+    """Format a device/object description, e.g. virtio-net-pci,mq=on,vectors=10"""
+    return ",".join([name] + [f"{k}={v}" for k, v in props.items()])
+
+
+class QemuCommand:
+    """Accumulates a qemu argv. Every option is a separate argv element so
+    nothing depends on shell line joining."""
+
+    def __init__(self, binary: str = QEMU_BINARY):
+        self.argv: list[str] = [binary]
+
+    def flag(self, name: str) -> QemuCommand:
+        self.argv.append(name)
+        return self
+
+    def option(self, name: str, value: str) -> QemuCommand:
+        self.argv.extend([name, value])
+        return self
+
+    def render(self) -> str:
+        return shlex.join(self.argv)
+
+
+class QemuConfig:
+    def __init__(
+        self,
+        kernel_image: Path,
+        kernel_cmdline: str,
+        rootfs_path: Path,
+        tap_interface: str,
+        gdb_port: int,
+        memory: str,
+        cpus: int,
+        pidfile: Path,
+        wait_for_gdb: bool = False,
+        profile: str = PROFILE_DEFAULT,
+        hugepages: bool = False,
+        pin_cpus: Optional[str] = None,
+        name: str = "kernel-build",
+        fast_boot: bool = False,
+        console_log: Optional[Path] = None,
+        snapshot: bool = False,
+        interactive: bool = True,
+        ephemeral_size: Optional[str] = None,
+        ssh_forward: Optional[tuple[str, int]] = None,
+        cgroup: Optional[Path] = None,
+        balloon: bool = False,
+    ):
+        if profile not in QEMU_PROFILES:
+            raise Exit(
+                f"unknown qemu profile '{profile}', expected one of {QEMU_PROFILES}"
+            )
+
+        self.kernel_image = kernel_image
+        self.kernel_cmdline = kernel_cmdline
+        self.rootfs_path = rootfs_path
+        self.tap_interface = tap_interface
+        self.gdb_port = gdb_port
+        self.memory = memory
+        self.cpus = cpus
+        self.pidfile = pidfile
+        self.wait_for_gdb = wait_for_gdb
+        self.profile = profile
+        self.hugepages = hugepages
+        self.pin_cpus = pin_cpus
+        self.name = name
+        self.fast_boot = fast_boot
+        self.console_log = console_log
+        self.snapshot = snapshot
+        self.interactive = interactive
+        self.ephemeral_size = ephemeral_size
+        # guest ip and host port: user mode networking instead of the tap,
+        # with the host port forwarded to sshd in the guest
+        self.ssh_forward = ssh_forward
+        # see tasks/cgroups.py
+        self.cgroup = cgroup
+        self.balloon = balloon
+
+        if fast_boot and console_log is None:
+            raise Exit("fast boot requires a console log file for the virtio console")
+        if balloon and hugepages:
+            raise Exit(
+                "hugepages are preallocated and never returned, they cannot be used with the balloon"
+            )
+
+    @property
+    def ephemeral(self) -> bool:
+        return self.ephemeral_size is not None
+
+    @property
+    def disk_path(self) -> Path:
+        """The image qemu writes to. An ephemeral run writes to a throwaway
+        overlay in RAM, backed by the persistent overlay at rootfs_path."""
+        if self.ephemeral:
+            return EPHEMERAL_DIR / f"kbuild-{self.name}.qcow2"
+        return self.rootfs_path.absolute()
+
+    def virtio_device(self, kind: str) -> str:
+        if self.fast_boot:
+            return f"virtio-{kind}-device"
+        return f"virtio-{kind}-pci"
+
+    @property
+    def net_queues(self) -> int:
+        return net_queues(self.profile, self.cpus)
+
+
+def _add_user_network(
+    cmd: QemuCommand, config: QemuConfig, guest_ip: str, port: int
+) -> None:
+    # The guest keeps the static address and gateway configured in its
+    # overlay, slirp answers as that gateway. Every instance has a private
+    # network, so instances of one kernel can share the guest address.
+    prefix = guest_ip.rsplit(".", 1)[0]
+    netdev: dict[str, str | int] = {
+        "id": "mynet0",
+        "net": f"{prefix}.0/24",
+        "host": f"{prefix}.1",
+        "hostfwd": f"tcp:127.0.0.1:{port}-{guest_ip}:22",
+    }
+    cmd.option("-netdev", qemu_props("user", netdev))
+    cmd.option(
+        "-device",
+        qemu_props(config.virtio_device("net"), {"netdev": "mynet0", "mac": GUEST_MAC}),
+    )
+
+
+def _add_network(cmd: QemuCommand, config: QemuConfig) -> None:
+    if config.ssh_forward is not None:
+        _add_user_network(cmd, config, *config.ssh_forward)
+        return
 
-QEMU_CMDLINE_TEMPLATE = """
-exec qemu-system-x86_64 \
-    -gdb tcp:127.0.0.1:{gdb_port} \
-    -smp {cpus},sockets=4,cores=1,threads=1 \
-    -m {memory} \
-    -cpu host \
-    -kernel {kernel_image} \
-    -append "{kernel_cmdline}"
-    -drive file={rootfs_path},format=qcow2,if=virtio \
-    -netdev tap,id=mynet0,ifname={tap_interface},vhost=on,script=no,downscript=no \
-    -device virtio-net-pci,mq=on,vectors=10,netdev=mynet0,mac=52:55:00:d1:55:01 \
-    -enable-kvm \
-    -nographic \
-    -pidfile vm.pid
-    -no-reboot \
-    -no-acpi \
-    {extra_qemu_args} \
-    2>&1 | tee vm.log
+    netdev: dict[str, str | int] = {
+        "id": "mynet0",
+        "ifname": config.tap_interface,
+        "vhost": "on",
+        "script": "no",
+        "downscript": "no",
+    }
+    device: dict[str, str | int] = {"netdev": "mynet0", "mac": GUEST_MAC}
+
+    queues = config.net_queues
+    if queues > 1:
+        netdev["queues"] = queues
+        device["mq"] = "on"
+        if not config.fast_boot:
+            # one rx/tx pair per queue, plus config and control vectors
+            device["vectors"] = 2 * queues + 2
+
+    cmd.option("-netdev", qemu_props("tap", netdev))
+    cmd.option("-device", qemu_props(config.virtio_device("net"), device))
+
+
+def _add_rootfs(cmd: QemuCommand, config: QemuConfig) -> None:
+    rootfs = config.disk_path.as_posix()
+    drive: dict[str, str | int] = {"format": "qcow2"}
+    if config.ephemeral:
+        # the data is thrown away on exit, flushes to tmpfs buy nothing
+        drive["cache"] = "unsafe"
+
+    if config.profile != PROFILE_PERF and not config.fast_boot:
+        drive["if"] = "virtio"
+        cmd.option("-drive", qemu_props(f"file={rootfs}", drive))
+        return
+
+    drive.update({"if": "none", "id": "rootdisk"})
+    device: dict[str, str | int] = {"drive": "rootdisk"}
+    if config.profile == PROFILE_PERF:
+        cmd.option("-object", "iothread,id=iothread0")
+        drive.update({"aio": "io_uring", "discard": "unmap"})
+        # cache=none needs O_DIRECT, which tmpfs lacks, so ephemeral disks
+        # keep cache=unsafe
+        drive.setdefault("cache", "none")
+        device.update({"iothread": "iothread0", "num-queues": config.cpus})
+
+    cmd.option("-drive", qemu_props(f"file={rootfs}", drive))
+    cmd.option("-device", qemu_props(config.virtio_device("blk"), device))
+
+
+def _add_memory(cmd: QemuCommand, config: QemuConfig) -> None:
+    cmd.option("-m", config.memory)
+    if not config.hugepages:
+        return
+
+    cmd.option(
+        "-object",
+        qemu_props(
+            "memory-backend-file",
+            {
+                "id": "mem0",
+                "size": config.memory,
+                "mem-path": HUGEPAGES_MOUNT.as_posix(),
+                "prealloc": "on",
+                "share": "on",
+            },
+        ),
+    )
+    cmd.option("-numa", "node,memdev=mem0")
+
+
+def _add_balloon(cmd: QemuCommand, config: QemuConfig) -> None:
+    # The guest hands pages it freed back to the host, which drops them.
+    # Guest memory is mergeable by default (mem-merge), KSM only has to run.
+    cmd.option(
+        "-device",
+        qemu_props(
+            config.virtio_device("balloon"),
+            {"id": "balloon0", "free-page-reporting": "on", "deflate-on-oom": "on"},
+        ),
+    )
+
+
+def _add_console(cmd: QemuCommand, config: QemuConfig) -> None:
+    if config.fast_boot and config.console_log is not None:
+        # kernel and getty output go to a virtio console backed by a file,
+        # instead of being clocked out of an emulated 115200 baud uart
+        cmd.option(
+            "-chardev",
+            f"file,id=console0,path={config.console_log.absolute().as_posix()}",
+        )
+        cmd.option("-device", "virtio-serial-device")
+        cmd.option("-device", "virtconsole,chardev=console0")
+
+    if config.interactive:
+        cmd.flag("-nographic")
+        return
+
+    cmd.option("-display", "none")
+    cmd.option("-monitor", "none")
+    if not config.fast_boot:
+        if config.console_log is not None:
+            cmd.option("-serial", f"file:{config.console_log.absolute().as_posix()}")
+        else:
+            cmd.option("-serial", "none")
+
+
+def build_qemu_command(config: QemuConfig) -> QemuCommand:
+    cmd = QemuCommand()
+    if config.fast_boot:
+        cmd.option("-M", MICROVM_MACHINE)
+        cmd.flag("-nodefaults")
+        cmd.flag("-no-user-config")
+    # debug-threads names vCPU threads 'CPU <n>/KVM' so they can be pinned
+    cmd.option("-name", f"{config.name},debug-threads=on")
+    if config.gdb_port > 0:
+        cmd.option("-gdb", f"tcp:127.0.0.1:{config.gdb_port}")
+    cmd.option("-smp", f"{config.cpus},sockets=1,cores={config.cpus},threads=1")
+    _add_memory(cmd, config)
+    cmd.option("-cpu", "host")
+    cmd.option("-kernel", config.kernel_image.absolute().as_posix())
+    cmd.option("-append", config.kernel_cmdline)
+    _add_rootfs(cmd, config)
+    _add_network(cmd, config)
+    if config.balloon:
+        _add_balloon(cmd, config)
+    _add_console(cmd, config)
+    cmd.flag("-enable-kvm")
+    cmd.option("-pidfile", config.pidfile.absolute().as_posix())
+    cmd.flag("-no-reboot")
+    if not config.fast_boot:
+        cmd.flag("-no-acpi")
+    if config.snapshot:
+        # writes go to a temporary file and are discarded on exit
+        cmd.flag("-snapshot")
+    if config.wait_for_gdb:
+        cmd.flag("-S")
+
+    return cmd
+
+
+# Runs in the background of run.sh. Waits for qemu to create its vCPU threads
+# and pins vCPU n to the n-th cpu of the requested host cpu list.
+PIN_VCPUS_TEMPLATE = """
+pin_vcpus() {{
+    local host_cpus=({host_cpus})
+    local pid="" pinned=0 comm name idx tid
+    for _ in $(seq 100); do
+        [ -s "{pidfile}" ] && pid=$(cat "{pidfile}") && break
+        sleep 0.1
+    done
+    [ -z "$pid" ] && return
+    for _ in $(seq 100); do
+        pinned=0
+        for comm in /proc/$pid/task/*/comm; do
+            name=$(cat "$comm" 2>/dev/null)
+            case "$name" in
+                "CPU "*"/KVM")
+                    idx=${{name#CPU }}
+                    idx=${{idx%/KVM}}
+                    tid=$(basename "$(dirname "$comm")")
+                    taskset -pc "${{host_cpus[$((idx % ${{#host_cpus[@]}}))]}}" "$tid" > /dev/null
+                    pinned=$((pinned + 1))
+                    ;;
+            esac
+        done
+        [ "$pinned" -ge {cpus} ] && return
+        sleep 0.1
+    done
+}}
+pin_vcpus &
+"""
+
+
+# Places run.sh, and qemu started by it, in the cgroup of the VM
+VM_CGROUP_TEMPLATE = """
+sudo mkdir -p {cgroup}
+echo $$ | sudo tee {cgroup}/cgroup.procs > /dev/null
+"""
+
+
+# KSM only scans memory while it runs, it is off after every host boot
+KSM_TEMPLATE = """
+[ "$(cat {ksm}/run)" = 1 ] || echo 1 | sudo tee {ksm}/run > /dev/null
+[ "$(cat {ksm}/pages_to_scan)" -ge {pages} ] || echo {pages} | sudo tee {ksm}/pages_to_scan > /dev/null
 """
 
 
-# -append "console=ttyS0 acpi=off panic=-1 root=/dev/vda rw net.ifnames=0 reboot=t nokaslr" \
-def generate_qemu_cmdline(
-    rootfs_path: Path,
-    kernel_image: Path,
-    kernel_cmdline: str,
-    tap_interface: str,
-    gdb_port: int,
-    wait_for_gdb: bool,
-    memory: str,
-    cpus: int,
-) -> str:
-    extra_qemu_args = []
-    if wait_for_gdb:
-        extra_qemu_args.append("-S")
-
-    cmdline = QEMU_CMDLINE_TEMPLATE.format(
-        rootfs_path=rootfs_path.absolute().as_posix(),
-        kernel_image=kernel_image.absolute().as_posix(),
-        tap_interface=tap_interface,
-        gdb_port=gdb_port,
-        kernel_cmdline=kernel_cmdline,
-        memory=memory,
-        cpus=cpus,
-        extra_qemu_args=' '.join(extra_qemu_args),
+# Creates the throwaway overlay in RAM and removes it when the VM exits. The
+# size guard refuses to start when tmpfs cannot hold the requested amount of
+# guest writes.
+EPHEMERAL_TEMPLATE = """
+EPHEMERAL={overlay}
+need=$(numfmt --from=iec {size})
+avail=$(df --output=avail -B1 {tmpdir} | tail -1)
+if [ "$avail" -lt "$need" ]; then
+    echo "only $(numfmt --to=iec $avail) free in {tmpdir}, {size} needed for the ephemeral overlay" >&2
+    exit 1
+fi
+trap 'rm -f "$EPHEMERAL"' EXIT
+qemu-img create -q -f qcow2 -F qcow2 -b {backing} "$EPHEMERAL" || exit 1
+"""
+
+
+def generate_run_script(config: QemuConfig, log_file: Path) -> str:
+    lines = ["#!/bin/bash"]
+    if config.cgroup is not None:
+        lines.append(
+            VM_CGROUP_TEMPLATE.format(cgroup=shlex.quote(config.cgroup.as_posix()))
+        )
+    if config.ephemeral_size is not None:
+        lines.append(
+            EPHEMERAL_TEMPLATE.format(
+                overlay=shlex.quote(config.disk_path.as_posix()),
+                size=shlex.quote(config.ephemeral_size),
+                tmpdir=EPHEMERAL_DIR.as_posix(),
+                backing=shlex.quote(config.rootfs_path.absolute().as_posix()),
+            )
+        )
+    if config.balloon:
+        lines.append(
+            KSM_TEMPLATE.format(ksm=KSM_DIR.as_posix(), pages=KSM_PAGES_TO_SCAN)
+        )
+    if config.pin_cpus is not None:
+        host_cpus = parse_cpu_list(config.pin_cpus)
+        lines.append(
+            PIN_VCPUS_TEMPLATE.format(
+                host_cpus=" ".join([str(c) for c in host_cpus]),
+                pidfile=config.pidfile.absolute().as_posix(),
+                cpus=config.cpus,
+            )
+        )
+
+    cmd = build_qemu_command(config)
+    lines.append(
+        f"{cmd.render()} 2>&1 | tee {shlex.quote(log_file.absolute().as_posix())}"
     )
-    return ' '.join(cmdline.split('\n'))
+    return "\n".join(lines) + "\n"
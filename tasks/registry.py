@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from tasks.tool import Exit
+
+# Every host resource a VM needs is a numbered slot in one of these pools
+GDB_PORTS = "gdb_port"
+SUBNETS = "subnet"
+TAPS = "tap"
+NBD_DEVICES = "nbd"
+# host ports forwarded to sshd of the instances of a VM pool, see tasks/pool.py
+SSH_PORTS = "ssh_port"
+
+POOLS = {
+    GDB_PORTS: range(5432, 6432),
+    SUBNETS: range(0, 256),
+    TAPS: range(1, 100),
+    NBD_DEVICES: range(0, 16),
+    SSH_PORTS: range(10022, 10122),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slots (
+    kind TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    owner TEXT,
+    pid INTEGER,
+    updated REAL,
+    PRIMARY KEY (kind, slot)
+);
+CREATE INDEX IF NOT EXISTS slots_by_owner ON slots (kind, owner, slot);
+CREATE TABLE IF NOT EXISTS kernels (
+    owner TEXT PRIMARY KEY,
+    kid TEXT UNIQUE NOT NULL,
+    updated REAL
+);
+"""
+
+
+def pid_alive(pid: int) -> bool:
+    return Path(f"/proc/{pid}").exists()
+
+
+class Registry:
+    """On-disk registry of allocatable resources, shared by every invocation
+    on the host. Leases are owned by a kernel package directory name and can
+    optionally be tied to a process, e.g. for the duration of an nbd mount.
+
+    Allocations run in an IMMEDIATE transaction, so concurrent inits are
+    serialized on the database lock and can never be handed the same slot."""
+
+    def __init__(self, path: Path, owners_dir: Path):
+        self.path = path
+        self.owners_dir = owners_dir
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._seed()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _seed(self) -> None:
+        with self.transaction() as db:
+            for kind, pool in POOLS.items():
+                (count,) = db.execute(
+                    "SELECT COUNT(*) FROM slots WHERE kind = ?", (kind,)
+                ).fetchone()
+                if count == len(pool):
+                    continue
+                db.executemany(
+                    "INSERT OR IGNORE INTO slots (kind, slot) VALUES (?, ?)",
+                    [(kind, slot) for slot in pool],
+                )
+
+    def lease(self, kind: str, owner: str) -> Optional[int]:
+        row = self.conn.execute(
+            "SELECT slot FROM slots WHERE kind = ? AND owner = ?", (kind, owner)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def allocate(
+        self,
+        kind: str,
+        owner: str,
+        pid: Optional[int] = None,
+        accept: Optional[Callable[[int], bool]] = None,
+    ) -> int:
+        """Return the slot leased to owner, or lease it the lowest free slot.
+        accept can veto slots that are busy outside of our control, e.g. a
+        port or an interface some other program is using."""
+        with self.transaction() as db:
+            row = db.execute(
+                "SELECT slot FROM slots WHERE kind = ? AND owner = ?", (kind, owner)
+            ).fetchone()
+            if row is not None:
+                return int(row[0])
+
+            for attempt in range(2):
+                free = db.execute(
+                    "SELECT slot FROM slots WHERE kind = ? AND owner IS NULL ORDER BY slot",
+                    (kind,),
+                )
+                for (slot,) in free:
+                    if accept is not None and not accept(slot):
+                        continue
+                    db.execute(
+                        "UPDATE slots SET owner = ?, pid = ?, updated = ? WHERE kind = ? AND slot = ?",
+                        (owner, pid, time.time(), kind, slot),
+                    )
+                    return int(slot)
+
+                if attempt == 0:
+                    self._reap(db)
+
+        raise Exit(f"no free {kind} available, all {len(POOLS[kind])} are leased")
+
+    def claim(self, kind: str, owner: str, slot: int) -> bool:
+        """Record an existing allocation, used to import old manifests"""
+        with self.transaction() as db:
+            cur = db.execute(
+                "UPDATE slots SET owner = ?, updated = ? WHERE kind = ? AND slot = ? AND (owner IS NULL OR owner = ?)",
+                (owner, time.time(), kind, slot, owner),
+            )
+            return cur.rowcount == 1
+
+    def release(self, kind: str, owner: str) -> None:
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE slots SET owner = NULL, pid = NULL, updated = ? WHERE kind = ? AND owner = ?",
+                (time.time(), kind, owner),
+            )
+
+    def release_owner(self, owner: str) -> None:
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE slots SET owner = NULL, pid = NULL, updated = ? WHERE owner = ?",
+                (time.time(), owner),
+            )
+            db.execute("DELETE FROM kernels WHERE owner = ?", (owner,))
+
+    def leases(self, kind: str) -> dict[int, str]:
+        rows = self.conn.execute(
+            "SELECT slot, owner FROM slots WHERE kind = ? AND owner IS NOT NULL ORDER BY slot",
+            (kind,),
+        )
+        return {int(slot): str(owner) for slot, owner in rows}
+
+    def register_kernel(self, owner: str, kid: str) -> None:
+        with self.transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO kernels (owner, kid, updated) VALUES (?, ?, ?)",
+                (owner, kid, time.time()),
+            )
+
+    def kernels(self) -> dict[str, str]:
+        return {
+            str(o): str(k)
+            for o, k in self.conn.execute("SELECT owner, kid FROM kernels")
+        }
+
+    def _stale(self, owner: str, pid: Optional[int]) -> bool:
+        if pid is not None and not pid_alive(pid):
+            return True
+        return not (self.owners_dir / owner).is_dir()
+
+    def _reap(self, db: sqlite3.Connection) -> int:
+        stale = [
+            (kind, slot)
+            for kind, slot, owner, pid in db.execute(
+                "SELECT kind, slot, owner, pid FROM slots WHERE owner IS NOT NULL"
+            )
+            if self._stale(owner, pid)
+        ]
+        db.executemany(
+            "UPDATE slots SET owner = NULL, pid = NULL WHERE kind = ? AND slot = ?",
+            stale,
+        )
+        gone = [
+            (owner,)
+            for (owner,) in db.execute("SELECT owner FROM kernels")
+            if not (self.owners_dir / owner).is_dir()
+        ]
+        db.executemany("DELETE FROM kernels WHERE owner = ?", gone)
+        return len(stale) + len(gone)
+
+    def reap(self) -> int:
+        """Release leases whose kernel package is gone or whose process died"""
+        with self.transaction() as db:
+            return self._reap(db)
+
+
+def port_free(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(("127.0.0.1", port))
+        except OSError:
+            return False
+    return True
+
+
+def nbd_free(index: int) -> bool:
+    # the pid attribute only exists while the device is connected
+    return Path(f"/dev/nbd{index}").exists() and not os.path.exists(
+        f"/sys/block/nbd{index}/pid"
+    )
@@ -11,11 +11,17 @@ from typing import Optional
 from tasks.kernel import (
     KernelVersion,
     KernelManifest,
-    KernelBuildPaths,
     get_kernel_pkg_dir,
+    open_registry,
 )
+from tasks.registry import NBD_DEVICES, SUBNETS, nbd_free
 from tasks.arch import Arch
+from tasks.cgroups import build_cgroup
+from tasks.guest import SSH_MULTIPLEX_OPTIONS
+from tasks.debuginfod import guest_debuginfod_url
 from tasks.tool import info
+from tasks.tracing import phase, set_kernel
+from tasks.usertools import install_userspace_tools
 
 DEBIAN_SOURCE_LISTS = """
 deb http://deb.debian.org/debian bullseye main
@@ -56,13 +62,19 @@ def add_repos(ctx: InvokeContext, root: Path) -> None:
 # These include the headers the debug build of the kernel, etc.
 # Check the ./kernels/sources/kernel-[version] directory for all of them
 def install_deb_packages(
-    ctx: InvokeContext, kernel_version: KernelVersion, root: Path
+    ctx: InvokeContext,
+    kernel_version: KernelVersion,
+    root: Path,
+    skip_debug: bool = False,
 ) -> None:
     pkg_dir = get_kernel_pkg_dir(kernel_version)
     if not pkg_dir.exists():
         raise Exit(f"package dir for version {kernel_version} does not exist")
 
     deb_files = glob.glob(f"{pkg_dir}/linux-image*.deb")
+    if skip_debug:
+        # symbols are served by the host symbol server, see tasks/debuginfod.py
+        deb_files = [d for d in deb_files if "-dbg" not in os.path.basename(d)]
     scratch = pkg_dir / "scratch"
 
     # We do not use dpkg-deb -x directly because the root filesystem has
@@ -78,18 +90,6 @@ def install_deb_packages(
         ctx.run(f"rm -rf {scratch}")
 
 
-def all_guest_gateways() -> list[str]:
-    all_kernels = glob.glob(f"{KernelBuildPaths.kernel_sources_dir}/kernel-*")
-    tap_ips = list()
-    for k in all_kernels:
-        with open(os.path.join(k, "kernel.manifest"), "r") as f:
-            manifest = json.load(f)
-            if "gateway_ip" in manifest:
-                tap_ips.append(manifest["gateway_ip"])
-
-    return tap_ips
-
-
 def interface_ips() -> list[str]:
     interfaces = netifaces.interfaces()
     ips = list()
@@ -104,18 +104,14 @@ def interface_ips() -> list[str]:
     return ips
 
 
-def find_tap_ip() -> tuple[str, int]:
-    taken_ips = all_guest_gateways()
+def find_tap_ip(owner: str) -> tuple[str, int]:
     up_interfaces = interface_ips()
+    with open_registry() as registry:
+        subnet = registry.allocate(
+            SUBNETS, owner, accept=lambda i: IP_ADDR % i not in up_interfaces
+        )
 
-    for i in range(0, 256):
-        tap_ip = IP_ADDR % i
-        if tap_ip in taken_ips or tap_ip in up_interfaces:
-            continue
-
-        return tap_ip, i
-
-    raise Exit(f"no IP available in range {IP_ADDR % 0}/24")
+    return IP_ADDR % subnet, subnet
 
 
 def run_script(ctx: InvokeContext, script: str) -> None:
@@ -135,7 +131,7 @@ def setup_guest_network(
     root: Path,
 ) -> tuple[str, str]:
     kernel_dir = get_kernel_pkg_dir(version)
-    tap_ip, subnet = find_tap_ip()
+    tap_ip, subnet = find_tap_ip(kernel_dir.name)
     guest_ip = GUEST_ADDR % subnet
 
     setup_guest_network = f"""
@@ -145,9 +141,9 @@ rm {kernel_dir}/vm-{kuuid}.id_rsa*
 ssh-keygen -f {kernel_dir}/vm-{kuuid}.id_rsa -t rsa -N ''
 sudo mkdir -p {root}/root/.ssh/
 cat {kernel_dir}/vm-{kuuid}.id_rsa.pub | sudo tee -a {root}/root/.ssh/authorized_keys
-echo 'ssh -o StrictHostKeyChecking=false -o ServerAliveInterval=100000 root@{guest_ip} -i {kernel_dir.absolute()}/vm-{kuuid}.id_rsa' > {kernel_dir}/ssh_connect
+echo 'ssh -o StrictHostKeyChecking=false -o ServerAliveInterval=100000 {SSH_MULTIPLEX_OPTIONS} root@{guest_ip} -i {kernel_dir.absolute()}/vm-{kuuid}.id_rsa' > {kernel_dir}/ssh_connect
 chmod +x {kernel_dir}/ssh_connect
-echo 'ssh -o StrictHostKeyChecking=false root@{guest_ip} -i {kernel_dir.absolute()}/vm-{kuuid}.id_rsa \"reboot\"' > {kernel_dir}/ssh_shutdown
+echo 'ssh -o StrictHostKeyChecking=false {SSH_MULTIPLEX_OPTIONS} root@{guest_ip} -i {kernel_dir.absolute()}/vm-{kuuid}.id_rsa \"reboot\"' > {kernel_dir}/ssh_shutdown
 chmod +x {kernel_dir}/ssh_shutdown
 """
     run_script(ctx, setup_guest_network)
@@ -155,11 +151,24 @@ chmod +x {kernel_dir}/ssh_shutdown
     return tap_ip, guest_ip
 
 
+def setup_guest_debuginfod(ctx: InvokeContext, root: Path, gateway_ip: str) -> None:
+    url = guest_debuginfod_url(gateway_ip)
+    setup_debuginfod = f"""
+#!/bin/bash
+sudo sed -i '/^DEBUGINFOD_URLS=/d' {root}/etc/environment
+echo 'DEBUGINFOD_URLS={url}' | sudo tee -a {root}/etc/environment
+echo 'export DEBUGINFOD_URLS={url}' | sudo tee {root}/etc/profile.d/debuginfod.sh
+"""
+    run_script(ctx, setup_debuginfod)
+
+
 def setup_dev_env(
     ctx: InvokeContext,
     kernel_version: KernelVersion,
     manifest: KernelManifest,
     init: bool = True,
+    debuginfod: bool = False,
+    tools: bool = False,
 ) -> KernelManifest:
     if not kernel_version:
         raise Exit("no kernel version provided")
@@ -167,11 +176,22 @@ def setup_dev_env(
     # export overlay over nbd as a block device
     overlay = get_kernel_pkg_dir(kernel_version) / "overlay.qcow2"
     overlay_mount = get_kernel_pkg_dir(kernel_version) / "overlay.chroot"
+    if overlay_mount.exists():
+        # left behind by a run which failed while the overlay was mounted
+        ctx.run(f"sudo umount {overlay_mount.absolute()}", warn=True, hide=True)
+        overlay_mount.rmdir()
     overlay_mount.mkdir()
 
     ctx.run("sudo modprobe nbd")
-    ctx.run(f"sudo qemu-nbd --connect=/dev/nbd2 {overlay.absolute()}")
-    ctx.run(f"sudo mount -o exec,loop /dev/nbd2 {overlay_mount.absolute()}")
+    owner = get_kernel_pkg_dir(kernel_version).name
+    with open_registry() as registry:
+        # a lease left by a crashed run is not reused blindly, the device
+        # may still be connected
+        registry.release(NBD_DEVICES, owner)
+        nbd = f"/dev/nbd{registry.allocate(NBD_DEVICES, owner, pid=os.getpid(), accept=nbd_free)}"
+
+    ctx.run(f"sudo qemu-nbd --connect={nbd} {overlay.absolute()}")
+    ctx.run(f"sudo mount -o exec,loop {nbd} {overlay_mount.absolute()}")
 
     if init:
         add_repos(ctx, overlay_mount)
@@ -180,12 +200,27 @@ def setup_dev_env(
         )
         manifest["gateway_ip"] = tap
         manifest["guest_ip"] = guest
+        manifest["ssh_key"] = (
+            get_kernel_pkg_dir(kernel_version).absolute()
+            / f"vm-{manifest['kid']}.id_rsa"
+        ).as_posix()
+
+    if debuginfod and "gateway_ip" in manifest:
+        setup_guest_debuginfod(ctx, overlay_mount, manifest["gateway_ip"])
+        manifest["debuginfod"] = True
+
+    with phase("debs"):
+        install_deb_packages(ctx, kernel_version, overlay_mount, skip_debug=debuginfod)
 
-    install_deb_packages(ctx, kernel_version, overlay_mount)
+    if tools:
+        with phase("tools"):
+            install_userspace_tools(ctx, kernel_version, overlay_mount)
 
     ctx.run(f"sudo umount {overlay_mount.absolute()}")
-    ctx.run("sudo qemu-nbd --disconnect /dev/nbd2")
+    ctx.run(f"sudo qemu-nbd --disconnect {nbd}")
     overlay_mount.rmdir()
+    with open_registry() as registry:
+        registry.release(NBD_DEVICES, owner)
 
     return manifest
 
@@ -206,14 +241,26 @@ def create_kernel_overlay(ctx: InvokeContext, rootfs: Path, kernel_dir: Path) ->
     )
 
 
-def setup_kernel_overlay(ctx: InvokeContext, kernel_version: KernelVersion) -> None:
+def setup_kernel_overlay(
+    ctx: InvokeContext,
+    kernel_version: KernelVersion,
+    debuginfod: bool = False,
+    tools: bool = False,
+) -> None:
     kernel_dir = get_kernel_pkg_dir(kernel_version)
-    create_kernel_overlay(ctx, RootfsBuildPaths.images_dir / "rootfs.qcow2", kernel_dir)
+    set_kernel(kernel_dir)
+    with phase("overlay"):
+        create_kernel_overlay(
+            ctx, RootfsBuildPaths.images_dir / "rootfs.qcow2", kernel_dir
+        )
     kernel_manifest = kernel_dir / "kernel.manifest"
     with open(kernel_manifest, "r") as f:
         manifest = json.load(f)
 
-    manifest = setup_dev_env(ctx, kernel_version, manifest)
+    with phase("dev-env"):
+        manifest = setup_dev_env(
+            ctx, kernel_version, manifest, debuginfod=debuginfod, tools=tools
+        )
 
     info(
         f"[+] generate kernel manifest for {kernel_version}:\n{json.dumps(manifest, indent=4)}"
@@ -222,7 +269,11 @@ def setup_kernel_overlay(ctx: InvokeContext, kernel_version: KernelVersion) -> N
         json.dump(manifest, f)
 
 
-@task  # type: ignore
+@task(  # type: ignore
+    help={
+        "debuginfod": "leave the kernel debug package out of the overlay and fetch symbols from the host symbol server",
+    }
+)
 def build(
     ctx: InvokeContext,
     kernel_version: str,
@@ -232,6 +283,7 @@ def build(
     release: str = DEFAULT_DEBIAN,
     qcow2: bool = False,
     full_rebuild: bool = False,
+    debuginfod: bool = False,
 ) -> None:
     rootfs_build(
         ctx,
@@ -242,6 +294,7 @@ def build(
         release=release,
         qcow2=qcow2,
         full_rebuild=full_rebuild,
+        debuginfod=debuginfod,
     )
 
 
@@ -254,17 +307,31 @@ def rootfs_build(
     release: str = DEFAULT_DEBIAN,
     qcow2: bool = False,
     full_rebuild: bool = False,
+    debuginfod: bool = False,
 ) -> None:
     if platform_arch is None:
         arch = Arch.local()
     else:
-        arch = Arch.from_str(arch)
+        arch = Arch.from_str(platform_arch)
 
     rootfs = RootfsBuildPaths.images_dir / "rootfs.qcow2"
-    if not full_rebuild and rootfs.exists():
-        setup_kernel_overlay(ctx, kernel_version)
-        return
+    if full_rebuild or not rootfs.exists():
+        build_base_image(
+            ctx, arch, img_size=img_size, extra_pkgs=extra_pkgs, release=release
+        )
+
+    info("[+] Creating kernel overlay over rootfs qcow2")
+    setup_kernel_overlay(ctx, kernel_version, debuginfod=debuginfod)
+
 
+def build_base_image(
+    ctx: InvokeContext,
+    arch: Arch,
+    img_size: str = DEFAULT_IMG_SIZE,
+    extra_pkgs: str = "",
+    release: str = DEFAULT_DEBIAN,
+) -> Path:
+    """Debootstrap the rootfs.qcow2 shared by the overlays of all kernels"""
     release_img = RootfsBuildPaths.images_dir / f"{release}.img"
     RootfsBuildPaths.images_dir.mkdir(exist_ok=True)
     RootfsBuildPaths.chroot.mkdir(exist_ok=True)
@@ -310,13 +377,15 @@ echo "myvm" | sudo tee {RootfsBuildPaths.chroot}/etc/hostname
 echo -en "127.0.1.1\tmyvm\n" | sudo tee -a {RootfsBuildPaths.chroot}/etc/hosts
 """
 
-    run_script(ctx, provision_script)
+    with phase("debootstrap"), build_cgroup("rootfs.build debootstrap"):
+        run_script(ctx, provision_script)
 
     ctx.run(f"sudo umount {RootfsBuildPaths.chroot}")
     ctx.run(f"rm -rf {RootfsBuildPaths.chroot}")
 
     info("[+] Rootfs build complete. Creating qcow2 file")
-    convert_to_qemu(ctx, release_img, RootfsBuildPaths.images_dir / "rootfs.qcow2")
+    rootfs = RootfsBuildPaths.images_dir / "rootfs.qcow2"
+    with phase("qcow2"), build_cgroup("rootfs.build qcow2"):
+        convert_to_qemu(ctx, release_img, rootfs)
 
-    info("[+] Creating kernel overlay over rootfs qcow2")
-    setup_kernel_overlay(ctx, kernel_version)
+    return rootfs
@@ -0,0 +1,422 @@
+from __future__ import annotations
+
+import json
+import re
+import shlex
+import statistics
+import threading
+import time
+import xml.etree.ElementTree as ET
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Optional
+
+from invoke.context import Context as InvokeContext
+
+from tasks.guest import GuestResult, run_on_guests
+from tasks.hotpatch import build_tree
+from tasks.kernel import (
+    KernelBuildPaths,
+    KernelManifest,
+    KernelVersion,
+    get_kernel_pkg_dir,
+)
+from tasks.pool import VmInstance, VmPool
+from tasks.steps import git_tree_digest
+from tasks.tool import Exit, info, warn
+
+SELFTESTS_DIR = KernelBuildPaths.kernel_sources_dir / "selftests"
+# seconds each test took in its last run, shared by all kernels
+DURATIONS_FILE = SELFTESTS_DIR / "durations.json"
+# expected duration of a test which never ran, when nothing ran yet
+UNKNOWN_DURATION = 60.0
+# the install below the kernel tree is visible in the compiler container
+INSTALL_DIR = ".kselftest-install"
+GUEST_DIR = "/root/kselftest"
+STAMP = ".kbuild-stamp"
+# digest of the installed tests and inode of the overlay they went into
+INSTALLED_STAMP = "kselftest.installed"
+# ssh exits with 255 when the connection to the guest is lost
+SSH_LOST = 255
+SSH_CHECK_TIMEOUT = 10
+
+PASS = "pass"
+FAIL = "fail"
+SKIP = "skip"
+CRASH = "crash"
+
+TAP_RESULT = re.compile(r"^(not )?ok \d+ selftests: (\S+): (\S+)(.*)$", re.MULTILINE)
+
+# run_kselftest.sh applies the timeout from the settings file of each
+# collection, ours only catches a guest which stopped responding
+RUN_TEMPLATE = """
+cd {guest_dir} || exit 127
+./run_kselftest.sh -t {test}
+"""
+
+INSTALL_TEMPLATE = """
+set -e
+rm -rf {guest_dir}
+mkdir -p {guest_dir}
+tar -C {guest_dir} -xf -
+sync
+"""
+
+
+class TestResult:
+    def __init__(
+        self, test: str, status: str, duration: float, log: Path, detail: str = ""
+    ):
+        self.test = test
+        self.status = status
+        self.duration = duration
+        self.log = log
+        self.detail = detail
+
+    @property
+    def collection(self) -> str:
+        return self.test.split(":", 1)[0]
+
+    @property
+    def name(self) -> str:
+        return self.test.split(":", 1)[1]
+
+
+def load_durations() -> dict[str, float]:
+    try:
+        with open(DURATIONS_FILE, "r") as f:
+            durations: dict[str, float] = json.load(f)
+            return durations
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_durations(results: list[TestResult]) -> None:
+    """A crashed test says nothing about how long it takes, the previous
+    duration is kept"""
+    durations = load_durations()
+    for r in results:
+        if r.status != CRASH:
+            durations[r.test] = round(r.duration, 3)
+
+    SELFTESTS_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = DURATIONS_FILE.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(durations, f, indent=4, sort_keys=True)
+    tmp.replace(DURATIONS_FILE)
+
+
+def shard(tests: list[str], durations: dict[str, float], count: int) -> list[list[str]]:
+    """Longest tests first, each onto the shard with the least expected
+    time so far. Tests which never ran are expected to take the median."""
+    known = [durations[t] for t in tests if t in durations]
+    default = statistics.median(known) if len(known) > 0 else UNKNOWN_DURATION
+    shards: list[list[str]] = [list() for _ in range(count)]
+    loads = [0.0] * count
+    for test in sorted(tests, key=lambda t: -durations.get(t, default)):
+        i = loads.index(min(loads))
+        shards[i].append(test)
+        loads[i] += durations.get(test, default)
+
+    for i in range(count):
+        info(f"    shard {i}: {len(shards[i])} tests, ~{loads[i]:.0f}s")
+    return shards
+
+
+def build_selftests(
+    ctx: InvokeContext, manifest: KernelManifest, targets: list[str], force: bool
+) -> tuple[Path, str]:
+    """Build and install the selftests of targets in the tree the kernel was
+    built from, once per state of the tree. Returns the install directory
+    on the host and the digest it was built for."""
+    run, build_dir, host_dir = build_tree(ctx, manifest)
+    install_dir = host_dir / INSTALL_DIR
+    digest = f"{git_tree_digest(ctx, host_dir)}:{','.join(targets)}"
+    stamp = install_dir / STAMP
+    if not force and stamp.exists() and stamp.read_text() == digest:
+        info(f"[+] Selftests in {install_dir} are up to date")
+        return install_dir, digest
+
+    info(f"[+] Building selftests {', '.join(targets)} in {host_dir}")
+    run(f"make -C {build_dir} -j$(nproc) headers")
+    run(
+        f"make -C {build_dir}/tools/testing/selftests -j$(nproc) "
+        f"TARGETS='{' '.join(targets)}' INSTALL_PATH={build_dir}/{INSTALL_DIR} install"
+    )
+    if not (install_dir / "run_kselftest.sh").exists():
+        raise Exit(f"selftest install in {install_dir} has no run_kselftest.sh")
+
+    stamp.write_text(digest)
+    return install_dir, digest
+
+
+def install_selftests(
+    ctx: InvokeContext,
+    kversion: KernelVersion,
+    kernel_image: Path,
+    install_dir: Path,
+    digest: str,
+    cpus: int,
+    memory: str,
+) -> None:
+    """Copy the selftests into the overlay of the package once, with a
+    single boot without -snapshot, instead of into every instance"""
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    installed = f"{digest}:{(pkg_dir / 'overlay.qcow2').stat().st_ino}"
+    stamp = pkg_dir / INSTALLED_STAMP
+    if stamp.exists() and stamp.read_text() == installed:
+        return
+
+    info(f"[+] Installing selftests into the overlay of {kversion}")
+    # the guest syncs before the pool stops it, qemu writes back the
+    # overlay when it is terminated
+    with VmPool(kversion, kernel_image, 1, cpus, memory, snapshot=False) as instances:
+        ssh = shlex.join(instances[0].guest.ssh_argv())
+        script = shlex.quote(INSTALL_TEMPLATE.format(guest_dir=GUEST_DIR))
+        ctx.run(f"tar -C {install_dir} -cf - . | {ssh} {script}")
+
+    stamp.write_text(installed)
+
+
+def test_status(result: GuestResult) -> tuple[str, str]:
+    matches = list(TAP_RESULT.finditer(result.stdout))
+    if len(matches) == 0:
+        return (PASS if result.ok else FAIL), f"exit {result.exit_code}"
+
+    m = matches[-1]
+    rest = m.group(4).strip()
+    if "# SKIP" in rest:
+        return SKIP, rest.split("# SKIP", 1)[1].strip()
+    if m.group(1) is not None:
+        return FAIL, rest.lstrip("#").strip()
+    return PASS, ""
+
+
+class ShardRunner:
+    """Runs the tests of one shard on one instance. A test during which the
+    guest crashed or stopped answering runs once more on a fresh instance,
+    and is reported as a crash if it takes that one down as well."""
+
+    lock = threading.Lock()
+
+    def __init__(
+        self,
+        pool: VmPool,
+        instance: VmInstance,
+        tests: list[str],
+        out_dir: Path,
+        timeout: float,
+    ):
+        self.pool = pool
+        self.instance = instance
+        self.tests = tests
+        self.out_dir = out_dir
+        self.timeout = timeout
+        self.results: list[TestResult] = list()
+        self.error: Optional[BaseException] = None
+
+    def _lost(self, result: GuestResult) -> bool:
+        if not self.instance.alive() or result.exit_code == -1:
+            return True
+        if result.exit_code != SSH_LOST:
+            return False
+        # a test may exit with 255 itself, the guest is gone if it does
+        # not answer anymore
+        return not run_on_guests([self.instance.guest], "true", SSH_CHECK_TIMEOUT)[0].ok
+
+    def _run_once(self, test: str, log: Path) -> tuple[GuestResult, bool]:
+        cmd = RUN_TEMPLATE.format(guest_dir=GUEST_DIR, test=shlex.quote(test))
+        result = run_on_guests([self.instance.guest], cmd, self.timeout)[0]
+        if result.exit_code == 127:
+            raise Exit(
+                f"{GUEST_DIR} is missing in {self.instance.name}, rerun with --reinstall"
+            )
+
+        lost = self._lost(result)
+        with open(log, "a") as f:
+            f.write(result.stdout)
+            f.write(result.stderr)
+            if lost and self.instance.console_log.exists():
+                console = self.instance.console_log.read_text(errors="replace")
+                f.write(f"\n--- console of {self.instance.name} ---\n")
+                f.write("\n".join(console.splitlines()[-200:]) + "\n")
+        return result, lost
+
+    def run_test(self, test: str) -> TestResult:
+        collection, name = test.split(":", 1)
+        log = self.out_dir / "logs" / collection / f"{name}.log"
+        log.parent.mkdir(parents=True, exist_ok=True)
+        log.unlink(missing_ok=True)
+
+        why = ""
+        for _ in range(2):
+            result, lost = self._run_once(test, log)
+            if not lost:
+                status, detail = test_status(result)
+                return TestResult(test, status, result.duration, log, detail)
+
+            why = "crashed" if not self.instance.alive() else "stopped responding"
+            warn(f"[!] {self.instance.name} {why} during {test}")
+            self.pool.replace(self.instance)
+
+        return TestResult(test, CRASH, result.duration, log, f"guest {why} twice")
+
+    def run(self) -> None:
+        try:
+            for test in self.tests:
+                r = self.run_test(test)
+                self.results.append(r)
+                line = (
+                    f"[{self.instance.name}] {r.status:<5} {r.test} ({r.duration:.1f}s)"
+                )
+                with self.lock:
+                    if r.status in (PASS, SKIP):
+                        info(line)
+                    else:
+                        warn(line)
+        except BaseException as e:
+            self.error = e
+
+
+def write_tap(results: list[TestResult], path: Path) -> None:
+    lines = ["TAP version 13", f"1..{len(results)}"]
+    for i, r in enumerate(results, 1):
+        directive = ""
+        if r.status == SKIP:
+            directive = f" # SKIP {r.detail}"
+        elif r.status == CRASH:
+            directive = f" # {r.detail}"
+        ok = "ok" if r.status in (PASS, SKIP) else "not ok"
+        lines.append(f"{ok} {i} selftests: {r.collection}: {r.name}{directive}")
+    path.write_text("\n".join(lines) + "\n")
+
+
+def write_junit(results: list[TestResult], path: Path, kversion: KernelVersion) -> None:
+    root = ET.Element("testsuites", name=f"kselftest {kversion}")
+    for collection in sorted({r.collection for r in results}):
+        tests = [r for r in results if r.collection == collection]
+        suite = ET.SubElement(
+            root,
+            "testsuite",
+            name=collection,
+            tests=str(len(tests)),
+            failures=str(len([r for r in tests if r.status == FAIL])),
+            errors=str(len([r for r in tests if r.status == CRASH])),
+            skipped=str(len([r for r in tests if r.status == SKIP])),
+            time=f"{sum([r.duration for r in tests]):.3f}",
+        )
+        for r in tests:
+            case = ET.SubElement(
+                suite,
+                "testcase",
+                classname=collection,
+                name=r.name,
+                time=f"{r.duration:.3f}",
+            )
+            if r.status == FAIL:
+                ET.SubElement(case, "failure", message=r.detail)
+            elif r.status == CRASH:
+                ET.SubElement(case, "error", message=r.detail)
+            elif r.status == SKIP:
+                ET.SubElement(case, "skipped", message=r.detail)
+            if r.status != PASS and r.log.exists():
+                ET.SubElement(case, "system-out").text = r.log.read_text(
+                    errors="replace"
+                )
+
+    ET.indent(root)
+    ET.ElementTree(root).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def list_tests(install_dir: Path, patterns: list[str]) -> list[str]:
+    tests = [
+        line.strip()
+        for line in (install_dir / "kselftest-list.txt").read_text().splitlines()
+        if ":" in line
+    ]
+    if len(patterns) > 0:
+        tests = [t for t in tests if any(fnmatch(t, p) for p in patterns)]
+    return tests
+
+
+def run_selftests(
+    ctx: InvokeContext,
+    kversion: KernelVersion,
+    kernel_image: Path,
+    targets: list[str],
+    patterns: list[str],
+    instances: int,
+    cpus: int,
+    memory: str,
+    timeout: float,
+    rebuild: bool = False,
+    reinstall: bool = False,
+) -> Path:
+    """Build, install and run the selftests sharded over a pool of instances,
+    returns the directory of the merged report"""
+    if instances < 1:
+        raise Exit(f"--instances must be at least 1, got {instances}")
+
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    manifest_file = pkg_dir / "kernel.manifest"
+    if not manifest_file.exists():
+        raise Exit(f"kernel {kversion} is not initialized, run vm.init first")
+    with open(manifest_file, "r") as f:
+        manifest: KernelManifest = json.load(f)
+
+    install_dir, digest = build_selftests(ctx, manifest, targets, rebuild)
+    if reinstall:
+        (pkg_dir / INSTALLED_STAMP).unlink(missing_ok=True)
+    install_selftests(ctx, kversion, kernel_image, install_dir, digest, cpus, memory)
+
+    tests = list_tests(install_dir, patterns)
+    if len(tests) == 0:
+        raise Exit("no selftests selected")
+
+    instances = min(instances, len(tests))
+    out_dir = SELFTESTS_DIR / f"{pkg_dir.name}-{time.strftime('%Y%m%d-%H%M%S')}"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    info(f"[+] Sharding {len(tests)} tests over {instances} instances")
+    shards = shard(tests, load_durations(), instances)
+
+    start = time.monotonic()
+    pool = VmPool(kversion, kernel_image, instances, cpus, memory)
+    with pool as booted:
+        runners = [
+            ShardRunner(pool, i, s, out_dir, timeout) for i, s in zip(booted, shards)
+        ]
+        threads = [
+            threading.Thread(target=r.run, name=r.instance.name) for r in runners
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.monotonic() - start
+
+    order = {t: i for i, t in enumerate(tests)}
+    results = sorted(
+        [r for s in runners for r in s.results], key=lambda r: order[r.test]
+    )
+    write_tap(results, out_dir / "report.tap")
+    write_junit(results, out_dir / "junit.xml", kversion)
+    save_durations(results)
+
+    errors = [r.error for r in runners if r.error is not None]
+    if len(errors) > 0:
+        raise errors[0]
+
+    counts = {
+        s: len([r for r in results if r.status == s]) for s in (PASS, FAIL, SKIP, CRASH)
+    }
+    serial = sum([r.duration for r in results])
+    info(
+        f"[+] {len(results)} tests in {elapsed:.0f}s ({serial:.0f}s of test time): "
+        + ", ".join([f"{n} {s}" for s, n in counts.items()])
+    )
+    info(f"[+] Report in {out_dir}")
+    if counts[FAIL] + counts[CRASH] > 0:
+        raise Exit(
+            f"{counts[FAIL]} failed and {counts[CRASH]} crashed selftests, see {out_dir}"
+        )
+    return out_dir
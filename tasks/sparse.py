@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import json
+import re
+from pathlib import Path
+from typing import Any, Optional
+
+from invoke.context import Context as InvokeContext
+
+from tasks.arch import Arch
+from tasks.tool import info
+
+# top level directories kbuild never reads
+SPARSE_EXCLUDES = ["Documentation"]
+# Kconfig files are sourced unconditionally, also from directories which
+# are left out: Documentation/Kconfig, the Kconfig of disabled drivers
+SPARSE_KEEP = ["Kconfig*"]
+# checkouts recorded per mode to compare against
+CHECKOUT_HISTORY = 10
+MAKEFILE_SUBDIR = re.compile(r"^obj-(\$\(CONFIG_(\w+)\)|y)\s*[+:]?=\s*(.*)$")
+CONFIG_VALUE = re.compile(r"^(# )?CONFIG_(\w+)(=(\S+)| is not set)")
+
+
+def config_values(config: Path) -> dict[str, str]:
+    """Value of every symbol a .config sets, n for those not set"""
+    values: dict[str, str] = dict()
+    with open(config, "r") as f:
+        for line in f:
+            m = CONFIG_VALUE.match(line.strip())
+            if m is None or (m.group(1) is not None and m.group(3) != " is not set"):
+                continue
+            values[m.group(2)] = m.group(4) if m.group(4) is not None else "n"
+    return values
+
+
+def disabled_driver_dirs(ctx: InvokeContext, worktree: Path, config: Path) -> list[str]:
+    """Directories below drivers/ which kbuild only enters for symbols the
+    generated .config leaves off. Symbols a fragment disables may still be
+    selected by others, only the resolved config tells. A directory added
+    by any enabled symbol, or always, is kept."""
+    res = ctx.run(
+        f"git -C {worktree} grep -n --full-name -E '^obj-' HEAD -- 'drivers/Makefile' 'drivers/*/Makefile'",
+        hide=True,
+        warn=True,
+    )
+    if res is None or not res.ok:
+        return list()
+
+    values = config_values(config)
+    symbols: dict[str, set[str]] = dict()
+    for line in res.stdout.splitlines():
+        # HEAD:<path>:<line>:<content>
+        parts = line.split(":", 3)
+        if len(parts) != 4:
+            continue
+        m = MAKEFILE_SUBDIR.match(parts[3].strip())
+        if m is None:
+            continue
+        base = parts[1].rsplit("/", 1)[0]
+        symbol = m.group(2) or "y"
+        for entry in m.group(3).split():
+            if entry.endswith("/") and not entry.startswith("$"):
+                symbols.setdefault(f"{base}/{entry.rstrip('/')}", set()).add(symbol)
+
+    # symbols missing from .config depend on disabled ones
+    disabled = [
+        d
+        for d, syms in symbols.items()
+        if all([s != "y" and values.get(s, "n") == "n" for s in syms])
+    ]
+    # nothing below a directory which is left out anyway
+    return sorted(
+        [d for d in disabled if not any([d.startswith(f"{p}/") for p in disabled])]
+    )
+
+
+def sparse_patterns(arch: Arch, driver_dirs: list[str]) -> list[str]:
+    """Non-cone sparse-checkout patterns, the last matching one wins"""
+    patterns = ["/*"] + [f"!/{d}/" for d in SPARSE_EXCLUDES]
+    patterns += ["!/arch/*/", f"/arch/{arch.kernel_arch}/"]
+    if arch.kernel_arch == "arm64":
+        # arm64 device trees include the 32-bit ones of the same SoCs through
+        # scripts/dtc/include-prefixes/arm
+        patterns.append("/arch/arm/boot/dts/")
+    patterns += [f"!/{d}/" for d in driver_dirs]
+    return patterns + SPARSE_KEEP
+
+
+def apply_sparse_checkout(
+    ctx: InvokeContext, worktree: Path, arch: Arch, driver_dirs: list[str]
+) -> None:
+    patterns = " ".join([f"'{p}'" for p in sparse_patterns(arch, driver_dirs)])
+    ctx.run(f"git -C {worktree} sparse-checkout set --no-cone {patterns}")
+
+
+def is_sparse(ctx: InvokeContext, worktree: Path) -> bool:
+    res = ctx.run(
+        f"git -C {worktree} config --get core.sparseCheckout", hide=True, warn=True
+    )
+    return res is not None and res.ok and res.stdout.strip() == "true"
+
+
+def sparse_checkout(ctx: InvokeContext, worktree: Path, arch: Arch) -> None:
+    """Leave out Documentation and the other arches. A worktree built
+    before also leaves out the drivers its .config disables, as it was."""
+    config = worktree / ".config"
+    driver_dirs: list[str] = list()
+    if config.exists() and is_sparse(ctx, worktree):
+        driver_dirs = disabled_driver_dirs(ctx, worktree, config)
+    info("[+] Sparse checkout without Documentation and other arches")
+    apply_sparse_checkout(ctx, worktree, arch, driver_dirs)
+
+
+def narrow_sparse_checkout(ctx: InvokeContext, worktree: Path, arch: Arch) -> None:
+    """Leave out the driver trees the generated .config disables, once the
+    config is resolved. Full worktrees are left alone."""
+    if not is_sparse(ctx, worktree):
+        return
+
+    driver_dirs = disabled_driver_dirs(ctx, worktree, worktree / ".config")
+    info(
+        f"[+] Leaving {len(driver_dirs)} driver trees the config disables out of the worktree"
+    )
+    apply_sparse_checkout(ctx, worktree, arch, driver_dirs)
+
+
+def checkout_size(ctx: InvokeContext, worktree: Path) -> Optional[dict[str, int]]:
+    """Files and bytes checked out in worktree and in the full tree of HEAD"""
+    tree = ctx.run(f"git -C {worktree} ls-tree -r -l HEAD", hide=True, warn=True)
+    index = ctx.run(f"git -C {worktree} ls-files -t", hide=True, warn=True)
+    if tree is None or index is None or not tree.ok or not index.ok:
+        return None
+
+    sizes: dict[str, int] = dict()
+    for line in tree.stdout.splitlines():
+        meta, path = line.split("\t", 1)
+        size = meta.split()[3]
+        sizes[path] = int(size) if size.isdigit() else 0
+    # H is a file in the worktree, S one left out by the sparse checkout
+    present = [line[2:] for line in index.stdout.splitlines() if line.startswith("H ")]
+    return {
+        "files": len(present),
+        "bytes": sum([sizes.get(p, 0) for p in present]),
+        "full_files": len(sizes),
+        "full_bytes": sum(sizes.values()),
+    }
+
+
+def record_checkout(
+    ctx: InvokeContext,
+    stats_file: Path,
+    worktree: Path,
+    version: str,
+    sparse: bool,
+    seconds: float,
+) -> None:
+    """Report the size of a new worktree and how long it took next to the
+    full tree and the recent checkouts of the other mode"""
+    mode = "sparse" if sparse else "full"
+    try:
+        with open(stats_file, "r") as f:
+            stats: dict[str, Any] = json.load(f)
+    except (OSError, ValueError):
+        stats = dict()
+    runs = stats.get(mode, list()) + [
+        {"version": version, "seconds": round(seconds, 3)}
+    ]
+    stats[mode] = runs[-CHECKOUT_HISTORY:]
+    stats_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(stats_file, "w") as f:
+        json.dump(stats, f, indent=4)
+
+    size = checkout_size(ctx, worktree)
+    if size is not None:
+        info(
+            f"[+] {mode.capitalize()} checkout of {version}: {size['files']} of {size['full_files']} files, "
+            f"{size['bytes'] / (1 << 20):.0f}M of {size['full_bytes'] / (1 << 20):.0f}M in {seconds:.1f}s"
+        )
+    other = "full" if sparse else "sparse"
+    if len(stats.get(other, list())) > 0:
+        mean = sum([r["seconds"] for r in stats[other]]) / len(stats[other])
+        info(f"    {other} checkouts took {mean:.1f}s on average")
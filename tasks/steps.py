@@ -0,0 +1,392 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any, Callable, Iterator, Optional
+
+from invoke.context import Context as InvokeContext
+
+from tasks.elf import read_build_id
+from tasks.tool import Exit, info, warn
+from tasks.tracing import phase
+
+STEPS_FILE = "steps.json"
+# outputs up to this size are fingerprinted by content, larger ELF files
+# such as vmlinux by build id, since gdb-add-index rewrites vmlinux in place
+# without changing what was built, and disk images by size and mtime
+CONTENT_DIGEST_LIMIT = 16 << 20
+CHUNK_SIZE = 1 << 20
+
+RUN = "run"
+SKIP = "skip"
+ADOPT = "adopt"
+MAYBE = "maybe"
+
+Inputs = dict[str, str]
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(path: Path) -> str:
+    if not path.exists():
+        return "absent"
+    st = path.stat()
+    if path.is_dir():
+        return f"dir:{st.st_mtime_ns}"
+    if st.st_size <= CONTENT_DIGEST_LIMIT:
+        return file_digest(path)
+    build_id = read_build_id(path)
+    if build_id is not None:
+        return f"build-id:{build_id}"
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def git_tree_digest(ctx: InvokeContext, tree: Path) -> str:
+    """Commit checked out in tree and its uncommitted changes. Untracked
+    files are left out, the build writes some into the tree."""
+    if not tree.exists():
+        return "absent"
+
+    head = ctx.run(f"git -C {tree} rev-parse HEAD", hide=True, warn=True)
+    diff = ctx.run(f"git -C {tree} diff HEAD", hide=True, warn=True)
+    if head is None or diff is None or not head.ok:
+        return "absent"
+
+    changes = hashlib.sha256(diff.stdout.encode()).hexdigest()
+    return f"{head.stdout.strip()}:{changes}"
+
+
+class StepWriter:
+    """Output stream of a step while steps run in parallel. Lines go to the
+    log of the step, and to the terminal prefixed with the step name, a
+    whole line at a time."""
+
+    lock = threading.Lock()
+
+    def __init__(self, name: str, log: IO[str], terminal: IO[str]):
+        self.name = name
+        self.log = log
+        self.terminal = terminal
+        self.buffer = ""
+
+    def write(self, data: str) -> int:
+        *lines, self.buffer = (self.buffer + data).split("\n")
+        if len(lines) > 0:
+            self._emit(lines)
+        return len(data)
+
+    def _emit(self, lines: list[str]) -> None:
+        with self.lock:
+            for line in lines:
+                self.terminal.write(f"[{self.name}] {line}\n")
+                self.log.write(line + "\n")
+            self.terminal.flush()
+            self.log.flush()
+
+    def flush(self) -> None:
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+    def finish(self) -> None:
+        if self.buffer != "":
+            self._emit([self.buffer])
+            self.buffer = ""
+
+
+class ThreadOutput:
+    """Stands in for sys.stdout or sys.stderr, sending what the thread of
+    a step prints to its StepWriter"""
+
+    def __init__(self, stream: IO[str], local: threading.local, index: int):
+        self.stream = stream
+        self.local = local
+        self.index = index
+
+    def write(self, data: str) -> int:
+        writers: Optional[tuple[StepWriter, StepWriter]] = getattr(
+            self.local, "writers", None
+        )
+        if writers is not None:
+            return writers[self.index].write(data)
+        with StepWriter.lock:
+            return self.stream.write(data)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.stream, attr)
+
+
+class ParallelOutput:
+    def __init__(self) -> None:
+        self.local = threading.local()
+        self.terminal: tuple[IO[str], IO[str]] = (sys.stdout, sys.stderr)
+
+    def writers(self) -> Optional[tuple[StepWriter, StepWriter]]:
+        writers: Optional[tuple[StepWriter, StepWriter]] = getattr(
+            self.local, "writers", None
+        )
+        return writers
+
+    @contextmanager
+    def install(self, ctx: InvokeContext) -> Iterator[None]:
+        """Route print() and the commands run through ctx by the thread of
+        a step to its writers. invoke writes the output of a command from
+        threads of its own, the streams are handed to it explicitly."""
+        output = self
+        base = ctx.config.runners.local
+
+        class StepRunner(base):  # type: ignore
+            def run(self, command: str, **kwargs: Any) -> Any:
+                writers = output.writers()
+                if writers is not None:
+                    kwargs.setdefault("out_stream", writers[0])
+                    kwargs.setdefault("err_stream", writers[1])
+                return super().run(command, **kwargs)
+
+        stdout, stderr = sys.stdout, sys.stderr
+        self.terminal = (stdout, stderr)
+        sys.stdout = ThreadOutput(stdout, self.local, 0)
+        sys.stderr = ThreadOutput(stderr, self.local, 1)
+        ctx.config.runners.local = StepRunner
+        try:
+            yield
+        finally:
+            ctx.config.runners.local = base
+            sys.stdout, sys.stderr = stdout, stderr
+
+    @contextmanager
+    def step(self, name: str, log: Path) -> Iterator[None]:
+        """Capture the output of the calling thread for step name"""
+        log.parent.mkdir(parents=True, exist_ok=True)
+        with open(log, "w") as f:
+            writers = (
+                StepWriter(name, f, self.terminal[0]),
+                StepWriter(name, f, self.terminal[1]),
+            )
+            self.local.writers = writers
+            try:
+                yield
+            finally:
+                self.local.writers = None
+                for writer in writers:
+                    writer.finish()
+
+
+class Step:
+    """A unit of a pipeline. inputs is evaluated right before the step runs,
+    once its dependencies are done, and the fingerprints of their outputs
+    are inputs as well. adopt tells whether a step which never ran under
+    the graph was completed by an earlier version of the task. Steps which
+    set up host state, e.g. tap devices, always run."""
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[], None],
+        state: Path,
+        inputs: Optional[Callable[[], Inputs]] = None,
+        outputs: Optional[list[Path]] = None,
+        deps: Optional[list[str]] = None,
+        adopt: Optional[Callable[[], bool]] = None,
+        always: bool = False,
+    ):
+        self.name = name
+        self.run = run
+        self.state = state
+        self.inputs = inputs if inputs is not None else dict
+        self.outputs = outputs if outputs is not None else list()
+        self.deps = deps if deps is not None else list()
+        self.adopt = adopt
+        self.always = always
+
+
+class StepGraph:
+    """Runs steps in dependency order, skipping those whose inputs did not
+    change since they last completed. A step is recorded as running before
+    it starts, so one which failed or was interrupted runs again."""
+
+    def __init__(self, steps: list[Step]):
+        self.steps: dict[str, Step] = dict()
+        for step in steps:
+            for dep in step.deps:
+                if dep not in self.steps:
+                    raise Exit(
+                        f"step {step.name} depends on unknown or later step {dep}"
+                    )
+            self.steps[step.name] = step
+
+    def _load(self, path: Path) -> dict[str, Any]:
+        try:
+            with open(path, "r") as f:
+                state: dict[str, Any] = json.load(f)
+                return state
+        except (OSError, ValueError):
+            return dict()
+
+    def _record(self, step: Step, record: dict[str, Any]) -> None:
+        state = self._load(step.state)
+        state[step.name] = record
+        step.state.parent.mkdir(parents=True, exist_ok=True)
+        tmp = step.state.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=4)
+        tmp.replace(step.state)
+
+    def inputs(self, step: Step) -> Inputs:
+        inputs = dict(step.inputs())
+        for dep in step.deps:
+            for output in self.steps[dep].outputs:
+                # a directory changes whenever a file is written into it, the
+                # kernel build writes into its worktree. Steps reading one
+                # fingerprint what they read in their own inputs.
+                if output.is_dir():
+                    continue
+                inputs[f"{dep}:{output.name}"] = fingerprint(output)
+        return inputs
+
+    def status(self, step: Step, pending: set[str]) -> tuple[str, str]:
+        """Action and reason for a step, pending are the steps which will
+        run before it"""
+        if step.always:
+            return RUN, "always runs"
+
+        record = self._load(step.state).get(step.name)
+        missing = [o.name for o in step.outputs if not o.exists()]
+        if record is None:
+            if len(missing) == 0 and step.adopt is not None and step.adopt():
+                return ADOPT, "completed before steps were recorded"
+            return RUN, "never ran"
+
+        if record.get("status") != "done":
+            return RUN, "failed or interrupted"
+        if len(missing) > 0:
+            return RUN, f"missing {', '.join(missing)}"
+
+        after = [d for d in step.deps if d in pending]
+        if len(after) > 0:
+            # the outputs may come out the same, which is only known then
+            return MAYBE, f"after {', '.join(after)}"
+
+        inputs = self.inputs(step)
+        recorded = record.get("inputs", dict())
+        changed = sorted(
+            [k for k in set(inputs) | set(recorded) if inputs.get(k) != recorded.get(k)]
+        )
+        if len(changed) > 0:
+            return RUN, f"changed: {', '.join(changed)}"
+
+        return SKIP, "up to date"
+
+    def plan(self) -> list[tuple[str, str, str]]:
+        pending: set[str] = set()
+        plan = list()
+        for step in self.steps.values():
+            action, reason = self.status(step, pending)
+            if action in (RUN, MAYBE):
+                pending.add(step.name)
+            plan.append((step.name, action, reason))
+        return plan
+
+    def print_plan(self) -> None:
+        for name, action, reason in self.plan():
+            info(f"    {action:<6} {name:<12} {reason}")
+
+    def _execute(
+        self, step: Step, output: Optional[ParallelOutput], log_dir: Path
+    ) -> float:
+        """Run a step unless it is up to date, returns its duration"""
+        action, reason = self.status(step, set())
+        if action == SKIP:
+            info(f"[+] Step {step.name}: up to date")
+            return 0.0
+
+        # taken before the step runs, changes made meanwhile run it again
+        inputs = self.inputs(step)
+        info(f"[+] Step {step.name}: {reason}")
+        seconds = 0.0
+        if action != ADOPT:
+            self._record(step, {"status": "running"})
+            start = time.monotonic()
+            try:
+                with phase(step.name):
+                    if output is None:
+                        step.run()
+                    else:
+                        with output.step(step.name, log_dir / f"step-{step.name}.log"):
+                            step.run()
+            except BaseException:
+                warn(f"[!] Step {step.name} failed, it runs again next time")
+                raise
+            seconds = time.monotonic() - start
+            info(f"[+] Step {step.name} done in {seconds:.1f}s")
+
+        if not step.always:
+            self._record(
+                step,
+                {
+                    "status": "done",
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "seconds": round(seconds, 3),
+                    "inputs": inputs,
+                    "outputs": {o.name: fingerprint(o) for o in step.outputs},
+                },
+            )
+        return seconds
+
+    def run(
+        self, ctx: InvokeContext, jobs: int = 1, log_dir: Optional[Path] = None
+    ) -> dict[str, float]:
+        """Run the steps, up to jobs of them at the same time once their
+        dependencies are done. With more than one job the output of each
+        step is also written to step-<name>.log in log_dir. Returns the
+        time spent in each step."""
+        if jobs <= 1 or log_dir is None:
+            return {
+                step.name: self._execute(step, None, Path())
+                for step in self.steps.values()
+            }
+
+        times: dict[str, float] = dict()
+        waiting = list(self.steps.values())
+        running: dict[Future[float], Step] = dict()
+        output = ParallelOutput()
+        failure: Optional[BaseException] = None
+        with output.install(ctx), ThreadPoolExecutor(max_workers=jobs) as pool:
+            while len(waiting) > 0 or len(running) > 0:
+                # nothing new starts once a step failed, the running ones finish
+                ready = [s for s in waiting if all(d in times for d in s.deps)]
+                while failure is None and len(ready) > 0 and len(running) < jobs:
+                    step = ready.pop(0)
+                    waiting.remove(step)
+                    running[pool.submit(self._execute, step, output, log_dir)] = step
+
+                if len(running) == 0:
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        times[step.name] = future.result()
+                    except BaseException as e:
+                        failure = failure or e
+
+        if failure is not None:
+            raise failure
+        return times
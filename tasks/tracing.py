@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+from invoke.collection import Collection
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Local, Result
+
+from tasks.tool import info
+
+# KBUILD_TRACE=1 writes traces to TRACE_DIR, any other value is the path
+# of the trace file. Not named trace.py, which would shadow the module of
+# the standard library once invoke puts tasks/ on sys.path.
+TRACE_ENV = "KBUILD_TRACE"
+TRACE_DIR = Path("./kernels/sources/traces")
+# runs of the same kernel kept in its manifest for comparison
+TRACE_HISTORY = 20
+TASK_NAME = re.compile(r"^[a-z_-]+\.[a-z_-]+$")
+DOCKER_EXEC = re.compile(r'docker exec .* bash -c "(.*)"$', re.DOTALL)
+
+
+class Tracer:
+    """Collects a Chrome trace-event of every command run through invoke and
+    of every phase. Phases nest, a command belongs to the innermost phase
+    of the thread running it."""
+
+    def __init__(self, path: Path, label: str):
+        self.path = path
+        self.label = label
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events: list[dict[str, Any]] = list()
+        self.phases: dict[str, float] = dict()
+        self.commands: dict[str, int] = dict()
+        self.kernel_dir: Optional[Path] = None
+
+    def _us(self, t: float) -> int:
+        return int((t - self.start) * 1e6)
+
+    def stack(self) -> list[str]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = list()
+        stack: list[str] = self.local.stack
+        return stack
+
+    def current(self) -> str:
+        return "/".join(self.stack()) or "unlabeled"
+
+    def _event(
+        self, name: str, cat: str, start: float, end: float, args: dict[str, Any]
+    ) -> None:
+        with self.lock:
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": cat,
+                    "ph": "X",
+                    "ts": self._us(start),
+                    "dur": self._us(end) - self._us(start),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        self.stack().append(name)
+        label = self.current()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            self.stack().pop()
+            self._event(name, "phase", start, end, {"phase": label, "task": self.label})
+            with self.lock:
+                self.phases[label] = self.phases.get(label, 0.0) + end - start
+
+    def command(
+        self, command: str, start: float, end: float, exit_code: Optional[int]
+    ) -> None:
+        runner = "local"
+        m = DOCKER_EXEC.search(command)
+        if m is not None:
+            runner = "compiler"
+            command = m.group(1)
+
+        label = self.current()
+        self._event(
+            command.strip().splitlines()[0][:120] if command.strip() else command,
+            runner,
+            start,
+            end,
+            {
+                "command": command,
+                "exit_code": exit_code,
+                "phase": label,
+                "task": self.label,
+            },
+        )
+        with self.lock:
+            self.commands[label] = self.commands.get(label, 0) + 1
+            if len(self.stack()) == 0:
+                self.phases[label] = self.phases.get(label, 0.0) + end - start
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "task": self.label,
+            "total": time.monotonic() - self.start,
+            "phases": {
+                p: {"seconds": round(s, 3), "commands": self.commands.get(p, 0)}
+                for p, s in sorted(self.phases.items(), key=lambda kv: -kv[1])
+            },
+        }
+
+    def folded(self) -> list[str]:
+        """Stacks in the folded format of flamegraph.pl, weighted in ms"""
+        lines = list()
+        for e in self.events:
+            if e["cat"] == "phase":
+                continue
+            stack = (
+                [self.label]
+                + e["args"]["phase"].split("/")
+                + [e["name"].replace(";", ",")]
+            )
+            lines.append(f"{';'.join(stack)} {max(e['dur'] // 1000, 1)}")
+        return lines
+
+    def save_to_manifest(self, summary: dict[str, Any]) -> None:
+        if self.kernel_dir is None:
+            return
+
+        manifest_file = self.kernel_dir / "kernel.manifest"
+        if not manifest_file.exists():
+            return
+
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+
+        history = manifest.get("trace_history", list()) + [summary]
+        manifest["trace_history"] = history[-TRACE_HISTORY:]
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f)
+
+    def write(self) -> None:
+        summary = self.summary()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(
+                {
+                    "traceEvents": self.events,
+                    "displayTimeUnit": "ms",
+                    "summary": summary,
+                },
+                f,
+            )
+        with open(self.path.with_suffix(".folded"), "w") as f:
+            f.write("\n".join(self.folded()) + "\n")
+        self.save_to_manifest(summary)
+
+        info(f"[+] Trace written to {self.path} ({summary['total']:.1f}s)")
+        for p, s in summary["phases"].items():
+            info(f"    {s['seconds']:>9.1f}s {s['commands']:>5} cmds  {p}")
+
+
+_tracer: Optional[Tracer] = None
+
+
+class TracingLocal(Local):
+    def run(self, command: str, **kwargs: Any) -> Optional[Result]:
+        start = time.monotonic()
+        exit_code: Optional[int] = None
+        try:
+            result = super().run(command, **kwargs)
+            exit_code = result.exited if result is not None else None
+            return result
+        except UnexpectedExit as e:
+            exit_code = e.result.exited
+            raise
+        finally:
+            if _tracer is not None:
+                _tracer.command(command, start, time.monotonic(), exit_code)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Label the commands run in the block, a no-op unless tracing is on"""
+    if _tracer is None:
+        yield
+        return
+
+    with _tracer.phase(name):
+        yield
+
+
+@contextmanager
+def tracing_to(tracer: Tracer) -> Iterator[Tracer]:
+    """Collect phases and commands into tracer for the duration of the block"""
+    global _tracer
+    previous = _tracer
+    _tracer = tracer
+    try:
+        yield tracer
+    finally:
+        _tracer = previous
+
+
+def record_command(
+    command: str, start: float, end: float, exit_code: Optional[int]
+) -> None:
+    """Record a command not run through TracingLocal"""
+    if _tracer is not None:
+        _tracer.command(command, start, end, exit_code)
+
+
+def set_kernel(kernel_dir: Path) -> None:
+    """Save the summary of this run into the manifest of kernel_dir"""
+    if _tracer is not None:
+        _tracer.kernel_dir = kernel_dir
+
+
+def install(ns: Collection) -> None:
+    global _tracer
+    value = os.environ.get(TRACE_ENV, "")
+    if value in ("", "0"):
+        return
+
+    tasks = [a for a in sys.argv[1:] if TASK_NAME.match(a)]
+    label = " ".join(tasks) or "inv"
+    if value == "1":
+        path = (
+            TRACE_DIR
+            / f"{time.strftime('%Y%m%d-%H%M%S')}-{label.replace(' ', '_')}.json"
+        )
+    else:
+        path = Path(value)
+
+    _tracer = Tracer(path, label)
+    ns.configure({"runners": {"local": TracingLocal}})
+    atexit.register(_tracer.write)
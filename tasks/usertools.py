@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+
+from invoke.context import Context as InvokeContext
+
+from tasks.compiler import CONTAINER_LINUX_BUILD_PATH, get_compiler
+from tasks.kernel import (
+    KernelBuildPaths,
+    KernelVersion,
+    Runner,
+    get_kernel_pkg_dir,
+    use_docker_compiler,
+)
+from tasks.tool import Exit, info, warn
+
+# perf, bpftool and libbpf of a kernel tree, keyed by the git tree of its
+# tools/ directory, the make flags and where they were built. Kernels whose
+# tools/ did not change share one build.
+TOOLS_CACHE = KernelBuildPaths.kernel_sources_dir / "tools-cache"
+# cache key of the tools of a kernel package, read when its overlay is set up
+TOOLS_KEY = "tools.key"
+# install root and build script below the kernel tree, visible in the
+# compiler container like the wrappers of tasks/btf.py and tasks/ccprofile.py
+TOOLS_DEST = ".kbuild-tools"
+# objects go to their own directory, tools/ is shared with objtool and
+# resolve_btfids of the kernel build running at the same time
+TOOLS_OUTPUT = ".kbuild-tools-build"
+TOOLS_SCRIPT = ".kbuild-tools.sh"
+TOOLS_PREFIX = "/usr/local"
+# perf and bpftool are linked statically. The guest is a bullseye debootstrap,
+# whose glibc is older than that of most build hosts, and binaries linked
+# against a newer one fail to start there.
+PERF_FLAGS = "NO_LIBPYTHON=1 NO_LIBPERL=1 NO_GTK2=1 NO_JVMTI=1 LDFLAGS=-static"
+BPFTOOL_FLAGS = "EXTRA_LDFLAGS=-static"
+# run in the guest root once installed, relative to TOOLS_PREFIX
+GUEST_CHECKS = ["bin/perf --version", "sbin/bpftool version"]
+
+TOOLS_BUILD_TEMPLATE = """#!/bin/bash
+set -e
+src={source_dir}
+dest=$src/{dest}
+out=$src/{output}
+rm -rf $dest $out
+mkdir -p $out/libbpf $out/bpftool $out/perf
+make -C $src/tools/lib/bpf -j$(nproc) OUTPUT=$out/libbpf/ prefix={prefix} DESTDIR=$dest install
+make -C $src/tools/bpf/bpftool -j$(nproc) OUTPUT=$out/bpftool/ {bpftool_flags} prefix={prefix} DESTDIR=$dest install
+make -C $src/tools/perf -j$(nproc) O=$out/perf {perf_flags} prefix={prefix} DESTDIR=$dest install-bin
+"""
+
+# libbpf is found through the ld.so cache
+LDCONFIG_TEMPLATE = """
+echo {prefix}/lib64 | sudo tee {root}/etc/ld.so.conf.d/kbuild-tools.conf > /dev/null
+sudo chroot {root} ldconfig
+"""
+
+
+def tools_tree(
+    ctx: InvokeContext, kversion: KernelVersion, always_use_gcc8: bool
+) -> tuple[Runner, Path, Path, str]:
+    """Runner, tree as seen by it, tree on the host and the environment the
+    tools are built in"""
+    host_dir = KernelBuildPaths.linux_stable / kversion.worktree
+    if use_docker_compiler(kversion, always_use_gcc8):
+        cc = get_compiler(ctx, KernelBuildPaths.kernel_sources_dir)
+        source_dir = CONTAINER_LINUX_BUILD_PATH / "linux-stable" / kversion.worktree
+        return cc.exec, source_dir, host_dir, f"container:{cc.image}"
+
+    return ctx.run, host_dir.absolute(), host_dir, "host"
+
+
+def tools_key(ctx: InvokeContext, host_dir: Path, environment: str) -> Optional[str]:
+    """Git tree of tools/, uncommitted changes to it, the make flags and the
+    build environment"""
+    tree = ctx.run(f"git -C {host_dir} rev-parse HEAD:tools", hide=True, warn=True)
+    diff = ctx.run(f"git -C {host_dir} diff HEAD -- tools", hide=True, warn=True)
+    if tree is None or diff is None or not tree.ok:
+        return None
+
+    digest = hashlib.sha256()
+    for part in (
+        tree.stdout.strip(),
+        diff.stdout,
+        PERF_FLAGS,
+        BPFTOOL_FLAGS,
+        environment,
+    ):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def build_userspace_tools(
+    ctx: InvokeContext, kversion: KernelVersion, always_use_gcc8: bool = False
+) -> Path:
+    """Build perf, bpftool and libbpf from the worktree of the kernel unless
+    the cache already has them, and record the key in the kernel package.
+    Returns the cached install root."""
+    run, source_dir, host_dir, environment = tools_tree(ctx, kversion, always_use_gcc8)
+    key = tools_key(ctx, host_dir, environment)
+    if key is None:
+        raise Exit(f"{host_dir} is not a git worktree, check out {kversion} first")
+
+    cached = TOOLS_CACHE / key
+    if cached.exists():
+        info(f"[+] perf, bpftool and libbpf of {kversion} are cached in {cached}")
+    else:
+        info(f"[+] Building perf, bpftool and libbpf of {kversion}")
+        script = host_dir / TOOLS_SCRIPT
+        script.write_text(
+            TOOLS_BUILD_TEMPLATE.format(
+                source_dir=source_dir,
+                dest=TOOLS_DEST,
+                output=TOOLS_OUTPUT,
+                prefix=TOOLS_PREFIX,
+                perf_flags=PERF_FLAGS,
+                bpftool_flags=BPFTOOL_FLAGS,
+            )
+        )
+        os.chmod(script, 0o755)
+        run(f"bash {source_dir / TOOLS_SCRIPT}")
+
+        TOOLS_CACHE.mkdir(parents=True, exist_ok=True)
+        staging = TOOLS_CACHE / f".{key}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        shutil.copytree(host_dir / TOOLS_DEST, staging, symlinks=True)
+        staging.replace(cached)
+
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    pkg_dir.mkdir(parents=True, exist_ok=True)
+    (pkg_dir / TOOLS_KEY).write_text(key)
+    return cached
+
+
+def cached_tools(kversion: KernelVersion) -> Optional[Path]:
+    key_file = get_kernel_pkg_dir(kversion) / TOOLS_KEY
+    if not key_file.exists():
+        return None
+
+    cached = TOOLS_CACHE / key_file.read_text().strip()
+    if not cached.exists():
+        warn(
+            f"[!] Tools of {kversion} are no longer in {TOOLS_CACHE}, run 'inv kernel.tools'"
+        )
+        return None
+    return cached
+
+
+def install_userspace_tools(
+    ctx: InvokeContext, kversion: KernelVersion, root: Path
+) -> None:
+    """Copy the cached tools into the mounted guest disk at root and check
+    that they start there"""
+    cached = cached_tools(kversion)
+    if cached is None:
+        return
+
+    ctx.run(f"sudo cp -a {cached}/. {root}/")
+    ctx.run(LDCONFIG_TEMPLATE.format(prefix=TOOLS_PREFIX, root=root))
+    for check in GUEST_CHECKS:
+        res = ctx.run(
+            f"sudo chroot {root} {TOOLS_PREFIX}/{check}", hide=True, warn=True
+        )
+        if res is None or not res.ok:
+            error = res.stderr.strip() if res is not None else ""
+            raise Exit(
+                f"{check.split()[0]} of {kversion} from {cached} does not run in the guest: {error}"
+            )
+    info(f"[+] Installed perf, bpftool and libbpf of {kversion} into the overlay")
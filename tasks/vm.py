@@ -1,25 +1,85 @@
 from __future__ import annotations
 
+import math
 import os
-import netifaces
+import shutil
+import sys
+import time
 import json
 from invoke import task
 from glob import glob
 from tasks.arch import Arch
 from tasks.kernel import (
     build_kernel,
+    checkout_kernel,
     clean as kernel_clean,
+    config_fragments,
     get_kernel_pkg_dir,
     get_kernel_image_name,
     KernelBuildPaths,
     KernelVersion,
+    mark_used,
     requires_gcc8,
+    use_docker_compiler,
     DEFAULT_GIT_SOURCE,
     KernelManifest,
+    open_registry,
+)
+from tasks.qemu import (
+    generate_run_script,
+    QemuConfig,
+    HUGEPAGES_MOUNT,
+    DEFAULT_EPHEMERAL_SIZE,
+    net_queues,
+    parse_cpu_list,
+    PROFILE_DEFAULT,
+)
+from tasks.cgroups import (
+    CgroupLayout,
+    DEFAULT_BUILD_IO_WEIGHT,
+    DEFAULT_BUILD_WEIGHT,
+    DEFAULT_VM_IO_WEIGHT,
+    DEFAULT_VM_WEIGHT,
+    configure as configure_cgroups,
+    load_layout,
+    remove as remove_cgroups,
+    status as cgroups_status,
+    vm_cgroup,
+)
+from tasks.rootfs import RootfsBuildPaths, build_base_image, setup_kernel_overlay
+from tasks.steps import (
+    MAYBE,
+    RUN,
+    STEPS_FILE,
+    Inputs,
+    Step,
+    StepGraph,
+    fingerprint,
+    git_tree_digest,
+)
+from tasks.tool import Exit, info, warn
+from tasks.tracing import set_kernel
+from tasks.usertools import TOOLS_KEY, build_userspace_tools, tools_key
+from tasks.network import create_tap, link_exists, tap_name, teardown_all, teardown_tap
+from tasks.registry import GDB_PORTS, POOLS, TAPS, port_free
+from tasks.density import mem_stats_report
+from tasks.elf import has_gdb_index, has_pvh_entry, read_build_id
+from tasks.debuginfod import (
+    DEBUGINFOD_PORT,
+    listen_addresses,
+    serve as serve_debuginfod,
+)
+from tasks.guest import (
+    Guest,
+    GuestResult,
+    guest_from_manifest,
+    launch_vm,
+    run_on_guests,
+    stop_vm,
+    vm_running,
+    wait_for_ssh,
+    wait_ready as wait_guests_ready,
 )
-from tasks.qemu import generate_qemu_cmdline
-from tasks.rootfs import rootfs_build
-from tasks.tool import Exit
 from invoke.context import Context as InvokeContext
 from tasks.compiler import get_compiler, CONTAINER_LINUX_BUILD_PATH
 from pathlib import Path
@@ -33,21 +93,46 @@ DEFAULT_MEMORY = "8G"
 DEFAULT_KERNEL_CMDLINE = (
     "console=ttyS0 acpi=off panic=-1 root=/dev/vda rw net.ifnames=0 reboot=t nokaslr"
 )
+# Boot messages go to the virtio console at a quiet printk level and the
+# legacy devices which microvm does not have are not probed.
+FAST_BOOT_KERNEL_CMDLINE = (
+    "console=hvc0 quiet loglevel=3 acpi=off panic=-1 root=/dev/vda rw net.ifnames=0 reboot=t nokaslr "
+    "i8042.noaux i8042.nomux i8042.nopnp i8042.dumbkbd tsc=reliable no_timer_check"
+)
+FAST_BOOT_CONFIG = KernelBuildPaths.configs_dir / "fastboot.config"
+DEFAULT_BOOT_BENCH_ITERATIONS = 10
+DEFAULT_BENCH_ITERATIONS = 5
+DEFAULT_BENCH_TIMEOUT = 1800
+DEFAULT_SELFTEST_INSTANCES = 4
+DEFAULT_SELFTEST_CPUS = 2
+DEFAULT_SELFTEST_MEMORY = "4G"
+# per test, only there to catch a guest which stopped answering
+DEFAULT_SELFTEST_TIMEOUT = 3600
+# kernels vm.gc leaves alone, the ones built or booted last
+DEFAULT_GC_KEEP = 3
+BOOT_TIMEOUT = 120
+# steps of vm.init running at the same time: the base rootfs build is disk
+# and network bound, it overlaps with the kernel compile and the tools
+INIT_JOBS = 3
+# build id of the vmlinux the gdb scripts and index were generated for
+GDB_ASSETS_STAMP = ".gdb-assets.build-id"
 
 
-def tap_interface_name() -> str:
-    interfaces = netifaces.interfaces()
-    for i in range(1, 100):
-        name = f"qemu_tap-{i}"
-        if name in interfaces:
-            continue
-
-        return name
+def tap_interface_name(owner: str) -> str:
+    with open_registry() as registry:
+        slot = registry.allocate(
+            TAPS, owner, accept=lambda i: not link_exists(tap_name(i))
+        )
 
-    raise Exit("could not find a valid suffix for tap name. Too may taps active")
+    return tap_name(slot)
 
 
-def setup_tap_interface(ctx: InvokeContext, kernel_version: KernelVersion) -> str:
+def setup_tap_interface(
+    ctx: InvokeContext,
+    kernel_version: KernelVersion,
+    queues: int = 1,
+    bridge: bool = False,
+) -> str:
     manifest_file = get_kernel_pkg_dir(kernel_version) / "kernel.manifest"
     with open(manifest_file, "r") as f:
         manifest = json.load(f)
@@ -57,74 +142,184 @@ def setup_tap_interface(ctx: InvokeContext, kernel_version: KernelVersion) -> st
             "vm package improperly initialized. No gateway ip specified in manifest"
         )
 
-    default_interface = ctx.run(
-        "ip route get $(getent ahosts google.com | awk '{print $1; exit}') | grep -Po '(?<=(dev ))(\S+)'"
-    ).stdout.split()[0]
-
     tap_ip = manifest["gateway_ip"]
     if "tap_name" in manifest:
-        old_tap = manifest["tap_name"]
-        ctx.run(f"sudo ip link del {old_tap}", warn=True)
-
-    tap_name = tap_interface_name()
-    ctx.run(f"sudo ip link del {tap_name}", warn=True)
-    ctx.run(f"sudo ip tuntap add {tap_name} mode tap")
-    ctx.run(f"sudo ip addr add {tap_ip}/30 dev {tap_name}")
-    ctx.run(f"sudo ip link set dev {tap_name} up")
-    ctx.run("sudo sh -c 'echo 1 > /proc/sys/net/ipv4/ip_forward'")
-
-    '''
-    This iptables rule effectively sets up NAT for outbound traffic on interface {default_interface}, 
-    allowing devices on the local network to access the internet using the public IP address associated with {default_interface}
-    '''
-    ctx.run(f"sudo iptables -t nat -A POSTROUTING -o {default_interface} -j MASQUERADE")
-    ctx.run(
-        "sudo iptables -A FORWARD -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT"
-    )
-    ctx.run(f"sudo iptables -A FORWARD -i {tap_name} -o {default_interface} -j ACCEPT")
+        teardown_tap(ctx, manifest["tap_name"], tap_ip)
 
-    return tap_name
+    tap = tap_interface_name(get_kernel_pkg_dir(kernel_version).name)
+    create_tap(ctx, tap, tap_ip, queues=queues, bridge=bridge)
 
+    return tap
 
-def setup_kernel_package(
+
+def kernel_package_steps(
     ctx: InvokeContext,
     kernel_version: KernelVersion,
     arch: Arch,
     compile_only: bool,
     always_use_gcc8: bool,
-    kernel_src_dir: str | None,
     git_source: str,
-) -> None:
-    build_kernel(
-        ctx,
-        kversion=kernel_version,
-        arch=arch,
-        compile_only=compile_only,
-        always_use_gcc8=always_use_gcc8,
-        kernel_src_dir=kernel_src_dir,
-        git_source=git_source,
+    extra_config: Optional[str] = None,
+    debuginfod: bool = False,
+    tools: bool = False,
+    sparse: bool = False,
+) -> list[Step]:
+    """Steps building the kernel package and the guest disk. The base image
+    is shared by all kernels and records its step next to it."""
+    pkg_dir = get_kernel_pkg_dir(kernel_version)
+    state = pkg_dir / STEPS_FILE
+    worktree = KernelBuildPaths.linux_stable / kernel_version.worktree
+    manifest_file = pkg_dir / "kernel.manifest"
+    rootfs = RootfsBuildPaths.images_dir / "rootfs.qcow2"
+
+    def checkout() -> None:
+        cloned = checkout_kernel(
+            ctx,
+            kernel_version,
+            git_source,
+            sparse=sparse,
+            arch=arch,
+        )
+        if cloned and use_docker_compiler(kernel_version, always_use_gcc8):
+            # restart compiler if we had to clone the kernel sources again
+            get_compiler(ctx, KernelBuildPaths.kernel_sources_dir).stop()
+
+    def checkout_inputs() -> Inputs:
+        inputs = {"version": str(kernel_version), "git_source": git_source}
+        if sparse:
+            inputs["sparse"] = arch.kernel_arch
+        return inputs
+
+    def kernel_inputs() -> Inputs:
+        inputs = {
+            "arch": arch.name,
+            "compile_only": str(compile_only),
+            "gcc8": str(use_docker_compiler(kernel_version, always_use_gcc8)),
+            "source": git_tree_digest(ctx, worktree),
+        }
+        for fragment in config_fragments(extra_config):
+            inputs[f"config:{fragment.name}"] = fingerprint(fragment)
+        return inputs
+
+    def kernel() -> None:
+        build_kernel(
+            ctx,
+            kversion=kernel_version,
+            arch=arch,
+            extra_config=extra_config,
+            compile_only=compile_only,
+            always_use_gcc8=always_use_gcc8,
+            git_source=git_source,
+            no_checkout=True,
+        )
+
+    def tools_inputs() -> Inputs:
+        gcc8 = use_docker_compiler(kernel_version, always_use_gcc8)
+        return {"tools": tools_key(ctx, worktree, f"gcc8:{gcc8}") or "absent"}
+
+    def userspace_tools() -> None:
+        build_userspace_tools(ctx, kernel_version, always_use_gcc8)
+
+    def overlay_inputs() -> Inputs:
+        inputs = {"debuginfod": str(debuginfod)}
+        if tools:
+            inputs["tools"] = "installed"
+        return inputs
+
+    def overlay() -> None:
+        if (pkg_dir / "overlay.qcow2").exists():
+            warn(
+                f"[!] Recreating {pkg_dir}/overlay.qcow2, changes made in the guest are lost"
+            )
+        setup_kernel_overlay(ctx, kernel_version, debuginfod=debuginfod, tools=tools)
+
+    def base_image() -> None:
+        build_base_image(ctx, arch)
+
+    def manifest_has(field: str) -> bool:
+        if not manifest_file.exists():
+            return False
+        with open(manifest_file, "r") as f:
+            return field in json.load(f)
+
+    steps = [
+        Step(
+            "checkout",
+            checkout,
+            state,
+            inputs=checkout_inputs,
+            outputs=[worktree],
+        ),
+        Step(
+            "kernel",
+            kernel,
+            state,
+            inputs=kernel_inputs,
+            outputs=[pkg_dir / "vmlinux", pkg_dir / get_kernel_image_name(arch)],
+            deps=["checkout"],
+            adopt=lambda: manifest_has("kid"),
+        ),
+        Step(
+            "rootfs",
+            base_image,
+            RootfsBuildPaths.images_dir / STEPS_FILE,
+            inputs=lambda: {"arch": arch.name},
+            outputs=[rootfs],
+            adopt=rootfs.exists,
+        ),
+    ]
+    if tools:
+        # built from the checked out tree next to the kernel compile
+        steps.append(
+            Step(
+                "tools",
+                userspace_tools,
+                state,
+                inputs=tools_inputs,
+                outputs=[pkg_dir / TOOLS_KEY],
+                deps=["checkout"],
+            )
+        )
+    steps.append(
+        Step(
+            "overlay",
+            overlay,
+            state,
+            inputs=overlay_inputs,
+            outputs=[pkg_dir / "overlay.qcow2"],
+            deps=["kernel", "rootfs", "tools"] if tools else ["kernel", "rootfs"],
+            adopt=lambda: manifest_has("guest_ip"),
+        )
     )
-    rootfs_build(ctx, kernel_version)
+    return steps
 
 
-def find_free_gdb_port() -> int:
-    kernel_dir = os.path.join(".", "kernels", "sources")
-    all_kernels = glob(f"{kernel_dir}/kernel-*")
-    ports = list()
-    for k in all_kernels:
-        if not os.path.isdir(k):
-            continue
+def find_free_gdb_port(owner: str) -> int:
+    with open_registry() as registry:
+        return registry.allocate(GDB_PORTS, owner, accept=port_free)
 
-        with open(os.path.join(k, "kernel.manifest"), "r") as f:
-            manifest = json.load(f)
-            if "gdb_port" in manifest:
-                ports.append(manifest["gdb_port"])
 
-    for i in range(5432, 6432):
-        if i not in ports:
-            return i
+def gdb_assets_current(kdir: Path, build_id: Optional[str]) -> bool:
+    stamp = kdir / GDB_ASSETS_STAMP
+    vmlinux_gdb = kdir / "linux-source" / "vmlinux-gdb.py"
+    if build_id is None or not stamp.exists() or not vmlinux_gdb.exists():
+        return False
+
+    return stamp.read_text().strip() == build_id
+
 
-    return 0
+def index_vmlinux(ctx: InvokeContext, vmlinux: Path) -> None:
+    """Embed a .gdb_index in vmlinux so gdb does not have to build its symbol
+    tables from the DWARF on every attach."""
+    if has_gdb_index(vmlinux):
+        return
+
+    if shutil.which("gdb-add-index") is None:
+        warn("[!] gdb-add-index not found, gdb.sh falls back to gdb's index cache")
+        return
+
+    info(f"[+] Building gdb index for {vmlinux}")
+    ctx.run(f"gdb-add-index {vmlinux}")
 
 
 def add_gdb_script(
@@ -134,36 +329,128 @@ def add_gdb_script(
     if not os.path.exists(kdir):
         raise Exit(f"Kernel directory '{kdir}' not present")
 
-    cfg = build_path / ".config"
-    ctx.run(f"cp {cfg} {kdir}/linux-source")
+    dbg_img = kdir.absolute() / "vmlinux"
+    build_id = read_build_id(dbg_img)
+    if gdb_assets_current(kdir, build_id):
+        info(f"[+] gdb scripts and index up to date for build id {build_id}")
+    else:
+        cfg = build_path / ".config"
+        ctx.run(f"cp {cfg} {kdir}/linux-source")
 
-    run_cmd = ctx.run
-    source_dir = kdir
-    if requires_gcc8(kernel_version):
-        cc = get_compiler(ctx, KernelBuildPaths.kernel_sources_dir)
-        run_cmd = cc.exec
-        source_dir = CONTAINER_LINUX_BUILD_PATH / os.path.basename(kdir)
+        run_cmd = ctx.run
+        source_dir = kdir
+        if requires_gcc8(kernel_version):
+            cc = get_compiler(ctx, KernelBuildPaths.kernel_sources_dir)
+            run_cmd = cc.exec
+            source_dir = CONTAINER_LINUX_BUILD_PATH / os.path.basename(kdir)
 
-    run_cmd(f"cd {source_dir}/linux-source && make scripts_gdb")
+        run_cmd(f"cd {source_dir}/linux-source && make scripts_gdb")
+        index_vmlinux(ctx, dbg_img)
+        if build_id is not None:
+            (kdir / GDB_ASSETS_STAMP).write_text(build_id)
 
-    dbg_img = kdir.absolute() / "vmlinux"
     src_dir = kdir.absolute() / "linux-source"
     vmlinux_gdb = src_dir.absolute() / "vmlinux-gdb.py"
+    index_cache = kdir.absolute() / "gdb-index-cache"
     gdb_script = kdir / "gdb.sh"
     with open(gdb_script, "w") as f:
         f.write("#!/bin/bash\n")
-        f.write(f'gdb -ex "add-auto-load-safe-path {src_dir}" -ex "file {dbg_img}" -ex "set arch i386:x86-64:intel" \
+        f.write(
+            f'gdb -iex "set index-cache directory {index_cache}" -iex "set index-cache on" \
+                -ex "add-auto-load-safe-path {src_dir}" -ex "file {dbg_img}" -ex "set arch i386:x86-64:intel" \
                 -ex "target remote localhost:{port}" -ex "source {vmlinux_gdb}" -ex "set disassembly-flavor intel" \
-                -ex "set pagination off"\n')
+                -ex "set pagination off"\n'
+        )
 
     ctx.run(f"chmod +x {gdb_script}")
 
 
+def boot_kernel_cmdline(fast_boot: bool, append: str) -> str:
+    if fast_boot:
+        return FAST_BOOT_KERNEL_CMDLINE + f" {append}"
+    return DEFAULT_KERNEL_CMDLINE + f" {append}"
+
+
+def boot_kernel_image(pkg_dir: Path, arch: Arch, fast_boot: bool) -> Path:
+    """For fast boot prefer the uncompressed vmlinux, which qemu can start
+    through its PVH entry point without any decompression. Kernels built
+    without CONFIG_PVH fall back to the regular (LZ4 with fastboot.config)
+    compressed image."""
+    vmlinux = pkg_dir / "vmlinux"
+    if fast_boot and has_pvh_entry(vmlinux):
+        return vmlinux
+
+    if fast_boot:
+        warn(f"[!] {vmlinux} has no PVH entry point, booting compressed image")
+
+    return pkg_dir / get_kernel_image_name(arch)
+
+
+def snapshot_run(
+    kversion: KernelVersion,
+    kernel_image: Path,
+    cmd: str,
+    timeout: Optional[float],
+    append: str = "",
+    tag: str = "snapshot",
+    cpus: int = DEFAULT_CPUS,
+    memory: str = DEFAULT_MEMORY,
+) -> Optional[GuestResult]:
+    """Boot kernel_image with -snapshot on the disk, tap and ssh key of an
+    initialized kernel package, run cmd in the guest and stop it again.
+    Returns None when the guest does not become ssh-ready."""
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    with open(pkg_dir / "kernel.manifest", "r") as f:
+        manifest = json.load(f)
+
+    qemu_config = QemuConfig(
+        kernel_image=kernel_image,
+        kernel_cmdline=boot_kernel_cmdline(False, append),
+        rootfs_path=pkg_dir / "overlay.qcow2",
+        tap_interface=manifest["tap_name"],
+        gdb_port=manifest["gdb_port"],
+        memory=memory,
+        cpus=cpus,
+        pidfile=pkg_dir / f"{tag}.pid",
+        name=f"{pkg_dir.name}-{tag}",
+        snapshot=True,
+        interactive=False,
+        cgroup=vm_cgroup(f"{pkg_dir.name}-{tag}"),
+    )
+
+    guest = guest_from_manifest(kversion)
+    mark_used(kversion)
+    # a master left behind by a run that was killed would outlive this boot
+    guest.close_master()
+    proc = launch_vm(qemu_config, pkg_dir / f"{tag}.log")
+    try:
+        if not wait_for_ssh(guest.ip, BOOT_TIMEOUT, proc):
+            return None
+
+        return run_on_guests([guest], cmd, timeout)[0]
+    finally:
+        stop_vm(proc, guest=guest)
+
+
 @task(  # type: ignore
     help={
         "kernel_version": "kernel version string of the form v6.8 or v5.2.20",
         "platform_arch": "architecture of the form x86 or aarch64, etc.",
         "compile_only": "only rebuild bzImage",
+        "profile": "qemu device profile: 'default' or 'perf' (multiqueue vhost-net, iothread virtio-blk with io_uring)",
+        "hugepages": "back guest memory with hugepages from /dev/hugepages",
+        "pin_cpus": "host cpu list, e.g. 2-5, to pin vCPU threads to",
+        "fast_boot": "boot a microvm machine with a quiet virtio console and an uncompressed/LZ4 kernel",
+        "bridge": "attach the tap to the shared kbuild-br0 bridge instead of routing it on its own",
+        "ephemeral": "write guest changes to a throwaway overlay in /dev/shm, discarded when the VM exits",
+        "ephemeral_size": "free space required in /dev/shm before an ephemeral VM starts",
+        "debuginfod": "leave the kernel debug package out of the overlay, the guest fetches symbols from 'inv vm.debuginfod'",
+        "plan": "show which steps would run and why, without running any",
+        "serial": "run one step at a time instead of building the base rootfs while the kernel compiles",
+        "isolate": "pin vCPU threads to the VM cpus of the cgroup layout, away from build jobs",
+        "balloon": "return memory the guest frees to the host and merge identical pages with KSM",
+        "tools": "build perf, bpftool and libbpf from the kernel tree while it compiles and install them in the guest",
+        "sparse": "check out only what kbuild reads for the arch and config: no Documentation, other arches or disabled drivers",
     }
 )
 def init(
@@ -178,77 +465,554 @@ def init(
     memory: str = DEFAULT_MEMORY,
     append: str = "",
     wait_for_gdb: bool = False,
+    profile: str = PROFILE_DEFAULT,
+    hugepages: bool = False,
+    pin_cpus: Optional[str] = None,
+    fast_boot: bool = False,
+    bridge: bool = False,
+    ephemeral: bool = False,
+    ephemeral_size: str = DEFAULT_EPHEMERAL_SIZE,
+    debuginfod: bool = False,
+    plan: bool = False,
+    serial: bool = False,
+    isolate: bool = False,
+    balloon: bool = False,
+    tools: bool = False,
+    sparse: bool = False,
 ) -> None:
+    if hugepages and not HUGEPAGES_MOUNT.is_dir():
+        raise Exit(f"hugepages requested but {HUGEPAGES_MOUNT} is not mounted")
+
+    layout = load_layout()
+    if isolate:
+        if layout is None or layout.vm_cpus == "":
+            raise Exit(
+                "isolating vCPUs requires VM cpus in the cgroup layout, see 'inv vm.cgroups'"
+            )
+        pin_cpus = pin_cpus or layout.vm_cpus
+    if layout is not None and layout.vm_cpus != "" and pin_cpus is not None:
+        outside = set(parse_cpu_list(pin_cpus)) - set(parse_cpu_list(layout.vm_cpus))
+        if len(outside) > 0:
+            raise Exit(
+                f"cpus {sorted(outside)} are not in the VM cpus {layout.vm_cpus} of the cgroup layout"
+            )
+
     if platform_arch is None:
         arch = Arch.local()
     else:
         arch = Arch.from_str(platform_arch)
 
+    if fast_boot and arch.kernel_arch != "x86":
+        raise Exit(
+            "fast boot uses the qemu microvm machine which is only available on x86"
+        )
+
     kversion = KernelVersion.from_str(ctx, kernel_version)
     pkg_dir = get_kernel_pkg_dir(kversion)
+    if kernel_src_dir is not None:
+        KernelBuildPaths.linux_stable = Path(kernel_src_dir)
 
-    if not pkg_dir.exists():
-        setup_kernel_package(
-            ctx,
-            kversion,
-            arch,
-            compile_only,
-            always_use_gcc8,
-            kernel_src_dir,
-            git_source,
+    def network() -> None:
+        with open(pkg_dir / "kernel.manifest", "r") as f:
+            manifest: KernelManifest = json.load(f)
+
+        if "kernel_source_dir" not in manifest:
+            raise Exit(
+                "corrupted manifest does not contain 'kernel_source_dir' source directory"
+            )
+
+        if "gdb_port" not in manifest:
+            gdb_port = find_free_gdb_port(pkg_dir.name)
+        else:
+            gdb_port = manifest["gdb_port"]
+
+        tap = setup_tap_interface(
+            ctx, kversion, queues=net_queues(profile, cpus), bridge=bridge
+        )
+        qemu_config = QemuConfig(
+            kernel_image=boot_kernel_image(pkg_dir, arch, fast_boot),
+            kernel_cmdline=boot_kernel_cmdline(fast_boot, append),
+            rootfs_path=pkg_dir / "overlay.qcow2",
+            tap_interface=tap,
+            gdb_port=gdb_port,
+            memory=memory,
+            cpus=cpus,
+            pidfile=pkg_dir / "vm.pid",
+            wait_for_gdb=wait_for_gdb,
+            profile=profile,
+            hugepages=hugepages,
+            pin_cpus=pin_cpus,
+            name=pkg_dir.name,
+            fast_boot=fast_boot,
+            console_log=pkg_dir / "console.log" if fast_boot else None,
+            ephemeral_size=ephemeral_size if ephemeral else None,
+            cgroup=vm_cgroup(pkg_dir.name),
+            balloon=balloon,
         )
+        with open(f"{pkg_dir}/run.sh", "w") as f:
+            f.write(generate_run_script(qemu_config, pkg_dir / "vm.log"))
 
-    manifest: KernelManifest = {}
-    with open(pkg_dir / "kernel.manifest", "r") as f:
-        manifest = json.load(f)
+        ctx.run(f"chmod +x {pkg_dir}/run.sh")
+
+        manifest["tap_name"] = tap
+        manifest["gdb_port"] = gdb_port
+        manifest["last_used"] = time.time()
+        with open(pkg_dir / "kernel.manifest", "w") as f:
+            json.dump(manifest, f)
+
+    def manifest_inputs() -> Inputs:
+        if not (pkg_dir / "kernel.manifest").exists():
+            return {"gdb_port": "absent"}
+        with open(pkg_dir / "kernel.manifest", "r") as f:
+            manifest = json.load(f)
+        return {"gdb_port": str(manifest.get("gdb_port"))}
+
+    def gdb() -> None:
+        with open(pkg_dir / "kernel.manifest", "r") as f:
+            manifest = json.load(f)
+        add_gdb_script(
+            ctx, Path(manifest["kernel_source_dir"]), kversion, manifest["gdb_port"]
+        )
 
-    if "kernel_source_dir" not in manifest:
+    steps = kernel_package_steps(
+        ctx,
+        kversion,
+        arch,
+        compile_only,
+        always_use_gcc8,
+        git_source,
+        extra_config=str(FAST_BOOT_CONFIG) if fast_boot else None,
+        debuginfod=debuginfod,
+        tools=tools,
+        sparse=sparse,
+    )
+    steps += [
+        # the tap device and run.sh are host state which is set up every time
+        Step("network", network, pkg_dir / STEPS_FILE, deps=["overlay"], always=True),
+        Step(
+            "gdb",
+            gdb,
+            pkg_dir / STEPS_FILE,
+            inputs=manifest_inputs,
+            outputs=[pkg_dir / "gdb.sh"],
+            deps=["kernel", "network"],
+            adopt=lambda: gdb_assets_current(
+                pkg_dir, read_build_id(pkg_dir / "vmlinux")
+            ),
+        ),
+    ]
+    graph = StepGraph(steps)
+    if plan:
+        info(f"[+] vm.init plan for {kversion}:")
+        graph.print_plan()
+        return
+
+    pending = {name for name, action, _ in graph.plan() if action in (RUN, MAYBE)}
+    if len(pending - {"network"}) > 0 and vm_running(pkg_dir / "vm.pid"):
         raise Exit(
-            "corrupted manifest does not contain 'kernel_source_dir' source directory"
+            f"VM of kernel {kversion} is running, stop it before rebuilding {', '.join(sorted(pending))}"
         )
 
-    build_path = Path(manifest["kernel_source_dir"])
+    set_kernel(pkg_dir)
+    jobs = 1 if serial else INIT_JOBS
+    if jobs > 1 and {"kernel", "rootfs"} <= pending:
+        # ask for the sudo password now, not in the middle of the compile
+        # output, and keep concurrent commands from fighting over the tty
+        ctx.run("sudo -v")
+        ctx.config.run.in_stream = False
 
-    if "gdb_port" not in manifest:
-        gdb_port = find_free_gdb_port()
-        if gdb_port == 0:
-            raise Exit("unable to find free port for gdb server")
-    else:
-        gdb_port = manifest["gdb_port"]
-
-    tap = setup_tap_interface(ctx, kversion)
-    kernel_cmdline = DEFAULT_KERNEL_CMDLINE + f" {append}"
-
-    kimage = get_kernel_image_name(arch)
-    qemu_cmdline = generate_qemu_cmdline(
-        pkg_dir / "overlay.qcow2",
-        pkg_dir / kimage,
-        kernel_cmdline,
-        tap,
-        gdb_port,
-        wait_for_gdb,
+    start = time.monotonic()
+    times = graph.run(ctx, jobs=jobs, log_dir=pkg_dir)
+    total = time.monotonic() - start
+    busy = sum(times.values())
+    info(f"[+] vm.init of {kversion} finished in {total:.1f}s")
+    for name, seconds in times.items():
+        if seconds > 0:
+            info(f"    {seconds:>9.1f}s  {name}")
+    if busy > total + 1:
+        info(f"[+] Running steps in parallel saved {busy - total:.1f}s")
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+@task(  # type: ignore
+    help={
+        "kernel_version": "kernel version string of the form v6.8 or v5.2.20",
+        "iterations": "number of boots to measure",
+        "fast_boot": "measure the fast boot (microvm) configuration",
+    }
+)
+def boot_bench(
+    ctx: InvokeContext,
+    kernel_version: str,
+    iterations: int = DEFAULT_BOOT_BENCH_ITERATIONS,
+    fast_boot: bool = False,
+    platform_arch: Optional[str] = None,
+    cpus: int = DEFAULT_CPUS,
+    memory: str = DEFAULT_MEMORY,
+    append: str = "",
+) -> None:
+    """Measure boot to ssh-ready latency. Each boot runs with -snapshot so the
+    overlay is left untouched."""
+    if iterations < 1:
+        raise Exit(f"--iterations must be at least 1, got {iterations}")
+
+    arch = Arch.local() if platform_arch is None else Arch.from_str(platform_arch)
+    kversion = KernelVersion.from_str(ctx, kernel_version)
+    pkg_dir = get_kernel_pkg_dir(kversion)
+    manifest_file = pkg_dir / "kernel.manifest"
+    if not manifest_file.exists():
+        raise Exit(f"kernel {kversion} is not initialized, run vm.init first")
+
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+
+    for key in ["guest_ip", "tap_name", "gdb_port"]:
+        if key not in manifest:
+            raise Exit(f"manifest does not contain '{key}', run vm.init first")
+
+    if not os.path.exists(f"/sys/class/net/{manifest['tap_name']}"):
+        raise Exit(f"tap {manifest['tap_name']} does not exist, run vm.init first")
+
+    pidfile = pkg_dir / "boot-bench.pid"
+    if vm_running(pkg_dir / "vm.pid") or vm_running(pidfile):
+        raise Exit(f"a VM for kernel {kversion} is already running")
+
+    qemu_config = QemuConfig(
+        kernel_image=boot_kernel_image(pkg_dir, arch, fast_boot),
+        kernel_cmdline=boot_kernel_cmdline(fast_boot, append),
+        rootfs_path=pkg_dir / "overlay.qcow2",
+        tap_interface=manifest["tap_name"],
+        gdb_port=manifest["gdb_port"],
+        memory=memory,
+        cpus=cpus,
+        pidfile=pidfile,
+        name=pkg_dir.name,
+        fast_boot=fast_boot,
+        console_log=pkg_dir / "boot-bench.console.log",
+        snapshot=True,
+        interactive=False,
+        cgroup=vm_cgroup(f"{pkg_dir.name}-boot-bench"),
+    )
+
+    samples: list[float] = list()
+    for i in range(iterations):
+        start = time.monotonic()
+        proc = launch_vm(qemu_config, pkg_dir / "boot-bench.log")
+        try:
+            ready = wait_for_ssh(manifest["guest_ip"], BOOT_TIMEOUT, proc)
+            elapsed = time.monotonic() - start
+        finally:
+            stop_vm(proc)
+
+        if not ready:
+            raise Exit(
+                f"guest did not become ssh-ready within {BOOT_TIMEOUT}s, see {pkg_dir}/boot-bench.log"
+            )
+
+        samples.append(elapsed)
+        info(f"[+] boot {i + 1}/{iterations}: {elapsed:.3f}s")
+
+    summary = {
+        "fast_boot": fast_boot,
+        "iterations": iterations,
+        "min": min(samples),
+        "p50": percentile(samples, 50),
+        "p90": percentile(samples, 90),
+        "p99": percentile(samples, 99),
+        "max": max(samples),
+    }
+    info(
+        f"[+] boot-to-ssh for {kversion}: "
+        + " ".join(
+            [f"{k}={v:.3f}s" for k, v in summary.items() if isinstance(v, float)]
+        )
+    )
+
+    manifest["boot_bench"] = summary
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f)
+
+
+@task(  # type: ignore
+    help={
+        "kernel_versions": "comma separated kernels to compare, in order, e.g. 6.1.80,6.8.1",
+        "workloads": "comma separated subset of sched, syscall, net, block, bpf",
+        "iterations": "measured iterations of each workload per boot, after one warm up round",
+        "report_only": "print the latest stored results of the kernels without booting them",
+    }
+)
+def bench(
+    ctx: InvokeContext,
+    kernel_versions: str,
+    workloads: str = "sched,syscall,net,block,bpf",
+    iterations: int = DEFAULT_BENCH_ITERATIONS,
+    cpus: int = DEFAULT_CPUS,
+    memory: str = DEFAULT_MEMORY,
+    platform_arch: Optional[str] = None,
+    timeout: int = DEFAULT_BENCH_TIMEOUT,
+    report_only: bool = False,
+) -> None:
+    """Boot each kernel with -snapshot and identical resources, run the
+    workload suite over ssh and compare the kernels"""
+    # tasks.bench depends on this module for snapshot_run
+    from tasks.bench import bench_kernels
+
+    arch = Arch.local() if platform_arch is None else Arch.from_str(platform_arch)
+    bench_kernels(
+        [KernelVersion.from_str(ctx, v) for v in kernel_versions.split(",")],
+        arch,
+        [w.strip() for w in workloads.split(",") if w.strip() != ""],
+        iterations,
+        cpus,
         memory,
+        timeout,
+        report_only=report_only,
+    )
+
+
+@task(  # type: ignore
+    help={
+        "kernel_version": "kernel version string of the form v6.8 or v5.2.20",
+        "targets": "comma separated selftest collections to build and run",
+        "tests": "comma separated patterns of collection:test to run, e.g. 'net:*,bpf:test_progs'",
+        "instances": "VMs running shards of the tests at the same time",
+        "cpus": "cpus of each VM",
+        "memory": "memory of each VM",
+        "timeout": "seconds after which a test is considered hung and its VM replaced",
+        "rebuild": "build the selftests even if the tree did not change",
+        "reinstall": "copy the selftests into the overlay even if they are already there",
+    }
+)
+def selftests(
+    ctx: InvokeContext,
+    kernel_version: str,
+    targets: str = "bpf,net,netfilter",
+    tests: str = "",
+    instances: int = DEFAULT_SELFTEST_INSTANCES,
+    cpus: int = DEFAULT_SELFTEST_CPUS,
+    memory: str = DEFAULT_SELFTEST_MEMORY,
+    platform_arch: Optional[str] = None,
+    timeout: int = DEFAULT_SELFTEST_TIMEOUT,
+    append: str = "",
+    rebuild: bool = False,
+    reinstall: bool = False,
+) -> None:
+    """Build the kernel selftests in the worktree of the kernel and run them
+    sharded over a pool of -snapshot VMs, with a merged TAP and JUnit report"""
+    # tasks.selftests depends on this module through tasks.pool
+    from tasks.selftests import run_selftests
+
+    kversion = KernelVersion.from_str(ctx, kernel_version)
+    arch = Arch.local() if platform_arch is None else Arch.from_str(platform_arch)
+    run_selftests(
+        ctx,
+        kversion,
+        get_kernel_pkg_dir(kversion) / get_kernel_image_name(arch),
+        [t.strip() for t in targets.split(",") if t.strip() != ""],
+        [t.strip() for t in tests.split(",") if t.strip() != ""],
+        instances,
         cpus,
+        memory,
+        timeout,
+        rebuild=rebuild,
+        reinstall=reinstall,
     )
-    with open(f"{pkg_dir}/run.sh", "w") as f:
-        f.write(qemu_cmdline)
 
-    ctx.run(f"chmod +x {pkg_dir}/run.sh")
 
-    manifest["tap_name"] = tap
-    manifest["gdb_port"] = gdb_port
-    with open(pkg_dir / "kernel.manifest", "w") as f:
-        json.dump(manifest, f)
+@task(  # type: ignore
+    help={
+        "scenarios": "comma separated scenarios to run, all by default",
+        "report": "file the JSON report is written to, by default next to the scenario logs",
+    }
+)
+def overhead(
+    ctx: InvokeContext, scenarios: Optional[str] = None, report: Optional[str] = None
+) -> None:
+    """Count the commands kernel.build, rootfs.build and vm.init run against
+    fake git, make and docker, and check them against per-scenario budgets"""
+    # tasks.overhead runs the tasks of this module
+    from tasks.overhead import overhead_report
+
+    overhead_report(scenarios, report)
+
+
+def running_kernel_versions(ctx: InvokeContext) -> list[KernelVersion]:
+    versions = list()
+    for k in sorted(glob(f"{KernelBuildPaths.kernel_sources_dir}/kernel-*")):
+        if vm_running(Path(k) / "vm.pid"):
+            versions.append(
+                KernelVersion.from_str(ctx, os.path.basename(k)[len("kernel-") :])
+            )
+
+    return versions
+
+
+def select_guests(ctx: InvokeContext, kernel_versions: Optional[str]) -> list[Guest]:
+    if kernel_versions is None:
+        versions = running_kernel_versions(ctx)
+        if len(versions) == 0:
+            raise Exit("no running VMs found")
+    else:
+        versions = [KernelVersion.from_str(ctx, v) for v in kernel_versions.split(",")]
 
-    add_gdb_script(ctx, build_path, kversion, gdb_port)
+    return [guest_from_manifest(v) for v in versions]
+
+
+def report_guest_results(results: list[GuestResult], show_output: bool = True) -> None:
+    failed = [r for r in results if not r.ok]
+    for r in results:
+        status = (
+            f"[{r.guest.name} {r.guest.ip}] exit={r.exit_code} in {r.duration:.2f}s"
+        )
+        if r.ok:
+            info(status)
+        else:
+            warn(status)
+        if show_output and r.stdout != "":
+            print(r.stdout, end="" if r.stdout.endswith("\n") else "\n", flush=True)
+        if not r.ok and r.stderr != "":
+            print(
+                r.stderr,
+                end="" if r.stderr.endswith("\n") else "\n",
+                file=sys.stderr,
+                flush=True,
+            )
+
+    if len(failed) > 0:
+        raise Exit(
+            f"{len(failed)}/{len(results)} guests failed: {', '.join([r.guest.name for r in failed])}"
+        )
+
+
+@task(  # type: ignore
+    help={
+        "kernel_versions": "comma separated kernel versions, defaults to all running VMs",
+        "timeout": "seconds to wait for each guest",
+    }
+)
+def wait_ready(
+    ctx: InvokeContext,
+    kernel_versions: Optional[str] = None,
+    timeout: int = BOOT_TIMEOUT,
+) -> None:
+    results = wait_guests_ready(select_guests(ctx, kernel_versions), timeout)
+    report_guest_results(results, show_output=False)
+
+
+@task(  # type: ignore
+    name="exec",
+    help={
+        "cmd": "command to run in every guest",
+        "kernel_versions": "comma separated kernel versions, defaults to all running VMs",
+        "timeout": "seconds to allow the command to run, 0 for no limit",
+    },
+)
+def exec_cmd(
+    ctx: InvokeContext,
+    cmd: str,
+    kernel_versions: Optional[str] = None,
+    timeout: int = 0,
+) -> None:
+    """Run a command concurrently in many guests over multiplexed ssh connections"""
+    results = run_on_guests(
+        select_guests(ctx, kernel_versions), cmd, timeout if timeout > 0 else None
+    )
+    report_guest_results(results)
+
+
+@task(  # type: ignore
+    name="debuginfod",
+    help={
+        "host": "address to listen on instead of 127.0.0.1 and the tap gateways of the kernels, 0.0.0.0 for every interface",
+        "port": "port to listen on, guests are configured for the default",
+    },
+)
+def debuginfod_server(
+    ctx: InvokeContext, host: Optional[str] = None, port: int = DEBUGINFOD_PORT
+) -> None:
+    """Serve vmlinux, modules and sources of every built kernel by build id
+    over the debuginfod protocol"""
+    serve_debuginfod(ctx, [host] if host is not None else listen_addresses(), port)
+
+
+@task(  # type: ignore
+    help={"reap": "release leases of deleted kernel packages and dead processes"}
+)
+def leases(ctx: InvokeContext, reap: bool = False) -> None:
+    """Show the gdb ports, subnets, taps, nbd devices and ssh ports leased to each kernel"""
+    with open_registry() as registry:
+        if reap:
+            info(f"[+] Reaped {registry.reap()} stale leases")
+
+        for kind in POOLS:
+            for slot, owner in registry.leases(kind).items():
+                print(f"{kind:<10} {slot:<6} {owner}")
+
+
+@task(  # type: ignore
+    help={
+        "build_cpus": "cpu list builds run on, e.g. 0-11, empty for all",
+        "vm_cpus": "cpu list VMs run on, e.g. 12-15, empty for all",
+        "build_weight": "cpu.weight of builds, 100 is that of every other cgroup",
+        "vm_weight": "cpu.weight of all VMs together",
+        "build_memory": "memory.max of builds, e.g. 16G, or max",
+        "build_io_weight": "io.weight of builds",
+        "vm_io_weight": "io.weight of all VMs together",
+        "disable": "remove the cgroups, builds and VMs run where they are started again",
+    }
+)
+def cgroups(
+    ctx: InvokeContext,
+    build_cpus: Optional[str] = None,
+    vm_cpus: Optional[str] = None,
+    build_weight: int = DEFAULT_BUILD_WEIGHT,
+    vm_weight: int = DEFAULT_VM_WEIGHT,
+    build_memory: str = "max",
+    build_io_weight: int = DEFAULT_BUILD_IO_WEIGHT,
+    vm_io_weight: int = DEFAULT_VM_IO_WEIGHT,
+    disable: bool = False,
+) -> None:
+    """Place builds and VMs in cgroup v2 slices of their own. Without any
+    option, show the layout and what builds and VMs were throttled by."""
+    if disable:
+        remove_cgroups()
+        return
+
+    layout = CgroupLayout(
+        build_cpus=build_cpus or "",
+        vm_cpus=vm_cpus or "",
+        build_weight=build_weight,
+        vm_weight=vm_weight,
+        build_memory=build_memory,
+        build_io_weight=build_io_weight,
+        vm_io_weight=vm_io_weight,
+    )
+    if (
+        build_cpus is None
+        and vm_cpus is None
+        and layout.to_dict() == CgroupLayout().to_dict()
+    ):
+        cgroups_status()
+        return
+
+    configure_cgroups(layout)
+
+
+@task  # type: ignore
+def mem_stats(ctx: InvokeContext) -> None:
+    """Host memory used by every running VM, with what KSM merged out of them"""
+    mem_stats_report()
 
 
 @task  # type: ignore
 def cleanup_taps(ctx: InvokeContext) -> None:
-    interfaces = netifaces.interfaces()
-    for tap in interfaces:
-        if "qemu_tap" in tap:
-            ctx.run(f"sudo ip link del {tap}", warn=True)
+    teardown_all(ctx)
 
 
 @task(  # type: ignore
@@ -303,12 +1067,35 @@ def destroy(ctx: InvokeContext, kernel_version: str, full: bool = False) -> None
             manifest = json.load(f)
 
         if "tap_name" in manifest:
-            name = manifest["tap_name"]
-            ctx.run(f"sudo ip link del {name}", warn=True)
+            teardown_tap(ctx, manifest["tap_name"], manifest.get("gateway_ip"))
     except:
         pass
 
     ctx.run(f"rm -rf {kernel_dir}")
+    with open_registry() as registry:
+        registry.release_owner(kernel_dir.name)
 
     if full:
         kernel_clean(ctx, kernel_version, full=full)
+
+
+@task(  # type: ignore
+    help={
+        "keep": "number of kernels used last whose artifacts are left alone",
+        "free": "stop once this much is reclaimed, e.g. 50G, instead of reclaiming everything beyond --keep",
+        "compact": "also rewrite the overlays of kernels which are not running without their unused clusters",
+        "dry_run": "only show the space used and what would be reclaimed",
+    }
+)
+def gc(
+    ctx: InvokeContext,
+    keep: int = DEFAULT_GC_KEEP,
+    free: Optional[str] = None,
+    compact: bool = False,
+    dry_run: bool = False,
+) -> None:
+    """Show the disk space of every kernel by artifact and reclaim that of
+    the kernels not used recently, whatever is cheapest to get back first"""
+    from tasks.disk import gc as _gc
+
+    _gc(ctx, keep=keep, free=free, compact=compact, dry_run=dry_run)